@@ -0,0 +1,10 @@
+"""Run every test against a scratch SQLite database and file store."""
+from __future__ import annotations
+
+import os
+import tempfile
+
+# Must be set before tgbot_project.database.db builds its engine.
+_SCRATCH = tempfile.mkdtemp(prefix="tgbot-tests-")
+os.environ.setdefault("TGBOT_DATABASE_URL", f"sqlite:///{os.path.join(_SCRATCH, 'tests.db')}")
+os.environ.setdefault("TGBOT_STORAGE_ROOT", os.path.join(_SCRATCH, "store"))
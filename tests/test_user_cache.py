@@ -0,0 +1,43 @@
+"""The user cache must never keep a record older than the last committed write."""
+from __future__ import annotations
+
+from contextlib import contextmanager
+
+from tgbot_project.database import db
+from tgbot_project.database.cache import TTLCache
+from tgbot_project.database.db import add_or_update_user, get_user_by_id, init_db, set_user_role, user_cache
+
+
+def test_set_after_invalidate_is_dropped():
+    cache = TTLCache(max_entries=10, ttl=60)
+    token = cache.token()
+    cache.invalidate("a")
+    cache.set("a", "stale", token=token)
+    assert cache.get("a") is None
+    cache.set("a", "fresh", token=cache.token())
+    assert cache.get("a") == "fresh"
+
+
+def test_lookup_racing_a_role_change_does_not_cache_the_old_role(monkeypatch):
+    init_db()
+    add_or_update_user(424242, "racer")
+    set_user_role(424242, "admin")
+    user_cache.clear()
+
+    real_scope = db.session_scope
+    raced = []
+
+    @contextmanager
+    def scope_then_demote():
+        with real_scope() as session:
+            yield session
+        if not raced:
+            # The lookup has read "admin"; the demotion commits before it fills the cache.
+            raced.append(True)
+            monkeypatch.setattr(db, "session_scope", real_scope)
+            set_user_role(424242, "member")
+
+    monkeypatch.setattr(db, "session_scope", scope_then_demote)
+    assert db._lookup_user(424242)["role"] == "admin"
+    assert raced
+    assert get_user_by_id(424242)["role"] == "member"
@@ -0,0 +1,58 @@
+"""A role change made in one worker process must be seen by the others at once."""
+from __future__ import annotations
+
+import multiprocessing
+
+from tgbot_project.database.db import add_or_update_user, init_db, set_user_role
+
+USER_ID = 515151
+
+
+def _worker(isolate: bool, commands, results) -> None:
+    from tgbot_project.database.db import set_user_role, user_has_role
+    from tgbot_project.runtime.workers import isolate_worker_caches
+
+    if isolate:
+        isolate_worker_caches()
+    while True:
+        command = commands.get()
+        if command == "stop":
+            return
+        if command == "demote":
+            set_user_role(USER_ID, "member")
+            results.put("demoted")
+        else:
+            results.put(user_has_role(USER_ID, "admin"))
+
+
+def _role_seen_after_demotion(isolate: bool) -> bool:
+    init_db()
+    add_or_update_user(USER_ID, "demoted_admin")
+    set_user_role(USER_ID, "admin")
+    context = multiprocessing.get_context("spawn")
+    queues = [(context.Queue(), context.Queue()) for _ in range(2)]
+    workers = [context.Process(target=_worker, args=(isolate, *pair)) for pair in queues]
+    for process in workers:
+        process.start()
+    (reader_in, reader_out), (writer_in, writer_out) = queues
+    try:
+        reader_in.put("check")
+        assert reader_out.get(timeout=60) is True
+        writer_in.put("demote")
+        assert writer_out.get(timeout=60) == "demoted"
+        reader_in.put("check")
+        return reader_out.get(timeout=60)
+    finally:
+        for commands, _results in queues:
+            commands.put("stop")
+        for process in workers:
+            process.join(30)
+
+
+def test_demotion_in_one_worker_is_seen_by_another():
+    assert _role_seen_after_demotion(isolate=True) is False
+
+
+def test_shared_cache_would_keep_the_old_role():
+    # Guards the test above: without isolation the reader still sees the cached admin role.
+    assert _role_seen_after_demotion(isolate=False) is True
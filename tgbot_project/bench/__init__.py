@@ -0,0 +1 @@
+﻿"""Offline benchmarking helpers package."""
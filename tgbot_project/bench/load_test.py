@@ -0,0 +1,329 @@
+﻿"""Replay synthetic updates through the real handlers with a stubbed Bot.
+
+Updates go through ``bot.setup_dispatcher`` on a real :class:`Dispatcher`,
+so flood control runs ahead of the handlers as in the bot; only the Bot API
+is replaced, and uploads are served by a local fake file server. Each chat
+has its own seeded admin, who sends the admin-only commands. Each scenario
+reports throughput, latency percentiles, the number of database writes and
+the updates flood control dropped (``--no-flood-control`` measures the
+handlers alone)::
+
+    python -m tgbot_project.bench.load_test --scenario all --updates 2000
+    python -m tgbot_project.bench.load_test --scenario uploads --upload-kb 512 --json
+
+Unless ``TGBOT_DATABASE_URL`` and ``TGBOT_STORAGE_ROOT`` are already set, the
+run re-executes itself against a scratch SQLite file and store directory, so
+the configured database is never touched.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+from telegram import Bot, Update
+from telegram.ext import CallbackContext, Dispatcher, TypeHandler
+
+from ..bot import setup_dispatcher
+from ..database.db import DB_QUERY_SECONDS, add_or_update_user, claim_first_admin, init_db, set_user_role
+from ..database.write_behind import WRITE_BEHIND_ENABLED, write_queue
+from ..storage.download_pool import download_pool
+from .stats import format_summary, summarize
+from .synthetic import document_update, join_update, leave_update, message_update
+
+TOKEN = "123456:load-test"
+ADMIN_ID = 1
+SCENARIOS = ("joins", "commands", "uploads")
+COMMANDS = ("/start", "/help", "/fortune", "/manage_user list", "/stats 7")
+ADMIN_COMMANDS = {"/manage_user list", "/stats 7"}
+
+
+def admin_for(chat_id: int, chats: int) -> int:
+    """The seeded admin of a synthetic chat (``ADMIN_ID`` for the first one)."""
+    return ADMIN_ID + (-1_000_000 - chat_id) % chats
+
+
+class StubBot(Bot):
+    """Bot whose API calls are answered locally after ``latency`` seconds."""
+
+    def __init__(self, token: str, base_file_url: str, latency: float = 0.0) -> None:
+        super().__init__(token, base_file_url=base_file_url)
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self._calls_lock = threading.Lock()
+
+    def _post(self, endpoint: str, data: Optional[Dict[str, Any]] = None, timeout: Any = None, api_kwargs: Any = None) -> Any:
+        data = data or {}
+        with self._calls_lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if endpoint == "getMe":
+            return {"id": 42, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if endpoint == "getFile":
+            # The file id encodes the size so the fake file server knows what to send.
+            file_id = str(data["file_id"])
+            size = int(file_id.split("-")[1])
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": size, "file_path": f"documents/{file_id}"}
+        if endpoint in {"sendMessage", "editMessageText"}:
+            return {
+                "message_id": int(time.monotonic() * 1000) % 1_000_000_000,
+                "date": int(time.time()),
+                "chat": {"id": data.get("chat_id", 0), "type": "supergroup"},
+                "text": data.get("text", ""),
+            }
+        return True
+
+
+class _FileHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        file_id = self.path.rsplit("/", 1)[-1]
+        size = int(file_id.split("-")[1])
+        seed = file_id.encode("utf-8")
+        body = (seed * (size // len(seed) + 1))[:size]
+        self.send_response(200)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+class _Tracker:
+    """Record when each update was queued and when the dispatcher finished it."""
+
+    def __init__(self) -> None:
+        self.queued: Dict[int, float] = {}
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+
+    def mark_queued(self, update_id: int) -> None:
+        self.queued[update_id] = time.perf_counter()
+
+    def finish(self, update: Any, failed: bool = False, dropped: bool = False) -> None:
+        finished = time.perf_counter()
+        update_id = getattr(update, "update_id", None)
+        with self._lock:
+            started = self.queued.pop(update_id, None)
+            if started is not None:
+                self.latencies.append(finished - started)
+                self.errors += int(failed)
+                self.dropped += int(dropped)
+                self._done.notify_all()
+
+    def wait(self, count: int, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while len(self.latencies) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._done.wait(remaining)
+        return True
+
+
+def _db_writes() -> int:
+    total = 0
+    for name, labels, value in DB_QUERY_SECONDS.samples():
+        if name.endswith("_count") and labels.get("statement") in {"INSERT", "UPDATE", "DELETE"}:
+            total += int(value)
+    return total
+
+
+def _build_payloads(scenario: str, count: int, chats: int, offset: int, upload_bytes: int) -> List[Dict[str, Any]]:
+    payloads = []
+    for index in range(count):
+        update_id = offset + index
+        chat_id = -1_000_000 - index % chats
+        if scenario == "joins":
+            if index % 10 == 9:
+                payloads.append(leave_update(update_id, chat_id, 1_000_000 + offset + index - 9))
+            else:
+                members = range(1_000_000 + update_id, 1_000_000 + update_id + 1)
+                payloads.append(join_update(update_id, chat_id, members, inviter_id=ADMIN_ID))
+        elif scenario == "commands":
+            command = COMMANDS[index % len(COMMANDS)]
+            user_id = admin_for(chat_id, chats) if command in ADMIN_COMMANDS else 2_000_000 + index
+            payloads.append(message_update(update_id, chat_id, user_id, command))
+        else:
+            file_id = f"f{update_id}-{upload_bytes}"
+            payloads.append(
+                document_update(update_id, chat_id, 3_000_000 + index, file_id, file_id, f"{file_id}.bin", upload_bytes)
+            )
+    return payloads
+
+
+def run_scenario(
+    scenario: str,
+    bot: StubBot,
+    dispatcher: Dispatcher,
+    tracker: _Tracker,
+    count: int,
+    chats: int,
+    offset: int,
+    upload_bytes: int,
+    timeout: float,
+) -> Dict[str, Any]:
+    payloads = _build_payloads(scenario, count, chats, offset, upload_bytes)
+    updates = [Update.de_json(payload, bot) for payload in payloads]
+    tracker.latencies = []
+    tracker.errors = 0
+    tracker.dropped = 0
+    writes_before = _db_writes()
+    calls_before = sum(bot.calls.values())
+
+    started = time.perf_counter()
+    for update in updates:
+        tracker.mark_queued(update.update_id)
+        dispatcher.update_queue.put(update)
+    completed = tracker.wait(len(updates), timeout)
+    handled = time.perf_counter()
+    # Background work is part of the cost: pending uploads and write-behind batches.
+    while download_pool.active_downloads():
+        time.sleep(0.01)
+    write_queue.flush()
+    elapsed = time.perf_counter() - started
+
+    return {
+        "scenario": scenario,
+        "updates": len(updates),
+        "completed": completed,
+        "errors": tracker.errors,
+        "dropped": tracker.dropped,
+        "elapsed_s": elapsed,
+        "handler_elapsed_s": handled - started,
+        "updates_per_s": len(updates) / elapsed if elapsed else 0.0,
+        "latency": summarize(tracker.latencies),
+        "db_writes": _db_writes() - writes_before,
+        "api_calls": sum(bot.calls.values()) - calls_before,
+    }
+
+
+def run(
+    scenarios: List[str],
+    count: int,
+    chats: int,
+    workers: int,
+    upload_bytes: int,
+    api_latency: float,
+    timeout: float = 300.0,
+    flood_control: bool = True,
+) -> List[Dict[str, Any]]:
+    init_db()
+    add_or_update_user(ADMIN_ID, "bench_admin")
+    claim_first_admin(ADMIN_ID)
+    for admin_id in range(ADMIN_ID + 1, ADMIN_ID + chats):
+        add_or_update_user(admin_id, f"bench_admin{admin_id}")
+        set_user_role(admin_id, "admin")
+
+    file_server = ThreadingHTTPServer(("127.0.0.1", 0), _FileHandler)
+    file_server.daemon_threads = True
+    threading.Thread(target=file_server.serve_forever, name="bench-files", daemon=True).start()
+    bot = StubBot(TOKEN, f"http://127.0.0.1:{file_server.server_address[1]}/file/bot", latency=api_latency)
+
+    tracker = _Tracker()
+    dispatcher = Dispatcher(bot, queue.Queue(), workers=workers, use_context=True)
+    middleware = setup_dispatcher(dispatcher, flood_control=flood_control)
+    if middleware is not None:
+        middleware.on_reject = lambda update: tracker.finish(update, dropped=True)
+    dispatcher.add_handler(TypeHandler(Update, lambda update, context: tracker.finish(update)), group=1000)
+
+    def on_error(update: object, context: CallbackContext) -> None:
+        tracker.finish(update, failed=True)
+
+    dispatcher.add_error_handler(on_error)
+    if WRITE_BEHIND_ENABLED:
+        write_queue.start()
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name="bench-dispatcher", daemon=True)
+    dispatcher_thread.start()
+
+    reports = []
+    try:
+        for index, scenario in enumerate(scenarios):
+            reports.append(
+                run_scenario(
+                    scenario,
+                    bot,
+                    dispatcher,
+                    tracker,
+                    count,
+                    chats,
+                    offset=(index + 1) * 10_000_000,
+                    upload_bytes=upload_bytes,
+                    timeout=timeout,
+                )
+            )
+    finally:
+        dispatcher.stop()
+        download_pool.stop()
+        write_queue.stop()
+        file_server.shutdown()
+    return reports
+
+
+def _reexec_with_scratch_state(argv: List[str]) -> int:
+    scratch = tempfile.mkdtemp(prefix="tgbot-bench-")
+    env = dict(os.environ)
+    env["TGBOT_DATABASE_URL"] = f"sqlite:///{os.path.join(scratch, 'bench.db')}"
+    env["TGBOT_STORAGE_ROOT"] = os.path.join(scratch, "store")
+    print(f"scratch state: {scratch}", file=sys.stderr)
+    return subprocess.call([sys.executable, "-m", __spec__.name, *argv], env=env)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not (os.getenv("TGBOT_DATABASE_URL") and os.getenv("TGBOT_STORAGE_ROOT")):
+        sys.exit(_reexec_with_scratch_state(argv))
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=[*SCENARIOS, "all"], default="all")
+    parser.add_argument("--updates", type=int, default=1000, help="Updates per scenario")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=4, help="Dispatcher worker threads")
+    parser.add_argument("--upload-kb", type=int, default=64, help="Size of each synthetic upload")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="Simulated Bot API round trip")
+    parser.add_argument("--no-flood-control", action="store_true", help="Skip the flood control middleware")
+    parser.add_argument("--json", action="store_true", help="Print the reports as JSON for run-over-run comparison")
+    parser.add_argument("--verbose", action="store_true", help="Keep handler logging (it skews the numbers)")
+    args = parser.parse_args(argv)
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    scenarios = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    reports = run(
+        scenarios,
+        count=args.updates,
+        chats=args.chats,
+        workers=args.workers,
+        upload_bytes=args.upload_kb * 1024,
+        api_latency=args.api_latency_ms / 1000,
+        flood_control=not args.no_flood_control,
+    )
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return
+    for report in reports:
+        print(
+            f"[{report['scenario']}] updates={report['updates']} errors={report['errors']} dropped={report['dropped']} "
+            f"elapsed={report['elapsed_s']:.2f}s throughput={report['updates_per_s']:.1f} updates/s "
+            f"db_writes={report['db_writes']} api_calls={report['api_calls']}"
+            + ("" if report["completed"] else " (timed out)")
+        )
+        print(format_summary("  latency", report["latency"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+﻿"""Latency summary helpers shared by the benchmark tools."""
+from __future__ import annotations
+
+import math
+from typing import Dict, Sequence
+
+
+def percentile(samples: Sequence[float], fraction: float) -> float:
+    """Nearest-rank percentile of ``samples`` (``fraction`` in 0..1)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(samples: Sequence[float]) -> Dict[str, float]:
+    """Return count/mean/p50/p95/p99/max for latencies given in seconds, in milliseconds."""
+    if not samples:
+        return {"count": 0, "mean_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+    return {
+        "count": len(samples),
+        "mean_ms": sum(samples) / len(samples) * 1000,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p95_ms": percentile(samples, 0.95) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples) * 1000,
+    }
+
+
+def format_summary(title: str, summary: Dict[str, float]) -> str:
+    return (
+        f"{title}: n={int(summary['count'])} mean={summary['mean_ms']:.2f}ms "
+        f"p50={summary['p50_ms']:.2f}ms p95={summary['p95_ms']:.2f}ms "
+        f"p99={summary['p99_ms']:.2f}ms max={summary['max_ms']:.2f}ms"
+    )
+
+
+__all__ = ["format_summary", "percentile", "summarize"]
@@ -0,0 +1,78 @@
+﻿"""Builders for synthetic Telegram update payloads used by the benchmarks."""
+from __future__ import annotations
+
+import time
+from typing import Any, Dict, Iterable, Optional
+
+
+def user_payload(user_id: int, username: Optional[str] = None, is_bot: bool = False) -> Dict[str, Any]:
+    return {
+        "id": user_id,
+        "is_bot": is_bot,
+        "first_name": f"user{user_id}",
+        "username": username or f"user{user_id}",
+    }
+
+
+def chat_payload(chat_id: int, title: Optional[str] = None) -> Dict[str, Any]:
+    return {"id": chat_id, "type": "supergroup", "title": title or f"chat{chat_id}"}
+
+
+def message_update(
+    update_id: int,
+    chat_id: int,
+    user_id: int,
+    text: Optional[str] = None,
+    **fields: Any,
+) -> Dict[str, Any]:
+    """Build a ``message`` update; texts starting with ``/`` get a command entity."""
+    message: Dict[str, Any] = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": chat_payload(chat_id),
+        "from": user_payload(user_id),
+    }
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    message.update(fields)
+    return {"update_id": update_id, "message": message}
+
+
+def join_update(update_id: int, chat_id: int, member_ids: Iterable[int], inviter_id: int = 1) -> Dict[str, Any]:
+    members = [user_payload(member_id) for member_id in member_ids]
+    return message_update(update_id, chat_id, inviter_id, new_chat_members=members)
+
+
+def leave_update(update_id: int, chat_id: int, member_id: int) -> Dict[str, Any]:
+    return message_update(update_id, chat_id, member_id, left_chat_member=user_payload(member_id))
+
+
+def document_update(
+    update_id: int,
+    chat_id: int,
+    user_id: int,
+    file_id: str,
+    file_unique_id: str,
+    file_name: str,
+    file_size: int,
+) -> Dict[str, Any]:
+    document = {
+        "file_id": file_id,
+        "file_unique_id": file_unique_id,
+        "file_name": file_name,
+        "file_size": file_size,
+        "mime_type": "application/octet-stream",
+    }
+    return message_update(update_id, chat_id, user_id, document=document)
+
+
+__all__ = [
+    "chat_payload",
+    "document_update",
+    "join_update",
+    "leave_update",
+    "message_update",
+    "user_payload",
+]
@@ -0,0 +1,171 @@
+﻿"""Post synthetic updates to a webhook endpoint and report latency.
+
+Without ``--url`` a local :class:`WebhookServer` is started with a stand-in
+handler, so ingestion and end-to-end latency can be measured offline::
+
+    python -m tgbot_project.bench.webhook_harness --count 5000 --concurrency 32
+    python -m tgbot_project.bench.webhook_harness --url http://127.0.0.1:8443/telegram/webhook --secret s3cret
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from ..runtime.webhook import SECRET_HEADER, WebhookServer
+from .stats import format_summary, summarize
+from .synthetic import message_update
+
+
+class _Recorder:
+    """Track when each update was posted and when the handler saw it."""
+
+    def __init__(self, handler_delay: float) -> None:
+        self.handler_delay = handler_delay
+        self.sent_at: Dict[int, float] = {}
+        self.end_to_end: List[float] = []
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+
+    def mark_sent(self, update_id: int) -> None:
+        with self._lock:
+            self.sent_at.setdefault(update_id, time.perf_counter())
+
+    def on_update(self, payload: Dict[str, Any]) -> None:
+        if self.handler_delay:
+            time.sleep(self.handler_delay)
+        finished = time.perf_counter()
+        with self._lock:
+            started = self.sent_at.get(payload["update_id"])
+            if started is not None:
+                self.end_to_end.append(finished - started)
+            self._done.notify_all()
+
+    def wait_for(self, count: int, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while len(self.end_to_end) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._done.wait(remaining)
+        return True
+
+
+def _post(url: str, payload: Dict[str, Any], secret: Optional[str], max_retries: int) -> Dict[str, Any]:
+    body = json.dumps(payload).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers[SECRET_HEADER] = secret
+    started = time.perf_counter()
+    retries = 0
+    while True:
+        request = urllib.request.Request(url, data=body, headers=headers, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                status = response.status
+        except urllib.error.HTTPError as exc:
+            status = exc.code
+            if status == 503 and retries < max_retries:
+                # Telegram redelivers rejected updates; retry quickly to keep the run short.
+                retries += 1
+                time.sleep(0.05)
+                continue
+        return {"status": status, "elapsed": time.perf_counter() - started, "retries": retries}
+
+
+def run(
+    count: int,
+    concurrency: int,
+    chats: int,
+    url: Optional[str] = None,
+    secret: Optional[str] = None,
+    handler_delay: float = 0.0,
+    workers: int = 4,
+    queue_size: int = 1000,
+    max_retries: int = 20,
+) -> Dict[str, Any]:
+    recorder = _Recorder(handler_delay)
+    server: Optional[WebhookServer] = None
+    if url is None:
+        server = WebhookServer(
+            recorder.on_update,
+            port=0,
+            secret_token=secret,
+            queue_size=queue_size,
+            workers=workers,
+        )
+        server.start()
+        url = server.address
+
+    payloads = [
+        message_update(update_id, -1000 - update_id % chats, 10_000 + update_id, "/fortune")
+        for update_id in range(1, count + 1)
+    ]
+
+    def send(payload: Dict[str, Any]) -> Dict[str, Any]:
+        recorder.mark_sent(payload["update_id"])
+        return _post(url, payload, secret, max_retries)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, payloads))
+    accepted = sum(1 for item in results if item["status"] == 200)
+    if server is not None:
+        recorder.wait_for(accepted, timeout=60)
+        server.stop()
+    elapsed = time.perf_counter() - started
+
+    return {
+        "url": url,
+        "sent": count,
+        "accepted": accepted,
+        "retries": sum(item["retries"] for item in results),
+        "failed": count - accepted,
+        "elapsed_s": elapsed,
+        "updates_per_s": accepted / elapsed if elapsed else 0.0,
+        "http": summarize([item["elapsed"] for item in results]),
+        "end_to_end": summarize(recorder.end_to_end) if server is not None else None,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="Webhook URL to post to; omit to start a local stand-in server")
+    parser.add_argument("--secret", help="Secret token sent in the X-Telegram-Bot-Api-Secret-Token header")
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=4, help="Local server worker threads")
+    parser.add_argument("--queue-size", type=int, default=1000, help="Local server queue capacity")
+    parser.add_argument("--handler-delay-ms", type=float, default=0.0, help="Simulated handler work per update")
+    args = parser.parse_args(argv)
+
+    report = run(
+        count=args.count,
+        concurrency=args.concurrency,
+        chats=args.chats,
+        url=args.url,
+        secret=args.secret,
+        handler_delay=args.handler_delay_ms / 1000,
+        workers=args.workers,
+        queue_size=args.queue_size,
+    )
+    print(f"target: {report['url']}")
+    print(
+        f"sent={report['sent']} accepted={report['accepted']} failed={report['failed']} "
+        f"retries={report['retries']} elapsed={report['elapsed_s']:.2f}s "
+        f"throughput={report['updates_per_s']:.1f} updates/s"
+    )
+    print(format_summary("http round-trip", report["http"]))
+    if report["end_to_end"] is not None:
+        print(format_summary("end-to-end", report["end_to_end"]))
+
+
+if __name__ == "__main__":
+    main()
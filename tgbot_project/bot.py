@@ -1,25 +1,57 @@
 ﻿"""Entry point for the Telegram bot."""
 from __future__ import annotations
 
+import signal
 import sys
-from typing import Optional
+import threading
+from typing import Callable, Optional
 
-from telegram import Update
+# Imported ahead of everything else so the import timings below are recorded.
+from .runtime.startup import startup  # isort: skip
+
+from telegram import Chat, Message, Update, User
 from telegram.ext import (
     CallbackContext,
+    CallbackQueryHandler,
     CommandHandler,
+    Dispatcher,
     Filters,
     MessageHandler,
     Updater,
 )
 
-from .commands import file_management, fortune, twitter_sync, user_management
-from .config import config_secret
-from .database.db import add_or_update_user, init_db, mark_user_inactive, record_membership_event
+from .commands import file_management, fortune, stats, twitter_sync, user_management
+from .commands.stats import backfill_rollups_on_start
+from .commands.twitter_mirror import schedule_twitter_mirror
+from .config import config_bot, config_secret
+from .config.watcher import schedule_config_reload
+from .database.db import add_or_update_user, init_db
+from .database.retention import schedule_event_retention
+from .database.write_behind import WRITE_BEHIND_ENABLED, write_queue
 from .logger.logger import get_logger
+from .messaging.send_queue import send_queue, set_global_share
+from .monitoring.exporter import start_metrics_server
+from .runtime.async_runtime import RUNTIME_MODE, runtime
+from .runtime.dispatch import traced
+from .runtime.flood_control import FloodControl, build_flood_control
+from .runtime.webhook import INGESTION_MODE, build_webhook_server, webhook_secret
+from .runtime.workers import WorkerPool, build_worker_pool
+from .storage.download_pool import download_pool
 
 logger = get_logger("bot")
 
+START_TEXT = "你好！欢迎使用 Chiffon Telegram Bot。发送 /help 查看支持的命令。"
+HELP_TEXT = (
+    "可用命令:\n"
+    "/start - 初始化机器人\n"
+    "/help - 查看帮助\n"
+    "/fortune - 今日运势\n"
+    "/upload - 上传文件或图片\n"
+    "/manage_user - 用户和权限管理\n"
+    "/stats - 成员加入/离开与留存统计\n"
+    "/sync_twitter - 同步 Twitter 推文"
+)
+
 
 def start(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
@@ -32,7 +64,23 @@ def start(update: Update, context: CallbackContext) -> None:
             last_name=user.last_name,
         )
     if message:
-        message.reply_text("你好！欢迎使用 Chiffon Telegram Bot。发送 /help 查看支持的命令。")
+        send_queue.reply(message, START_TEXT)
+    logger.info("User %s triggered /start", user.id if user else "unknown")
+
+
+async def start_async(update: Update, context: CallbackContext) -> None:
+    user = update.effective_user
+    message = update.effective_message
+    if user:
+        await runtime.run_db(
+            add_or_update_user,
+            user.id,
+            user.username,
+            first_name=user.first_name,
+            last_name=user.last_name,
+        )
+    if message:
+        send_queue.reply(message, START_TEXT)
     logger.info("User %s triggered /start", user.id if user else "unknown")
 
 
@@ -40,15 +88,14 @@ def help_command(update: Update, context: CallbackContext) -> None:
     message = update.effective_message
     if not message:
         return
-    message.reply_text(
-        "可用命令:\n"
-        "/start - 初始化机器人\n"
-        "/help - 查看帮助\n"
-        "/fortune - 今日运势\n"
-        "/upload - 上传文件或图片\n"
-        "/manage_user - 用户和权限管理\n"
-        "/sync_twitter - 同步 Twitter 推文"
-    )
+    send_queue.reply(message, HELP_TEXT)
+
+
+async def help_command_async(update: Update, context: CallbackContext) -> None:
+    message = update.effective_message
+    if not message:
+        return
+    send_queue.reply(message, HELP_TEXT)
 
 
 def handle_new_members(update: Update, context: CallbackContext) -> None:
@@ -56,17 +103,28 @@ def handle_new_members(update: Update, context: CallbackContext) -> None:
     chat = update.effective_chat
     if message is None or chat is None or not message.new_chat_members:
         return
+    _record_new_members(message, chat)
+
 
+async def handle_new_members_async(update: Update, context: CallbackContext) -> None:
+    message = update.effective_message
+    chat = update.effective_chat
+    if message is None or chat is None or not message.new_chat_members:
+        return
+    await runtime.run_db(_record_new_members, message, chat)
+
+
+def _record_new_members(message: Message, chat: Chat) -> None:
     for member in message.new_chat_members:
         if member.is_bot:
             continue
-        add_or_update_user(
+        write_queue.upsert_user(
             member.id,
             member.username,
             first_name=member.first_name,
             last_name=member.last_name,
         )
-        record_membership_event(
+        write_queue.record_event(
             telegram_id=member.id,
             chat_id=chat.id,
             chat_title=chat.title,
@@ -85,9 +143,24 @@ def handle_member_left(update: Update, context: CallbackContext) -> None:
     member = message.left_chat_member
     if member.is_bot:
         return
+    _record_member_left(member, chat)
+
+
+async def handle_member_left_async(update: Update, context: CallbackContext) -> None:
+    message = update.effective_message
+    chat = update.effective_chat
+    if message is None or chat is None or not message.left_chat_member:
+        return
+
+    member = message.left_chat_member
+    if member.is_bot:
+        return
+    await runtime.run_db(_record_member_left, member, chat)
 
-    mark_user_inactive(member.id)
-    record_membership_event(
+
+def _record_member_left(member: User, chat: Chat) -> None:
+    write_queue.mark_inactive(member.id)
+    write_queue.record_event(
         telegram_id=member.id,
         chat_id=chat.id,
         chat_title=chat.title,
@@ -101,33 +174,165 @@ def error_handler(update: Optional[Update], context: CallbackContext) -> None:
     logger.exception("Update %s caused error", update, exc_info=context.error)
 
 
+def register_handlers(dispatcher: Dispatcher, use_async: bool = False) -> None:
+    """Register every command handler, using the coroutine variants in async mode."""
+
+    def pick(sync_handler: Callable, async_handler: Callable) -> Callable:
+        return runtime.adapt(traced(async_handler)) if use_async else traced(sync_handler)
+
+    dispatcher.add_handler(CommandHandler("start", pick(start, start_async)))
+    dispatcher.add_handler(CommandHandler("help", pick(help_command, help_command_async)))
+    dispatcher.add_handler(CommandHandler("fortune", pick(fortune.fortune, fortune.fortune_async)))
+    dispatcher.add_handler(CommandHandler("upload", pick(file_management.upload, file_management.upload_async)))
+    dispatcher.add_handler(
+        CommandHandler("manage_user", pick(user_management.manage_user, user_management.manage_user_async))
+    )
+    dispatcher.add_handler(
+        CallbackQueryHandler(
+            pick(user_management.user_list_page, user_management.user_list_page_async),
+            pattern=user_management.USER_LIST_PATTERN,
+        )
+    )
+    dispatcher.add_handler(CommandHandler("stats", pick(stats.stats, stats.stats_async)))
+    dispatcher.add_handler(
+        CommandHandler("sync_twitter", pick(twitter_sync.sync_twitter, twitter_sync.sync_twitter_async), pass_args=True)
+    )
+
+    dispatcher.add_handler(
+        MessageHandler(
+            Filters.document | Filters.photo,
+            pick(file_management.upload, file_management.upload_async),
+        )
+    )
+    dispatcher.add_handler(
+        MessageHandler(Filters.status_update.new_chat_members, pick(handle_new_members, handle_new_members_async))
+    )
+    dispatcher.add_handler(
+        MessageHandler(Filters.status_update.left_chat_member, pick(handle_member_left, handle_member_left_async))
+    )
+
+    dispatcher.add_error_handler(error_handler)
+
+
+def setup_dispatcher(
+    dispatcher: Dispatcher,
+    use_async: bool = False,
+    worker_pool: Optional[WorkerPool] = None,
+    flood_control: bool = True,
+) -> Optional[FloodControl]:
+    """Attach flood control and then the handlers, or the routing to ``worker_pool``.
+
+    Returns the flood control middleware, if it is enabled.
+    """
+    middleware = build_flood_control() if flood_control else None
+    if middleware is not None:
+        # Ahead of the handlers (and of routing to workers), so rejected updates cost nothing more.
+        middleware.attach(dispatcher)
+    if worker_pool is not None:
+        worker_pool.attach(dispatcher)
+    else:
+        register_handlers(dispatcher, use_async=use_async)
+    return middleware
+
+
+def _wait_for_shutdown() -> None:
+    # Updater.idle() exits the process immediately when polling is not running,
+    # which would drop queued webhook updates, so wait for the signal here.
+    stop_requested = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda received, frame: stop_requested.set())
+    while not stop_requested.wait(1):
+        pass
+    logger.info("Shutdown requested, draining queued updates")
+
+
+def _run_webhook(updater: Updater) -> None:
+    """Serve updates from the local webhook server until interrupted."""
+    bot = updater.bot
+    dispatcher = updater.dispatcher
+    server = build_webhook_server(lambda payload: dispatcher.process_update(Update.de_json(payload, bot)))
+    server.start()
+    updater.job_queue.start()
+
+    public_url = getattr(getattr(config_bot, "webhook", None), "public_url", "")
+    if public_url:
+        api_kwargs = {}
+        secret_token = getattr(config_secret, "WEBHOOK_SECRET_TOKEN", None)
+        if secret_token:
+            api_kwargs["secret_token"] = secret_token
+        bot.set_webhook(url=public_url, api_kwargs=api_kwargs or None)
+        logger.info("Registered webhook %s", public_url)
+
+    try:
+        _wait_for_shutdown()
+    finally:
+        updater.job_queue.stop()
+        server.stop()
+
+
 def main() -> None:
     token = getattr(config_secret, "TELEGRAM_API_TOKEN", None)
     if not token:
         logger.error("Telegram token missing. Set TELEGRAM_API_TOKEN in config_secret.yaml or environment.")
         sys.exit(1)
+    if INGESTION_MODE == "webhook":
+        # Checked before anything starts; _run_webhook builds the server much later.
+        try:
+            webhook_secret()
+        except ValueError as exc:
+            logger.error("%s", exc)
+            sys.exit(1)
+    startup.mark("imports")
 
     init_db()
+    startup.mark("database")
+    # Before anything can write membership events, see backfill_rollups_on_start.
+    if backfill_rollups_on_start():
+        startup.mark("rollup backfill")
+    metrics_server = start_metrics_server()
+    if WRITE_BEHIND_ENABLED:
+        write_queue.start()
+    worker_pool = build_worker_pool()
+    if worker_pool is not None:
+        set_global_share(len(worker_pool.workers) + 1)
+    send_queue.start()
 
     updater = Updater(token, use_context=True)
     dispatcher = updater.dispatcher
 
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("help", help_command))
-    dispatcher.add_handler(CommandHandler("fortune", fortune.fortune))
-    dispatcher.add_handler(CommandHandler("upload", file_management.upload))
-    dispatcher.add_handler(CommandHandler("manage_user", user_management.manage_user))
-    dispatcher.add_handler(CommandHandler("sync_twitter", twitter_sync.sync_twitter, pass_args=True))
-
-    dispatcher.add_handler(MessageHandler(Filters.document | Filters.photo, file_management.upload))
-    dispatcher.add_handler(MessageHandler(Filters.status_update.new_chat_members, handle_new_members))
-    dispatcher.add_handler(MessageHandler(Filters.status_update.left_chat_member, handle_member_left))
-
-    dispatcher.add_error_handler(error_handler)
+    use_async = RUNTIME_MODE == "async" and worker_pool is None
+    if use_async:
+        runtime.start()
+    if worker_pool is not None:
+        # This process only receives updates and runs the scheduled jobs.
+        worker_pool.start()
+    setup_dispatcher(dispatcher, use_async=use_async, worker_pool=worker_pool)
+    startup.mark("dispatcher")
+    schedule_twitter_mirror(updater.job_queue)
+    schedule_event_retention(updater.job_queue)
+    schedule_config_reload(updater.job_queue)
+    startup.mark("jobs")
+    for line in startup.finish():
+        logger.info(line)
 
-    logger.info("Bot starting. Listening for updates...")
-    updater.start_polling()
-    updater.idle()
+    if worker_pool is not None:
+        logger.info("Bot starting with %d worker processes. Listening for updates...", len(worker_pool.workers))
+    else:
+        logger.info("Bot starting in %s mode. Listening for updates...", "async" if use_async else "sync")
+    if INGESTION_MODE == "webhook":
+        _run_webhook(updater)
+    else:
+        updater.start_polling()
+        updater.idle()
+    if worker_pool is not None:
+        worker_pool.stop()
+    download_pool.stop()
+    if use_async:
+        runtime.stop()
+    send_queue.stop()
+    write_queue.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
 
 
 if __name__ == "__main__":
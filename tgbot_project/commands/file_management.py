@@ -1,17 +1,114 @@
 ﻿"""File management commands."""
 from __future__ import annotations
 
-from pathlib import Path
+from functools import partial
+from typing import Any, Dict, Optional, Tuple
 
-from telegram import Update
+from telegram import Message, Update
+from telegram.error import TelegramError
 from telegram.ext import CallbackContext
 
 from ..logger.logger import get_logger
+from ..messaging.send_queue import send_queue
+from ..runtime.async_runtime import runtime
+from ..storage.download_pool import DownloadJob, UploadRejected, download_pool, format_size
+from ..storage.file_store import get_file_store
 
 logger = get_logger("commands.file_management")
 
-FILES_DIR = Path(__file__).resolve().parent.parent / "files"
-FILES_DIR.mkdir(parents=True, exist_ok=True)
+
+def _attachment_of(message: Message) -> Tuple[Optional[Any], Optional[str], str]:
+    """Return ``(attachment, file_name, label)`` for the document or photo in ``message``.
+
+    Document labels end with a space so replies read "文件 a.pdf 上传成功！".
+    """
+    if message.document:
+        return message.document, message.document.file_name, f"文件 {message.document.file_name} "
+    if message.photo:
+        # Save highest resolution photo when sent as picture
+        photo = message.photo[-1]
+        return photo, f"photo_{photo.file_unique_id}.jpg", "图片"
+    return None, None, ""
+
+
+class _UploadProgress:
+    """Post one status message for a long download and keep editing it."""
+
+    def __init__(self, message: Message, label: str) -> None:
+        self.message = message
+        self.label = label
+        self.status: Optional[Message] = None
+        self.requested = False
+
+    def __call__(self, received: int, total: Optional[int]) -> None:
+        if total:
+            text = f"正在接收{self.label.strip()}：{received * 100 // total}%（{format_size(received)} / {format_size(total)}）"
+        else:
+            text = f"正在接收{self.label.strip()}：已接收 {format_size(received)}"
+        if self.status is None:
+            if not self.requested:
+                self.requested = True
+                send_queue.reply(self.message, text, on_sent=self._remember)
+            return
+        try:
+            self.status.edit_text(text)
+        except TelegramError as exc:
+            logger.debug("Could not update upload progress: %s", exc)
+
+    def _remember(self, status: Message) -> None:
+        self.status = status
+
+
+def _on_upload_complete(
+    message: Message,
+    label: str,
+    record: Optional[Dict[str, Any]],
+    error: Optional[BaseException],
+) -> None:
+    if isinstance(error, UploadRejected):
+        send_queue.reply(message, str(error))
+        return
+    if error is not None or record is None:
+        send_queue.reply(message, f"{label}上传失败，请稍后再试。")
+        return
+    logger.info("Stored %s as %s", record["file_name"], record["storage_path"])
+    send_queue.reply(message, f"{label}上传成功！")
+
+
+def _start_upload(update: Update, message: Message) -> Optional[str]:
+    """Queue the attached document or photo for download.
+
+    Returns the text to reply with right away, or ``None`` when the download
+    pool will reply once the file has been stored.
+    """
+    user = update.effective_user
+    uploader = user.id if user else None
+
+    attachment, file_name, label = _attachment_of(message)
+    if attachment is None:
+        logger.warning("User %s triggered upload without file", uploader or "unknown")
+        return "请上传一个文件或图片！"
+
+    existing = get_file_store().lookup(attachment.file_unique_id)
+    if existing is not None:
+        logger.info("Skipped download of %s, already stored as %s", attachment.file_unique_id, existing["sha256"])
+        return f"{label}已存在，无需重复上传。"
+
+    try:
+        download_pool.submit(
+            DownloadJob(
+                attachment=attachment,
+                file_name=file_name,
+                user_id=uploader,
+                chat_id=message.chat_id,
+                on_complete=partial(_on_upload_complete, message, label),
+                on_progress=_UploadProgress(message, label),
+            )
+        )
+    except UploadRejected as exc:
+        logger.info("Rejected upload from %s: %s", uploader, exc)
+        return str(exc)
+    return None
 
 
 def upload(update: Update, context: CallbackContext) -> None:
@@ -19,24 +116,16 @@ def upload(update: Update, context: CallbackContext) -> None:
     if message is None:
         logger.warning("Received upload command without message context")
         return
+    reply = _start_upload(update, message)
+    if reply:
+        send_queue.reply(message, reply)
 
-    if message.document:
-        telegram_file = message.document.get_file()
-        target_path = FILES_DIR / message.document.file_name
-        telegram_file.download(custom_path=str(target_path))
-        message.reply_text(f"文件 {message.document.file_name} 上传成功！")
-        logger.info("Stored file %s", target_path)
-        return
 
-    if message.photo:
-        # Save highest resolution photo when sent as picture
-        telegram_file = message.photo[-1].get_file()
-        target_path = FILES_DIR / f"photo_{telegram_file.file_unique_id}.jpg"
-        telegram_file.download(custom_path=str(target_path))
-        message.reply_text("图片上传成功！")
-        logger.info("Stored photo %s", target_path)
+async def upload_async(update: Update, context: CallbackContext) -> None:
+    message = update.effective_message
+    if message is None:
+        logger.warning("Received upload command without message context")
         return
-
-    message.reply_text("请上传一个文件或图片！")
-    logger.warning("User %s triggered upload without file", update.effective_user.id if update.effective_user else "unknown")
-
+    reply = await runtime.run_db(_start_upload, update, message)
+    if reply:
+        send_queue.reply(message, reply)
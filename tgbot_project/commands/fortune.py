@@ -1,13 +1,30 @@
 ﻿"""Daily fortune command."""
 from __future__ import annotations
 
-import random
+import bisect
+import mmap
+import os
+import tempfile
+import threading
+from array import array
+from dataclasses import dataclass, field
 from datetime import date
 from hashlib import sha256
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
 
 from telegram import Update
 from telegram.ext import CallbackContext
 
+from ..config import ConfigNamespace, config_bot
+from ..database.cache import TTLCache
+from ..logger.logger import get_logger
+from ..messaging.send_queue import send_queue
+
+logger = get_logger("commands.fortune")
+
+_PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
 FORTUNES = [
     "今天是个幸运的一天，保持微笑！",
     "小心谨慎，慢慢来会有惊喜。",
@@ -17,10 +34,212 @@ FORTUNES = [
 ]
 
 
-def _seed_from_user(user_id: int) -> int:
-    payload = f"{user_id}:{date.today().isoformat()}".encode("utf-8")
-    digest = sha256(payload).hexdigest()
-    return int(digest[:8], 16)
+class ListCorpus:
+    """In-memory corpus, used for the built-in fortunes."""
+
+    def __init__(self, lines: Sequence[str]) -> None:
+        self._lines = list(lines)
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    def line(self, index: int) -> str:
+        return self._lines[index]
+
+
+class FileCorpus:
+    """One fortune per line of a UTF-8 file, read through ``mmap``.
+
+    A ``<file>.idx`` sidecar holds the start and end offset of every
+    non-empty, non-``#`` line as unsigned 64-bit integers. It is rebuilt when
+    it is older than the corpus, and mapped as well, so opening a large corpus
+    costs no parsing and picking a line is two array reads and one decode.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self._data: Optional[mmap.mmap] = None
+        self._offsets: Any = array("Q")
+        if self.path.stat().st_size == 0:
+            return
+        with self.path.open("rb") as corpus_file:
+            self._data = mmap.mmap(corpus_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offsets = self._load_index()
+
+    def __len__(self) -> int:
+        return len(self._offsets) // 2
+
+    def line(self, index: int) -> str:
+        start = self._offsets[2 * index]
+        end = self._offsets[2 * index + 1]
+        return self._data[start:end].decode("utf-8", errors="replace")  # type: ignore[index]
+
+    def _index_path(self) -> Path:
+        return self.path.with_name(self.path.name + ".idx")
+
+    def _load_index(self) -> Any:
+        index_path = self._index_path()
+        try:
+            if index_path.stat().st_mtime_ns >= self.path.stat().st_mtime_ns:
+                return self._map_index(index_path)
+        except FileNotFoundError:
+            pass
+        except (OSError, TypeError, ValueError) as exc:
+            # A truncated or foreign sidecar is rebuilt like a stale one.
+            logger.warning("Rebuilding fortune index %s: %s", index_path, exc)
+        offsets = self._build_index()
+        try:
+            handle, tmp_name = tempfile.mkstemp(dir=index_path.parent, prefix=index_path.name + ".")
+            with os.fdopen(handle, "wb") as index_file:
+                offsets.tofile(index_file)
+            os.replace(tmp_name, index_path)
+        except OSError as exc:
+            # A read-only corpus directory only costs a rebuild on every start.
+            logger.warning("Could not write fortune index %s: %s", index_path, exc)
+        return offsets
+
+    def _map_index(self, index_path: Path) -> Any:
+        if index_path.stat().st_size == 0:
+            return array("Q")
+        with index_path.open("rb") as index_file:
+            mapped = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        # cast() raises TypeError unless the size is a multiple of 8.
+        offsets = memoryview(mapped).cast("Q")
+        if len(offsets) % 2:
+            raise ValueError("odd number of offsets")
+        return offsets
+
+    def _build_index(self) -> array:
+        data = self._data
+        assert data is not None
+        offsets = array("Q")
+        size = len(data)
+        start = 3 if data[:3] == b"\xef\xbb\xbf" else 0
+        while start < size:
+            newline = data.find(b"\n", start)
+            end = size if newline == -1 else newline
+            # rstrip also drops the \r of CRLF files.
+            line = data[start:end].rstrip()
+            if line.strip() and not line.lstrip().startswith(b"#"):
+                offsets.append(start)
+                offsets.append(start + len(line))
+            start = end + 1
+        logger.info("Indexed %d fortunes in %s", len(offsets) // 2, self.path)
+        return offsets
+
+
+@dataclass
+class _Language:
+    corpora: List[Any] = field(default_factory=list)
+    # Running total of the category weights, for bisect.
+    cumulative: List[float] = field(default_factory=list)
+
+    def add(self, corpus: Any, weight: float) -> None:
+        self.corpora.append(corpus)
+        self.cumulative.append((self.cumulative[-1] if self.cumulative else 0.0) + weight)
+
+
+class FortuneEngine:
+    """Map ``(user, day)`` straight to a line of a weighted, per-language corpus.
+
+    The SHA-256 of the user id and date picks the category (weighted) and
+    the line within it, so the result is stable for the day without touching
+    any shared random state, and the per-day result is cached.
+    """
+
+    def __init__(self, default_language: str = "zh", cache_size: int = 10000) -> None:
+        self.default_language = default_language
+        self.languages: Dict[str, _Language] = {}
+        self._cache = TTLCache(max_entries=cache_size, ttl=24 * 3600)
+
+    def add_corpus(self, corpus: Any, language: str, weight: float = 1.0) -> None:
+        if len(corpus) == 0 or weight <= 0:
+            return
+        self.languages.setdefault(language.lower(), _Language()).add(corpus, float(weight))
+
+    def _language_for(self, language_code: Optional[str]) -> Optional[str]:
+        if language_code:
+            code = language_code.lower()
+            for candidate in (code, code.split("-", 1)[0]):
+                if candidate in self.languages:
+                    return candidate
+        if self.default_language in self.languages:
+            return self.default_language
+        return next(iter(self.languages), None)
+
+    def pick(self, user_id: int, language_code: Optional[str] = None, day: Optional[date] = None) -> str:
+        day = day or date.today()
+        language = self._language_for(language_code)
+        if language is None:
+            return FORTUNES[0]
+        key = (user_id, day.toordinal(), language)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+
+        digest = sha256(f"{user_id}:{day.isoformat()}".encode("utf-8")).digest()
+        entry = self.languages[language]
+        point = int.from_bytes(digest[:8], "big") / 2**64 * entry.cumulative[-1]
+        corpus = entry.corpora[min(bisect.bisect_right(entry.cumulative, point), len(entry.corpora) - 1)]
+        text = corpus.line(int.from_bytes(digest[8:16], "big") % len(corpus))
+        self._cache.set(key, text)
+        return text
+
+
+def _build_fortune_engine(bot_conf: ConfigNamespace) -> FortuneEngine:
+    conf = getattr(bot_conf, "fortune", None)
+    engine = FortuneEngine(
+        default_language=str(getattr(conf, "default_language", "zh")).lower(),
+        cache_size=int(getattr(conf, "cache_size", 10000)),
+    )
+    for entry in getattr(conf, "corpora", None) or []:
+        path = _PROJECT_ROOT / entry.path
+        language = str(getattr(entry, "language", engine.default_language))
+        try:
+            corpus = FileCorpus(path.resolve())
+        except (OSError, ValueError) as exc:
+            logger.error("Skipping fortune corpus %s: %s", path, exc)
+            continue
+        engine.add_corpus(corpus, language, float(getattr(entry, "weight", 1)))
+    if not engine.languages:
+        engine.add_corpus(ListCorpus(FORTUNES), engine.default_language)
+    return engine
+
+
+_engine: Optional[FortuneEngine] = None
+_engine_conf: Any = None
+_engine_lock = threading.Lock()
+
+
+def get_fortune_engine() -> FortuneEngine:
+    """Return the shared engine, opening and indexing the corpora on first use."""
+    global _engine, _engine_conf
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                bot_conf = config_bot.snapshot()
+                _engine_conf = getattr(bot_conf, "fortune", None)
+                _engine = _build_fortune_engine(bot_conf)
+    return _engine
+
+
+def _reload_engine(bot_conf: ConfigNamespace) -> None:
+    """Rebuild the engine when the ``fortune`` section changed; handlers pick up the new one on their next call."""
+    global _engine, _engine_conf
+    with _engine_lock:
+        conf = getattr(bot_conf, "fortune", None)
+        # An engine not built yet is built from the new snapshot on first use.
+        if _engine is None or conf == _engine_conf:
+            return
+        _engine = _build_fortune_engine(bot_conf)
+        _engine_conf = conf
+
+
+config_bot.subscribe(_reload_engine)
+
+
+def _pick_fortune(user_id: int, language_code: Optional[str] = None) -> str:
+    return get_fortune_engine().pick(user_id, language_code)
 
 
 def fortune(update: Update, context: CallbackContext) -> None:
@@ -28,5 +247,12 @@ def fortune(update: Update, context: CallbackContext) -> None:
     message = update.effective_message
     if message is None or user is None:
         return
-    random.seed(_seed_from_user(user.id))
-    message.reply_text(random.choice(FORTUNES))
+    send_queue.reply(message, _pick_fortune(user.id, user.language_code))
+
+
+async def fortune_async(update: Update, context: CallbackContext) -> None:
+    user = update.effective_user
+    message = update.effective_message
+    if message is None or user is None:
+        return
+    send_queue.reply(message, _pick_fortune(user.id, user.language_code))
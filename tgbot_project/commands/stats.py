@@ -0,0 +1,115 @@
+﻿"""Membership statistics command backed by the daily rollups."""
+from __future__ import annotations
+
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from ..config import config_bot
+from ..database.db import has_membership_rollups, membership_stats, rebuild_membership_rollups, user_has_role
+from ..logger.logger import get_logger
+from ..messaging.send_queue import send_queue
+from ..runtime.async_runtime import runtime
+from .user_management import ADMIN_ONLY_TEXT, ADMIN_ROLES
+
+logger = get_logger("commands.stats")
+
+USAGE_TEXT = "用法: /stats [天数] 或 /stats <开始日期> <结束日期>（日期格式 YYYY-MM-DD，按 UTC 统计）"
+
+DEFAULT_DAYS = 7
+MAX_DAYS = 3660
+MAX_CHATS_LISTED = 10
+
+
+def _parse_range(args: List[str], today: date) -> Optional[Tuple[date, date]]:
+    if not args:
+        return today - timedelta(days=DEFAULT_DAYS - 1), today
+    if len(args) == 1 and args[0].isdigit():
+        days = min(max(1, int(args[0])), MAX_DAYS)
+        return today - timedelta(days=days - 1), today
+    if len(args) == 2:
+        try:
+            start, end = (datetime.strptime(arg, "%Y-%m-%d").date() for arg in args)
+        except ValueError:
+            return None
+        if start > end:
+            start, end = end, start
+        return start, end
+    return None
+
+
+def _format_row(label: str, row: dict) -> str:
+    retention = "—" if row["retention"] is None else f"{row['retention'] * 100:.1f}%"
+    return (
+        f"{label}: 加入 {row['joins']} / 离开 {row['leaves']} / 净增长 {row['net']:+d} / "
+        f"留存 {retention}（{row['retained']}/{row['joins']}）"
+    )
+
+
+def _build_report(user_id: int, chat_id: int, chat_type: str, args: List[str]) -> str:
+    if not user_has_role(user_id, *ADMIN_ROLES):
+        return ADMIN_ONLY_TEXT
+    period = _parse_range(args, datetime.utcnow().date())
+    if period is None:
+        return USAGE_TEXT
+    start, end = period
+    header = f"成员统计 {start.isoformat()} ~ {end.isoformat()}（UTC）"
+
+    if chat_type != "private":
+        rows = membership_stats(start, end, chat_id=chat_id)
+        if not rows:
+            return f"{header}\n该时间段内没有成员变动记录。"
+        return f"{header}\n{_format_row('本群', rows[0])}"
+
+    rows = membership_stats(start, end)
+    if not rows:
+        return f"{header}\n该时间段内没有成员变动记录。"
+    lines = [header]
+    lines.extend(_format_row(row["chat_id"], row) for row in rows[:MAX_CHATS_LISTED])
+    if len(rows) > MAX_CHATS_LISTED:
+        lines.append(f"……另有 {len(rows) - MAX_CHATS_LISTED} 个群组未列出")
+    return "\n".join(lines)
+
+
+def stats(update: Update, context: CallbackContext) -> None:
+    user = update.effective_user
+    message = update.effective_message
+    if message is None or user is None:
+        return
+    send_queue.reply(message, _build_report(user.id, message.chat_id, message.chat.type, context.args or []))
+
+
+async def stats_async(update: Update, context: CallbackContext) -> None:
+    user = update.effective_user
+    message = update.effective_message
+    if message is None or user is None:
+        return
+    report = await runtime.run_db(_build_report, user.id, message.chat_id, message.chat.type, context.args or [])
+    send_queue.reply(message, report)
+
+
+def backfill_rollups() -> int:
+    """Rebuild the daily rollups from raw membership events."""
+    started = datetime.utcnow()
+    read = rebuild_membership_rollups()
+    logger.info("Rebuilt membership rollups from %d events in %s", read, datetime.utcnow() - started)
+    return read
+
+
+def backfill_rollups_on_start() -> bool:
+    """Backfill the rollups when the table is still empty; returns whether it ran.
+
+    Call this before the write-behind queue starts and before any update is
+    handled: a rebuild replaces the rollup rows wholesale, so increments
+    applied while it runs would be lost or counted twice.
+    """
+    conf = getattr(config_bot, "stats", None)
+    if not getattr(conf, "backfill_on_start", True) or has_membership_rollups():
+        return False
+    backfill_rollups()
+    return True
+
+
+__all__ = ["backfill_rollups", "backfill_rollups_on_start", "stats", "stats_async"]
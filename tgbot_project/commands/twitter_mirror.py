@@ -0,0 +1,185 @@
+﻿"""Background mirroring of Twitter timelines into configured chats."""
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+import tweepy
+from telegram.ext import CallbackContext, JobQueue
+
+from ..config import config_bot
+from ..logger.logger import get_logger
+from ..messaging.send_queue import send_queue
+from .twitter_sync import format_tweet, get_twitter_client, recent_tweets, take_unseen
+
+logger = get_logger("commands.twitter_mirror")
+
+Sender = Callable[[int, str], None]
+
+
+@dataclass
+class _HandleSchedule:
+    handle: str
+    chats: List[int] = field(default_factory=list)
+    next_due: float = 0.0
+    failures: int = 0
+
+
+class TwitterMirror:
+    """Fetch each configured handle on its own slot inside the rate-limit window.
+
+    Every distinct handle is fetched once per interval no matter how many
+    chats mirror it, and the intervals are derived from the API budget so the
+    whole target list never spends more than ``window_budget`` calls per
+    ``window_seconds``. Handles are staggered across the interval instead of
+    all firing together, and a failing handle backs off exponentially. A
+    ``429`` pauses every handle until the advertised reset time.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        targets: Dict[str, List[int]],
+        window_seconds: float = 900.0,
+        window_budget: int = 900,
+        min_interval: float = 60.0,
+        max_backoff: float = 3600.0,
+        clock: Callable[[], float] = time.monotonic,
+        wall_clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.client = client
+        self.window_seconds = float(window_seconds)
+        self.window_budget = max(1, int(window_budget))
+        self.max_backoff = float(max_backoff)
+        self.min_interval = float(min_interval)
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.paused_until = 0.0
+        self.handles: Dict[str, _HandleSchedule] = {}
+        self.interval = self.min_interval
+        self.set_targets(targets)
+
+    def set_targets(self, targets: Dict[str, List[int]]) -> None:
+        """Replace the mirrored handles and chats, recomputing the interval from the budget.
+
+        Handles that stay keep their schedule and backoff; new ones are
+        staggered across the interval.
+        """
+        handles: Dict[str, _HandleSchedule] = {}
+        for handle, chats in targets.items():
+            key = handle.lower()
+            if key not in handles:
+                previous = self.handles.get(key)
+                handles[key] = _HandleSchedule(
+                    handle=handle,
+                    next_due=previous.next_due if previous else 0.0,
+                    failures=previous.failures if previous else 0,
+                )
+            schedule = handles[key]
+            schedule.chats.extend(chat for chat in chats if chat not in schedule.chats)
+
+        calls_per_handle = self.window_budget / max(1, len(handles))
+        interval = max(self.min_interval, self.window_seconds / calls_per_handle)
+        now = self.clock()
+        added = [key for key in handles if key not in self.handles]
+        step = interval / max(1, len(added))
+        for index, key in enumerate(added):
+            handles[key].next_due = now + index * step
+        # run_due may be iterating the old dict on a job thread; swap rather than mutate.
+        self.interval = interval
+        self.handles = handles
+
+    def due_handles(self) -> List[_HandleSchedule]:
+        now = self.clock()
+        if now < self.paused_until:
+            return []
+        return [schedule for schedule in self.handles.values() if schedule.next_due <= now]
+
+    def run_due(self, send: Sender) -> int:
+        """Mirror every handle that is due; returns the number of messages sent."""
+        sent = 0
+        for schedule in self.due_handles():
+            try:
+                tweets = recent_tweets(self.client, schedule.handle, max_age=self.interval / 2)
+            except tweepy.TooManyRequests as exc:
+                self._pause_for_rate_limit(exc)
+                break
+            except tweepy.TweepyException as exc:  # type: ignore[attr-defined]
+                self._back_off(schedule, exc)
+                continue
+
+            schedule.failures = 0
+            schedule.next_due = self.clock() + self.interval
+            for chat_id in schedule.chats:
+                for item in take_unseen(schedule.handle, chat_id, tweets):
+                    send(chat_id, format_tweet(item))
+                    sent += 1
+        if sent:
+            logger.info("Mirrored %d tweets", sent)
+        return sent
+
+    def tick(self, context: CallbackContext) -> None:
+        """Job-queue callback."""
+        self.run_due(lambda chat_id, text: send_queue.send(context.bot, chat_id, text))
+
+    def _back_off(self, schedule: _HandleSchedule, exc: Exception) -> None:
+        schedule.failures += 1
+        delay = min(self.max_backoff, self.interval * (2 ** schedule.failures))
+        schedule.next_due = self.clock() + delay
+        logger.warning("Fetching %s failed (%s); retrying in %.0fs", schedule.handle, exc, delay)
+
+    def _pause_for_rate_limit(self, exc: Exception) -> None:
+        delay = self.window_seconds
+        response = getattr(exc, "response", None)
+        reset = getattr(response, "headers", {}).get("x-rate-limit-reset") if response is not None else None
+        if reset:
+            delay = max(1.0, float(reset) - self.wall_clock())
+        self.paused_until = self.clock() + delay
+        logger.warning("Twitter rate limit reached; pausing mirroring for %.0fs", delay)
+
+
+def _configured_targets(bot_conf: Any = config_bot) -> Dict[str, List[int]]:
+    conf = getattr(bot_conf, "twitter_mirror", None)
+    targets: Dict[str, List[int]] = {}
+    for target in getattr(conf, "targets", None) or []:
+        handle = getattr(target, "handle", None)
+        chats = [int(chat) for chat in (getattr(target, "chats", None) or [])]
+        if handle and chats:
+            targets.setdefault(handle, []).extend(chats)
+    return targets
+
+
+def schedule_twitter_mirror(job_queue: JobQueue, client: Optional[Any] = None) -> Optional[TwitterMirror]:
+    """Register the mirror job when enabled in config; returns the scheduler."""
+    conf = getattr(config_bot, "twitter_mirror", None)
+    if not getattr(conf, "enabled", False):
+        return None
+    client = client or get_twitter_client()
+    if client is None:
+        logger.warning("Twitter mirroring enabled but the Twitter client is not configured")
+        return None
+    targets = _configured_targets()
+    if not targets:
+        logger.warning("Twitter mirroring enabled without targets")
+        return None
+
+    mirror = TwitterMirror(
+        client,
+        targets,
+        window_seconds=getattr(conf, "window_seconds", 900),
+        window_budget=getattr(conf, "window_budget", 900),
+        min_interval=getattr(conf, "min_interval", 60),
+        max_backoff=getattr(conf, "max_backoff_seconds", 3600),
+    )
+    tick = float(getattr(conf, "tick_seconds", 30))
+    job_queue.run_repeating(mirror.tick, interval=tick, first=tick, name="twitter_mirror")
+    # Target edits apply live; enabling mirroring or changing the budget needs a restart.
+    config_bot.subscribe(lambda bot_conf: mirror.set_targets(_configured_targets(bot_conf)))
+    logger.info(
+        "Mirroring %d Twitter handles every %.0fs (tick %.0fs)", len(mirror.handles), mirror.interval, tick
+    )
+    return mirror
+
+
+__all__ = ["TwitterMirror", "schedule_twitter_mirror"]
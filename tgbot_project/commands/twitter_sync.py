@@ -1,17 +1,32 @@
 ﻿"""Sync Twitter timeline to Telegram."""
 from __future__ import annotations
 
-from typing import Optional
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional
 
 import tweepy
 from telegram import Update
 from telegram.ext import CallbackContext
 
-from ..config import config_secret
+from ..config import config_bot, config_secret
+from ..database.cache import TTLCache
+from ..database.db import get_twitter_cursor, get_twitter_state, save_twitter_state, set_twitter_cursor
 from ..logger.logger import get_logger
+from ..messaging.send_queue import send_queue
+from ..monitoring.metrics import registry
+from ..runtime.async_runtime import runtime
 
 logger = get_logger("commands.twitter_sync")
 
+TWITTER_CALLS = registry.counter(
+    "tgbot_twitter_api_calls_total", "Twitter API requests.", labels=("endpoint", "outcome")
+)
+TWITTER_SECONDS = registry.histogram("tgbot_twitter_api_seconds", "Twitter API request latency.", labels=("endpoint",))
+
 
 def _build_twitter_client() -> Optional[tweepy.API]:
     twitter_conf = getattr(config_secret, "TWITTER", None)
@@ -38,42 +53,175 @@ def _build_twitter_client() -> Optional[tweepy.API]:
     return tweepy.API(auth)
 
 
-_TWITTER_CLIENT = None
-try:
-    _TWITTER_CLIENT = _build_twitter_client()
-except Exception as exc:  # pragma: no cover - defensive
-    logger.exception("Failed to initialise Twitter client: %s", exc)
+_TWITTER_CLIENT: Optional[tweepy.API] = None
+_twitter_client_built = False
+_twitter_client_lock = threading.Lock()
 
 
-def sync_twitter(update: Update, context: CallbackContext) -> None:
-    message = update.effective_message
-    if message is None:
-        return
+def get_twitter_client() -> Optional[tweepy.API]:
+    """Build the client on first use; ``None`` when credentials are missing or invalid."""
+    global _TWITTER_CLIENT, _twitter_client_built
+    if not _twitter_client_built:
+        with _twitter_client_lock:
+            if not _twitter_client_built:
+                try:
+                    _TWITTER_CLIENT = _build_twitter_client()
+                except Exception as exc:  # pragma: no cover - defensive
+                    logger.exception("Failed to initialise Twitter client: %s", exc)
+                _twitter_client_built = True
+    return _TWITTER_CLIENT
+
+
+@dataclass
+class _Timeline:
+    tweets: List[Dict[str, str]]  # newest first
+    fetched_at: float
+    # Newest tweet id seen, kept when ``tweets`` is empty after a restart.
+    since_id: Optional[str] = None
+
+
+def _twitter_setting(name: str, default: Any) -> Any:
+    return getattr(getattr(config_bot, "twitter", None), name, default)
+
+
+REFRESH_INTERVAL = float(_twitter_setting("refresh_interval", 300))
+TIMELINE_DEPTH = int(_twitter_setting("timeline_depth", 20))
+MAX_REPLIES = int(_twitter_setting("max_replies", 5))
+
+# Shared by every chat: within REFRESH_INTERVAL a handle costs no API call at all.
+_timelines = TTLCache(max_entries=int(_twitter_setting("cached_handles", 256)), ttl=24 * 3600)
+# Fetches of one handle are serialised; handles share a fixed set of lock
+# stripes so the locks stay bounded however many handles are looked up.
+_FETCH_LOCK_STRIPES = 64
+_fetch_locks = [threading.Lock() for _ in range(_FETCH_LOCK_STRIPES)]
+
+
+def _tweet_record(tweet: Any) -> Dict[str, str]:
+    text = tweet.full_text if hasattr(tweet, "full_text") else tweet.text
+    return {"id": str(tweet.id), "author": tweet.user.name, "text": text}
 
-    if _TWITTER_CLIENT is None:
-        message.reply_text("Twitter 功能尚未配置，请先在 config_secret.yaml 中填写凭证。")
-        return
+
+def _fetch_timeline(client: Any, handle: str, since_id: Optional[str]) -> List[Dict[str, str]]:
+    kwargs: Dict[str, Any] = {"screen_name": handle, "tweet_mode": "extended"}
+    if since_id:
+        kwargs.update(since_id=int(since_id), count=TIMELINE_DEPTH)
+    else:
+        kwargs["count"] = MAX_REPLIES
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        statuses = client.user_timeline(**kwargs)
+        outcome = "ok"
+    except tweepy.TooManyRequests:
+        outcome = "rate_limited"
+        raise
+    finally:
+        TWITTER_CALLS.inc(endpoint="user_timeline", outcome=outcome)
+        TWITTER_SECONDS.observe(time.perf_counter() - started, endpoint="user_timeline")
+    tweets = [_tweet_record(tweet) for tweet in statuses]
+    tweets.sort(key=lambda item: int(item["id"]), reverse=True)
+    return tweets
+
+
+def _restored_timeline(key: str) -> Optional[_Timeline]:
+    """Rebuild an empty timeline from the state saved by an earlier process.
+
+    The tweets themselves are not persisted, but the saved ``since_id`` keeps
+    the next fetch incremental and the saved fetch time keeps the refresh
+    interval, so a restart does not cost every handle a full fetch.
+    """
+    state = get_twitter_state(key)
+    if state is None or not state["since_id"]:
+        return None
+    age = 0.0
+    if state["last_fetched_at"]:
+        age = max(0.0, (datetime.utcnow() - datetime.fromisoformat(state["last_fetched_at"])).total_seconds())
+    return _Timeline(tweets=[], fetched_at=time.monotonic() - age, since_id=state["since_id"])
+
+
+def recent_tweets(client: Any, handle: str, max_age: Optional[float] = None) -> List[Dict[str, str]]:
+    """Return cached recent tweets for ``handle``, fetching only what is new.
+
+    A cached timeline younger than ``max_age`` seconds (default
+    ``REFRESH_INTERVAL``) is returned without an API call. Raises
+    ``tweepy.TweepyException`` when a refresh is needed and fails.
+    """
+    key = handle.lower()
+    max_age = REFRESH_INTERVAL if max_age is None else max_age
+    with _fetch_locks[zlib.crc32(key.encode("utf-8")) % _FETCH_LOCK_STRIPES]:
+        timeline: Optional[_Timeline] = _timelines.get(key)
+        if timeline is None:
+            timeline = _restored_timeline(key)
+            if timeline is not None:
+                _timelines.set(key, timeline)
+        if timeline is not None and time.monotonic() - timeline.fetched_at < max_age:
+            return timeline.tweets
+
+        since_id = None
+        if timeline is not None:
+            since_id = timeline.tweets[0]["id"] if timeline.tweets else timeline.since_id
+        fresh = _fetch_timeline(client, handle, since_id)
+        known = timeline.tweets if timeline else []
+        tweets = (fresh + known)[:TIMELINE_DEPTH]
+        newest = tweets[0]["id"] if tweets else since_id
+        _timelines.set(key, _Timeline(tweets=tweets, fetched_at=time.monotonic(), since_id=newest))
+        save_twitter_state(key, since_id=newest, changed=bool(fresh))
+        logger.info("Fetched %d new tweets for %s (since_id=%s)", len(fresh), handle, since_id)
+        return tweets
+
+
+def take_unseen(handle: str, chat_id: int, tweets: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Pick the tweets ``chat_id`` has not received yet, oldest first, and advance its cursor."""
+    cursor = get_twitter_cursor(handle, chat_id)
+    unseen = [item for item in tweets if cursor is None or int(item["id"]) > int(cursor)]
+    if not unseen:
+        return []
+    set_twitter_cursor(handle, chat_id, unseen[0]["id"])
+    return list(reversed(unseen[:MAX_REPLIES]))
+
+
+def format_tweet(item: Dict[str, str]) -> str:
+    return f"{item['author']}: {item['text']}"
+
+
+def _collect_tweet_replies(chat_id: int, args: List[str]) -> List[str]:
+    """Return the tweets this chat has not seen yet as messages to send back."""
+    client = get_twitter_client()
+    if client is None:
+        return ["Twitter 功能尚未配置，请先在 config_secret.yaml 中填写凭证。"]
 
     twitter_conf = getattr(config_secret, "TWITTER", None)
-    handle = context.args[0] if context.args else getattr(twitter_conf, "target_handle", None)
+    handle = args[0] if args else getattr(twitter_conf, "target_handle", None)
     if not handle:
-        message.reply_text("请提供 Twitter 用户名，例如 /sync_twitter TwitterDev")
-        return
+        return ["请提供 Twitter 用户名，例如 /sync_twitter TwitterDev"]
 
     try:
-        tweets = _TWITTER_CLIENT.user_timeline(screen_name=handle, count=5, tweet_mode="extended")
+        tweets = recent_tweets(client, handle)
     except tweepy.TweepyException as exc:  # type: ignore[attr-defined]
         logger.exception("Failed to fetch tweets: %s", exc)
-        message.reply_text("同步推特时出现错误，请稍后再试。")
-        return
+        return ["同步推特时出现错误，请稍后再试。"]
+
+    delivered = take_unseen(handle, chat_id, tweets)
+    if not delivered:
+        return [f"{handle} 暂无新推文。"]
+    logger.info("Synced %d tweets for handle %s to chat %s", len(delivered), handle, chat_id)
+    return [format_tweet(item) for item in delivered]
+
 
-    if not tweets:
-        message.reply_text(f"未找到 {handle} 的推文。")
+def sync_twitter(update: Update, context: CallbackContext) -> None:
+    message = update.effective_message
+    if message is None:
         return
 
-    for tweet in tweets:
-        text = tweet.full_text if hasattr(tweet, "full_text") else tweet.text
-        message.reply_text(f"{tweet.user.name}: {text}")
+    for reply in _collect_tweet_replies(message.chat_id, context.args or []):
+        send_queue.reply(message, reply)
+
 
-    logger.info("Synced %d tweets for handle %s", len(tweets), handle)
+async def sync_twitter_async(update: Update, context: CallbackContext) -> None:
+    message = update.effective_message
+    if message is None:
+        return
 
+    replies = await runtime.run_io(_collect_tweet_replies, message.chat_id, context.args or [])
+    for reply in replies:
+        send_queue.reply(message, reply)
@@ -1,19 +1,25 @@
 ﻿"""User management commands."""
 from __future__ import annotations
 
-from typing import Dict, List
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional, Tuple
 
-from telegram import Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, User
 from telegram.ext import CallbackContext
 
 from ..database.db import (
+    UserCursor,
     add_or_update_user,
-    list_users,
+    claim_first_admin,
+    list_users_page,
     remove_user,
     set_user_role,
     user_has_role,
 )
 from ..logger.logger import get_logger
+from ..messaging.send_queue import send_queue
+from ..runtime.async_runtime import runtime
 
 logger = get_logger("commands.user_management")
 
@@ -23,12 +29,20 @@ HELP_TEXT = (
     "  /manage_user register\n"
     "  /manage_user setrole <telegram_id> <member|admin>\n"
     "  /manage_user remove <telegram_id>\n"
-    "  /manage_user list"
+    "  /manage_user list [role=<member|admin>] [active=<yes|no>] [name=<用户名前缀>]"
 )
 
+ADMIN_ONLY_TEXT = "只有管理员可以执行该命令，请先 /manage_user register 并联系管理员授权。"
+
 ADMIN_ROLES = {"admin"}
 VALID_ROLES = {"member", "admin"}
 
+PAGE_SIZE = 20
+USER_LIST_CALLBACK = "ul"
+USER_LIST_PATTERN = r"^ul\|"
+_CURSOR_TIME_FORMAT = "%Y%m%d%H%M%S%f"
+_MAX_PREFIX_BYTES = 12
+
 
 def _require_message(update: Update):
     if update.effective_message is None:
@@ -38,92 +52,218 @@ def _require_message(update: Update):
 
 def manage_user(update: Update, context: CallbackContext) -> None:
     message = _require_message(update)
-    user = update.effective_user
-    args: List[str] = context.args or []
+    text, markup = _reply_for(update.effective_user, context.args or [])
+    send_queue.reply(message, text, reply_markup=markup)
 
-    if user is None:
-        message.reply_text("无法识别用户信息。")
+
+async def manage_user_async(update: Update, context: CallbackContext) -> None:
+    message = _require_message(update)
+    text, markup = await runtime.run_db(_reply_for, update.effective_user, context.args or [])
+    send_queue.reply(message, text, reply_markup=markup)
+
+
+def user_list_page(update: Update, context: CallbackContext) -> None:
+    """Handle the previous/next buttons under a user list."""
+    query = update.callback_query
+    if query is None:
+        return
+    text, markup = _page_for_callback(update.effective_user, query.data or "")
+    if markup is None and text == ADMIN_ONLY_TEXT:
+        query.answer(text, show_alert=True)
         return
+    query.edit_message_text(text, reply_markup=markup)
+    query.answer()
 
-    if not args:
-        message.reply_text(HELP_TEXT)
+
+async def user_list_page_async(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    if query is None:
+        return
+    text, markup = await runtime.run_db(_page_for_callback, update.effective_user, query.data or "")
+    if markup is None and text == ADMIN_ONLY_TEXT:
+        await runtime.run_io(query.answer, text, show_alert=True)
         return
+    await runtime.run_io(query.edit_message_text, text, reply_markup=markup)
+    await runtime.run_io(query.answer)
+
+
+@dataclass(frozen=True)
+class _ListFilters:
+    role: Optional[str] = None
+    active: Optional[bool] = None
+    prefix: Optional[str] = None
+
+
+def _parse_list_filters(args: List[str]) -> _ListFilters:
+    role = None
+    active = None
+    prefix = None
+    for arg in args:
+        key, _, value = arg.partition("=")
+        key, value = key.lower(), value.strip()
+        if key == "role" and value.lower() in VALID_ROLES:
+            role = value.lower()
+        elif key == "active" and value:
+            active = value.lower() in {"1", "yes", "true", "y"}
+        elif key == "name" and value:
+            prefix = value.lstrip("@")
+    return _ListFilters(role=role, active=active, prefix=prefix)
+
+
+def _encode_cursor(cursor: UserCursor) -> str:
+    created_at, row_id = cursor
+    return f"{created_at.strftime(_CURSOR_TIME_FORMAT)}.{row_id}"
+
+
+def _decode_cursor(token: str) -> UserCursor:
+    stamp, _, row_id = token.partition(".")
+    return datetime.strptime(stamp, _CURSOR_TIME_FORMAT), int(row_id)
+
+
+def _callback_data(filters: _ListFilters, direction: str, cursor: UserCursor, page: int) -> str:
+    active = "" if filters.active is None else ("1" if filters.active else "0")
+    role = (filters.role or "")[:1]
+    return "|".join(
+        [USER_LIST_CALLBACK, role, active, filters.prefix or "", direction, _encode_cursor(cursor), str(page)]
+    )
+
+
+def _parse_callback_data(data: str) -> Tuple[_ListFilters, str, UserCursor, int]:
+    _, role, active, prefix, direction, cursor, page = data.split("|")
+    filters = _ListFilters(
+        role={"a": "admin", "m": "member"}.get(role),
+        active=None if not active else active == "1",
+        prefix=prefix or None,
+    )
+    return filters, direction, _decode_cursor(cursor), int(page)
+
+
+def _fit_prefix(filters: _ListFilters) -> _ListFilters:
+    # callback_data is limited to 64 bytes and split on "|", so long prefixes are shortened.
+    prefix = (filters.prefix or "").split("|", 1)[0]
+    while prefix and len(prefix.encode("utf-8")) > _MAX_PREFIX_BYTES:
+        prefix = prefix[:-1]
+    return _ListFilters(role=filters.role, active=filters.active, prefix=prefix or None)
+
+
+def _render_user_page(
+    filters: _ListFilters,
+    page: int = 1,
+    after: Optional[UserCursor] = None,
+    before: Optional[UserCursor] = None,
+    paging: Optional[_ListFilters] = None,
+) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Render one page filtered by ``filters``; the buttons carry ``paging`` (default ``filters``)."""
+    paging = paging or filters
+    result = list_users_page(
+        limit=PAGE_SIZE,
+        after=after,
+        before=before,
+        role=filters.role,
+        active=filters.active,
+        username_prefix=filters.prefix,
+    )
+    users = result["users"]
+    if not users:
+        return ("暂无注册用户" if page == 1 else "没有更多用户了"), None
+
+    lines = [
+        f"{item['telegram_id']} - {item.get('username') or '未知'} - {item['role']} - "
+        f"{'活跃' if item.get('is_active') else '已退出'}"
+        for item in users
+    ]
+    buttons = []
+    if result["prev"] is not None:
+        buttons.append(InlineKeyboardButton("« 上一页", callback_data=_callback_data(paging, "p", result["prev"], page - 1)))
+    if result["next"] is not None:
+        buttons.append(InlineKeyboardButton("下一页 »", callback_data=_callback_data(paging, "n", result["next"], page + 1)))
+    markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    text = f"用户列表（第 {page} 页）:\n" + "\n".join(lines)
+    if markup is not None and paging.prefix != filters.prefix:
+        text += f"\n（用户名前缀过长，翻页时按「{paging.prefix or ''}」筛选）"
+    return text, markup
+
+
+def _page_for_callback(user: Optional[User], data: str) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    if user is None or not user_has_role(user.id, *ADMIN_ROLES):
+        return ADMIN_ONLY_TEXT, None
+    try:
+        filters, direction, cursor, page = _parse_callback_data(data)
+    except ValueError:
+        logger.warning("Malformed user list callback data: %s", data)
+        return "分页信息已失效，请重新执行 /manage_user list", None
+    if direction == "p":
+        return _render_user_page(filters, page=page, before=cursor)
+    return _render_user_page(filters, page=page, after=cursor)
+
+
+def _reply_for(user: Optional[User], args: List[str]) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Return the reply text and optional keyboard for a /manage_user invocation."""
+    if user is not None and args and args[0].lower() == "list":
+        if not user_has_role(user.id, *ADMIN_ROLES):
+            logger.warning("User %s tried admin command list", user.id)
+            return ADMIN_ONLY_TEXT, None
+        filters = _parse_list_filters(args[1:])
+        # The first page uses the whole prefix; only the paging buttons need the shortened one.
+        return _render_user_page(filters, paging=_fit_prefix(filters))
+    return _run_subcommand(user, args), None
+
+
+def _run_subcommand(user: Optional[User], args: List[str]) -> str:
+    """Execute a /manage_user subcommand and return the reply text."""
+    if user is None:
+        return "无法识别用户信息。"
+
+    if not args:
+        return HELP_TEXT
 
     subcommand = args[0].lower()
 
     if subcommand == "register":
-        existing = list_users()
-        has_admin = any(item.get("role") == "admin" for item in existing)
-        default_role = "admin" if not has_admin else "member"
         record = add_or_update_user(
             user.id,
             user.username,
             first_name=user.first_name,
             last_name=user.last_name,
-            role=default_role,
-        )
-        suffix = "（首位注册用户自动成为管理员）" if default_role == "admin" else ""
-        message.reply_text(
-            f"用户 {record['telegram_id']} 注册成功，角色: {record['role']}{suffix}"
         )
+        promoted = claim_first_admin(user.id)
+        if promoted is not None:
+            record = promoted
+        suffix = "（首位注册用户自动成为管理员）" if promoted is not None else ""
         logger.info("Registered user %s with role %s", record["telegram_id"], record["role"])
-        return
+        return f"用户 {record['telegram_id']} 注册成功，角色: {record['role']}{suffix}"
 
     is_admin = user_has_role(user.id, *ADMIN_ROLES)
     if subcommand != "register" and not is_admin:
-        message.reply_text("只有管理员可以执行该命令，请先 /manage_user register 并联系管理员授权。")
         logger.warning("User %s tried admin command %s", user.id, subcommand)
-        return
+        return ADMIN_ONLY_TEXT
 
     if subcommand == "setrole":
         if len(args) < 3:
-            message.reply_text("用法: /manage_user setrole <telegram_id> <member|admin>")
-            return
+            return "用法: /manage_user setrole <telegram_id> <member|admin>"
         target_id, role = args[1], args[2].lower()
         if role not in VALID_ROLES:
-            message.reply_text(f"角色 {role} 不合法，可选: {', '.join(VALID_ROLES)}")
-            return
+            return f"角色 {role} 不合法，可选: {', '.join(VALID_ROLES)}"
         try:
             target_id_int = int(target_id)
         except ValueError:
-            message.reply_text("telegram_id 必须是数字")
-            return
+            return "telegram_id 必须是数字"
         record = set_user_role(target_id_int, role)
         if not record:
-            message.reply_text("未找到该用户，请提醒对方先执行 /manage_user register 或加入群组。")
-            return
-        message.reply_text(f"已将用户 {record['telegram_id']} 设置为 {record['role']}")
+            return "未找到该用户，请提醒对方先执行 /manage_user register 或加入群组。"
         logger.info("User %s set role of %s to %s", user.id, record["telegram_id"], role)
-        return
+        return f"已将用户 {record['telegram_id']} 设置为 {record['role']}"
 
     if subcommand == "remove":
         if len(args) < 2:
-            message.reply_text("用法: /manage_user remove <telegram_id>")
-            return
+            return "用法: /manage_user remove <telegram_id>"
         try:
             target_id_int = int(args[1])
         except ValueError:
-            message.reply_text("telegram_id 必须是数字")
-            return
+            return "telegram_id 必须是数字"
         if remove_user(target_id_int):
-            message.reply_text(f"已移除用户 {target_id_int}")
             logger.info("User %s removed %s", user.id, target_id_int)
-        else:
-            message.reply_text("未找到该用户")
-        return
-
-    if subcommand == "list":
-        users: List[Dict[str, str]] = list_users()
-        if not users:
-            message.reply_text("暂无注册用户")
-            return
-        lines = [
-            f"{item['telegram_id']} - {item.get('username') or '未知'} - {item['role']} - "
-            f"{'活跃' if item.get('is_active') else '已退出'}"
-            for item in users
-        ]
-        message.reply_text("用户列表:\n" + "\n".join(lines))
-        return
-
-    message.reply_text(HELP_TEXT)
+            return f"已移除用户 {target_id_int}"
+        return "未找到该用户"
 
+    return HELP_TEXT
@@ -2,9 +2,10 @@
 from __future__ import annotations
 
 import os
+import threading
 from pathlib import Path
 from types import SimpleNamespace
-from typing import Any, Dict
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import yaml
 
@@ -13,7 +14,16 @@ _CONFIG_DIR = Path(__file__).resolve().parent
 
 
 class ConfigNamespace(SimpleNamespace):
-    """Namespace wrapper that keeps attribute-style access for dict data."""
+    """Namespace wrapper that keeps attribute-style access for dict data.
+
+    Instances are read-only snapshots; a reload builds new ones.
+    """
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("configuration snapshots are read-only")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError("configuration snapshots are read-only")
 
     def to_dict(self) -> Dict[str, Any]:
         return _namespace_to_dict(self)
@@ -53,6 +63,8 @@ def _load_yaml_file(filename: str) -> ConfigNamespace:
 
     with path.open("r", encoding="utf-8") as config_file:
         data = yaml.safe_load(config_file) or {}
+    if not isinstance(data, dict):
+        raise ValueError(f"{filename} must contain a mapping at the top level")
 
     return _dict_to_namespace(_expand_env(data))
 
@@ -62,14 +74,97 @@ def load_runtime_db_path() -> Path:
     return _CONFIG_DIR / "config_runtime.db"
 
 
-config_logger = _load_yaml_file("config_logger.yaml")
-config_database = _load_yaml_file("config_database.yaml")
-config_secret = _load_yaml_file("config_secret.yaml")
+Validator = Callable[[ConfigNamespace], None]
+Subscriber = Callable[[ConfigNamespace], None]
+
+
+class ConfigFile:
+    """The current snapshot of one YAML file.
+
+    Attribute access is forwarded to the current snapshot, so modules that
+    imported the handle see reloaded values. Code that reads several related
+    settings should take :meth:`snapshot` once to get a consistent view. The
+    file is parsed on first access.
+    """
+
+    def __init__(self, name: str, filename: str) -> None:
+        self.name = name
+        self.filename = filename
+        self.path = _CONFIG_DIR / filename
+        self.validators: List[Validator] = []
+        self.subscribers: List[Subscriber] = []
+        self._snapshot: Optional[ConfigNamespace] = None
+        self._signature: Optional[Tuple[int, int]] = None
+        self._lock = threading.Lock()
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def snapshot(self) -> ConfigNamespace:
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._signature = self._stat()
+                    self._snapshot = _load_yaml_file(self.filename)
+                snapshot = self._snapshot
+        return snapshot
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.snapshot(), name)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self.snapshot().to_dict()
+
+    def add_validator(self, validator: Validator) -> None:
+        """Run ``validator`` against every reloaded snapshot; raising rejects the reload."""
+        self.validators.append(validator)
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        """Call ``subscriber`` with each new snapshot after it has been swapped in."""
+        self.subscribers.append(subscriber)
+
+    def changed(self) -> bool:
+        return self._snapshot is not None and self._stat() != self._signature
+
+    def reload(self) -> ConfigNamespace:
+        """Parse and validate the file, then swap the new snapshot in.
+
+        Raises when the file cannot be parsed or a validator rejects it; the
+        previous snapshot stays in place and that version of the file is not
+        retried until it changes again. Subscribers are not called here.
+        """
+        with self._lock:
+            signature = self._stat()
+            try:
+                snapshot = _load_yaml_file(self.filename)
+                for validator in self.validators:
+                    validator(snapshot)
+            finally:
+                self._signature = signature
+            self._snapshot = snapshot
+        return snapshot
+
+
+config_logger = ConfigFile("config_logger", "config_logger.yaml")
+config_database = ConfigFile("config_database", "config_database.yaml")
+config_secret = ConfigFile("config_secret", "config_secret.yaml")
+config_bot = ConfigFile("config_bot", "config_bot.yaml")
+CONFIG_FILES = (config_logger, config_database, config_secret, config_bot)
 
 __all__ = [
+    "CONFIG_FILES",
+    "ConfigFile",
     "ConfigNamespace",
     "config_logger",
     "config_database",
     "config_secret",
+    "config_bot",
     "load_runtime_db_path",
 ]
@@ -0,0 +1,48 @@
+﻿"""Poll the configuration files and apply edits without restarting the bot."""
+from __future__ import annotations
+
+from typing import Any, Iterable, List
+
+from ..logger.logger import get_logger
+from . import CONFIG_FILES, ConfigFile, config_bot
+
+logger = get_logger("config.watcher")
+
+
+def reload_config(files: Iterable[ConfigFile] = CONFIG_FILES, force: bool = False) -> List[str]:
+    """Reload every file whose mtime or size changed and notify its subscribers.
+
+    An invalid file is logged and skipped, so the running bot keeps the last
+    good snapshot. Returns the names of the files that were swapped in.
+    """
+    reloaded: List[str] = []
+    for config_file in files:
+        if not (force or config_file.changed()):
+            continue
+        try:
+            snapshot = config_file.reload()
+        except Exception as exc:
+            logger.error("Keeping the previous %s; the edited file was rejected: %s", config_file.filename, exc)
+            continue
+        reloaded.append(config_file.name)
+        logger.info("Reloaded %s", config_file.filename)
+        for subscriber in list(config_file.subscribers):
+            try:
+                subscriber(snapshot)
+            except Exception:
+                logger.exception("Applying %s via %s failed", config_file.filename, getattr(subscriber, "__qualname__", subscriber))
+    return reloaded
+
+
+def schedule_config_reload(job_queue: Any) -> bool:
+    """Register the polling job unless ``config_reload.enabled`` is false in config_bot.yaml."""
+    conf = getattr(config_bot, "config_reload", None)
+    if not getattr(conf, "enabled", True):
+        return False
+    interval = float(getattr(conf, "interval_seconds", 5))
+    job_queue.run_repeating(lambda context: reload_config(), interval=interval, first=interval, name="config_reload")
+    logger.info("Watching configuration files for changes every %.0fs", interval)
+    return True
+
+
+__all__ = ["reload_config", "schedule_config_reload"]
@@ -0,0 +1,93 @@
+﻿"""Seed the users table from an exported chat member list.
+
+Accepts a JSON array (plain user objects or ``ChatMember``-style objects with
+a nested ``user``) or a CSV file with a header row::
+
+    python -m tgbot_project.database.bulk_import members.json
+    python -m tgbot_project.database.bulk_import members.csv --role member --batch-size 2000
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from ..logger.logger import get_logger
+from .db import bulk_upsert_users, init_db
+
+logger = get_logger("database.bulk_import")
+
+_ID_KEYS = ("telegram_id", "id", "user_id")
+
+
+def _normalise(raw: Dict[str, Any], role: Optional[str]) -> Optional[Dict[str, Any]]:
+    user = raw.get("user") if isinstance(raw.get("user"), dict) else raw
+    if user.get("is_bot") in (True, "true", "True", "1"):
+        return None
+    telegram_id = next((user[key] for key in _ID_KEYS if user.get(key) not in (None, "")), None)
+    if telegram_id is None:
+        return None
+    return {
+        "telegram_id": str(telegram_id).strip(),
+        "username": (user.get("username") or "").lstrip("@") or None,
+        "first_name": user.get("first_name") or None,
+        "last_name": user.get("last_name") or None,
+        "role": role,
+    }
+
+
+def read_members(path: Path, role: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """Yield user records from a ``.json`` or ``.csv`` export, skipping bots and rows without an id."""
+    if path.suffix.lower() == ".csv":
+        with path.open(newline="", encoding="utf-8-sig") as source:
+            rows: Any = list(csv.DictReader(source))
+    else:
+        with path.open(encoding="utf-8-sig") as source:
+            rows = json.load(source)
+        if isinstance(rows, dict):
+            rows = rows.get("members") or rows.get("result") or []
+    for raw in rows:
+        record = _normalise(raw, role)
+        if record is not None:
+            yield record
+
+
+def import_members(path: Path, role: Optional[str] = None, batch_size: int = 1000) -> Dict[str, int]:
+    totals = {"inserted": 0, "updated": 0}
+    batch: List[Dict[str, Any]] = []
+
+    def flush() -> None:
+        result = bulk_upsert_users(batch)
+        for key in totals:
+            totals[key] += result[key]
+        batch.clear()
+
+    for record in read_members(path, role):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return totals
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", type=Path, help="Exported member list (.json or .csv)")
+    parser.add_argument("--role", choices=["member", "admin"], help="Role to assign; existing users keep theirs if omitted")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Users written per transaction")
+    args = parser.parse_args(argv)
+
+    init_db()
+    started = time.perf_counter()
+    totals = import_members(args.path, role=args.role, batch_size=max(1, args.batch_size))
+    elapsed = time.perf_counter() - started
+    logger.info("Imported %s", args.path)
+    print(f"inserted={totals['inserted']} updated={totals['updated']} elapsed={elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
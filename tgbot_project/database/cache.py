@@ -0,0 +1,122 @@
+﻿"""Small in-process caches used in front of database lookups."""
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from ..config import config_database
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ``ttl`` seconds.
+
+    ``max_entries <= 0`` disables the cache: every lookup is a miss and
+    nothing is stored.
+
+    To fill the cache after a database read without racing a writer, take
+    :meth:`token` before the read and pass it to :meth:`set`: the value is
+    dropped if the key was invalidated in between.
+    """
+
+    # Per-key invalidations remembered for set(); older ones only raise the floor.
+    _MAX_INVALIDATIONS = 4096
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 60.0) -> None:
+        self.max_entries = int(max_entries)
+        self.ttl = float(ttl)
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation; key -> generation of its last invalidation.
+        self._generation = 0
+        self._invalidated: "OrderedDict[Hashable, int]" = OrderedDict()
+        self._invalidated_floor = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def token(self) -> int:
+        """Current generation, to pass to :meth:`set` for a value read after this call."""
+        with self._lock:
+            return self._generation
+
+    def set(self, key: Hashable, value: Any, token: Optional[int] = None) -> None:
+        if not self.enabled:
+            return
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            if token is not None and (
+                token < self._invalidated_floor or self._invalidated.get(key, 0) > token
+            ):
+                # Invalidated since the value was read; it may predate the write.
+                return
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation += 1
+            self._invalidated[key] = self._generation
+            self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self._MAX_INVALIDATIONS:
+                _, generation = self._invalidated.popitem(last=False)
+                self._invalidated_floor = generation
+
+    def disable(self) -> None:
+        """Drop every entry and store nothing from now on."""
+        with self._lock:
+            self.max_entries = 0
+        self.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._invalidated.clear()
+            self._invalidated_floor = self._generation
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
+
+
+def _build_user_cache() -> TTLCache:
+    conf = getattr(config_database, "user_cache", None)
+    if conf is not None and not getattr(conf, "enabled", True):
+        return TTLCache(max_entries=0)
+    return TTLCache(
+        max_entries=getattr(conf, "max_entries", 4096),
+        ttl=getattr(conf, "ttl_seconds", 60),
+    )
+
+
+user_cache = _build_user_cache()
+
+__all__ = ["TTLCache", "user_cache"]
@@ -1,29 +1,51 @@
 ﻿"""Database helpers using SQLAlchemy for Telegram bot."""
 from __future__ import annotations
 
+import os
+import threading
+import time
+from collections import Counter
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import date, datetime
 from pathlib import Path
-from typing import Dict, Iterator, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
+    Date,
     DateTime,
+    Index,
     Integer,
     String,
     UniqueConstraint,
     create_engine,
-    text,
+    event,
+    func,
+    tuple_,
+    update,
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from ..config import config_database
+from ..monitoring.metrics import registry
+from .cache import user_cache
+from .migrations import migrate
 
 Base = declarative_base()
 
 
 def _build_database_url() -> str:
+    # Lets tools such as the load test run against a scratch database.
+    override = os.getenv("TGBOT_DATABASE_URL")
+    if override:
+        return override
+
     db_conf = getattr(config_database, "database", None)
     if db_conf is None:
         raise RuntimeError("Database configuration missing 'database' section")
@@ -48,16 +70,111 @@ def _build_database_url() -> str:
     raise ValueError(f"Unsupported database type: {db_type}")
 
 
-DATABASE_URL = _build_database_url()
+_SQLITE_JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+_SQLITE_SYNCHRONOUS = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+
+def _sqlite_pragmas(conf: Any) -> List[str]:
+    """Translate the ``sqlite`` config section into PRAGMA statements run on every new connection."""
+    journal_mode = str(getattr(conf, "journal_mode", "WAL")).upper()
+    synchronous = str(getattr(conf, "synchronous", "NORMAL")).upper()
+    if journal_mode not in _SQLITE_JOURNAL_MODES:
+        raise ValueError(f"Unsupported SQLite journal_mode: {journal_mode}")
+    if synchronous not in _SQLITE_SYNCHRONOUS:
+        raise ValueError(f"Unsupported SQLite synchronous level: {synchronous}")
+    return [
+        f"PRAGMA journal_mode={journal_mode}",
+        f"PRAGMA synchronous={synchronous}",
+        f"PRAGMA busy_timeout={int(getattr(conf, 'busy_timeout_ms', 5000))}",
+        # A negative cache_size is measured in KiB rather than pages.
+        f"PRAGMA cache_size=-{int(getattr(conf, 'cache_size_kib', 20000))}",
+        f"PRAGMA mmap_size={int(getattr(conf, 'mmap_size_mb', 256)) * 1024 * 1024}",
+        "PRAGMA temp_store=MEMORY",
+    ]
+
+
+DB_SESSION_SECONDS = registry.histogram("tgbot_db_session_seconds", "Lifetime of session_scope transactions.")
+DB_QUERY_SECONDS = registry.histogram(
+    "tgbot_db_query_seconds", "Database statement execution time.", labels=("statement",)
+)
+
+
+def _statement_kind(statement: str) -> str:
+    keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return keyword if keyword in {"SELECT", "INSERT", "UPDATE", "DELETE"} else "OTHER"
+
+
+def _instrument_engine(engine) -> None:
+    @event.listens_for(engine, "before_cursor_execute")
+    def _start_query_timer(conn, cursor, statement, parameters, context, executemany) -> None:
+        if context is not None:
+            context._tgbot_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _stop_query_timer(conn, cursor, statement, parameters, context, executemany) -> None:
+        started = getattr(context, "_tgbot_started", None)
+        if started is not None:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, statement=_statement_kind(statement))
+
+
+def _build_engine():
+    echo_flag = bool(getattr(config_database.database, "echo", False))
+    pool_conf = getattr(config_database, "pool", None)
+    url = make_url(_build_database_url())
+    pool_options: Dict[str, Any] = {
+        "pool_recycle": int(getattr(pool_conf, "recycle_seconds", 1800)),
+        "pool_pre_ping": bool(getattr(pool_conf, "pre_ping", True)),
+    }
+    # Only a QueuePool accepts sizing; in-memory SQLite (and file SQLite before
+    # SQLAlchemy 2.0) uses pools that reject these arguments.
+    if issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        pool_options.update(
+            pool_size=int(getattr(pool_conf, "size", 5)),
+            max_overflow=int(getattr(pool_conf, "max_overflow", 10)),
+            pool_timeout=float(getattr(pool_conf, "timeout_seconds", 30)),
+        )
+    engine = create_engine(url, echo=echo_flag, future=True, **pool_options)
+    _instrument_engine(engine)
+    if engine.dialect.name == "sqlite":
+        pragmas = _sqlite_pragmas(getattr(config_database, "sqlite", None))
+
+        @event.listens_for(engine, "connect")
+        def _apply_sqlite_pragmas(dbapi_connection, _connection_record) -> None:
+            cursor = dbapi_connection.cursor()
+            try:
+                for pragma in pragmas:
+                    cursor.execute(pragma)
+            finally:
+                cursor.close()
+
+    return engine
+
 
-echo_flag = bool(getattr(config_database.database, "echo", False))
-engine = create_engine(DATABASE_URL, echo=echo_flag, future=True)
-SessionLocal = sessionmaker(bind=engine, expire_on_commit=False, autoflush=False)
+_engine = None
+_engine_lock = threading.Lock()
+# Bound by get_engine() when the engine is first built.
+SessionLocal = sessionmaker(expire_on_commit=False, autoflush=False)
+
+
+def get_engine():
+    """Return the shared engine, creating it (and the SQLite directory) on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = _build_engine()
+                SessionLocal.configure(bind=engine)
+                _engine = engine
+    return _engine
 
 
 class User(Base):
     __tablename__ = "users"
-    __table_args__ = (UniqueConstraint("telegram_id", name="uq_users_telegram_id"),)
+    __table_args__ = (
+        UniqueConstraint("telegram_id", name="uq_users_telegram_id"),
+        Index("ix_users_created_at_id", "created_at", "id"),
+        Index("ix_users_role", "role"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     telegram_id = Column(String(64), nullable=False)
@@ -86,6 +203,10 @@ class User(Base):
 
 class MembershipEvent(Base):
     __tablename__ = "membership_events"
+    __table_args__ = (
+        Index("ix_membership_events_chat_id_created_at", "chat_id", "created_at"),
+        Index("ix_membership_events_telegram_id", "telegram_id"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     telegram_id = Column(String(64), nullable=False)
@@ -95,10 +216,127 @@ class MembershipEvent(Base):
     event = Column(String(16), nullable=False)
     created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
 
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "telegram_id": self.telegram_id,
+            "chat_id": self.chat_id,
+            "chat_title": self.chat_title,
+            "username": self.username,
+            "event": self.event,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+        }
+
+
+class MembershipDailyStat(Base):
+    """Per-chat daily join/leave counters, kept in step with ``membership_events``.
+
+    ``joins_left`` counts the joins of that day whose member has left since,
+    which is what retention over a range is computed from.
+    """
+
+    __tablename__ = "membership_daily_stats"
+    __table_args__ = (UniqueConstraint("chat_id", "day", name="uq_membership_daily_stats_chat_day"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(String(64), nullable=False)
+    day = Column(Date, nullable=False)
+    joins = Column(Integer, nullable=False, default=0)
+    leaves = Column(Integer, nullable=False, default=0)
+    joins_left = Column(Integer, nullable=False, default=0)
+
+
+class StoredFile(Base):
+    __tablename__ = "stored_files"
+    __table_args__ = (UniqueConstraint("file_unique_id", name="uq_stored_files_file_unique_id"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    file_unique_id = Column(String(128), nullable=False)
+    sha256 = Column(String(64), nullable=False, index=True)
+    size = Column(BigInteger, nullable=False)
+    storage_path = Column(String(512), nullable=False)
+    file_name = Column(String(255), nullable=True)
+    mime_type = Column(String(128), nullable=True)
+    uploaded_by = Column(String(64), nullable=True, index=True)
+    chat_id = Column(String(64), nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "file_unique_id": self.file_unique_id,
+            "sha256": self.sha256,
+            "size": self.size,
+            "storage_path": self.storage_path,
+            "file_name": self.file_name,
+            "mime_type": self.mime_type,
+            "uploaded_by": self.uploaded_by,
+            "chat_id": self.chat_id,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+        }
+
+
+class TwitterHandleState(Base):
+    __tablename__ = "twitter_handle_state"
+
+    handle = Column(String(64), primary_key=True)
+    since_id = Column(String(32), nullable=True)
+    last_fetched_at = Column(DateTime, nullable=True)
+    last_changed_at = Column(DateTime, nullable=True)
+
+    def to_dict(self) -> Dict[str, Optional[str]]:
+        return {
+            "handle": self.handle,
+            "since_id": self.since_id,
+            "last_fetched_at": self.last_fetched_at.isoformat() if self.last_fetched_at else None,
+            "last_changed_at": self.last_changed_at.isoformat() if self.last_changed_at else None,
+        }
+
+
+class TwitterChatCursor(Base):
+    __tablename__ = "twitter_chat_cursors"
+    __table_args__ = (UniqueConstraint("handle", "chat_id", name="uq_twitter_chat_cursors_handle_chat"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    handle = Column(String(64), nullable=False)
+    chat_id = Column(String(64), nullable=False)
+    last_tweet_id = Column(String(32), nullable=False)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class JobCursor(Base):
+    """Where a periodic job stopped, so its next run resumes there."""
+
+    __tablename__ = "job_cursors"
+
+    name = Column(String(64), primary_key=True)
+    position = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class RoleCount(Base):
+    """Number of users holding each role, kept in step with ``users``."""
+
+    __tablename__ = "role_counts"
+
+    role = Column(String(32), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+def _dialect_insert():
+    """Return the ``insert`` construct that supports ``ON CONFLICT`` for the configured database."""
+    if get_engine().dialect.name == "postgresql":
+        # Imported here: the PostgreSQL dialect is slow to import and SQLite deployments never need it.
+        from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+
+        return postgresql_insert
+    return sqlite_insert
+
 
 @contextmanager
 def session_scope() -> Iterator[SessionLocal]:  # type: ignore[type-arg]
+    get_engine()
     session = SessionLocal()
+    started = time.perf_counter()
     try:
         yield session
         session.commit()
@@ -107,31 +345,67 @@ def session_scope() -> Iterator[SessionLocal]:  # type: ignore[type-arg]
         raise
     finally:
         session.close()
+        DB_SESSION_SECONDS.observe(time.perf_counter() - started)
+
+
+def init_db() -> None:
+    migrate(get_engine(), Base.metadata)
 
 
-def _ensure_sqlite_schema() -> None:
-    if not DATABASE_URL.startswith("sqlite:///"):
+def _adjust_role_count(session, role: Optional[str], delta: int) -> None:
+    if not role or not delta:
         return
+    result = session.execute(
+        update(RoleCount).where(RoleCount.role == role).values(count=RoleCount.count + delta)
+    )
+    if result.rowcount == 0:
+        session.add(RoleCount(role=role, count=max(0, delta)))
+        session.flush()
 
-    with engine.begin() as connection:
-        columns = {
-            row[1]
-            for row in connection.execute(text("PRAGMA table_info(users)"))
-        }
-        column_defs = {
-            "first_name": "TEXT",
-            "last_name": "TEXT",
-            "is_active": "INTEGER DEFAULT 1",
-            "left_at": "DATETIME",
-        }
-        for column, definition in column_defs.items():
-            if column not in columns:
-                connection.execute(text(f"ALTER TABLE users ADD COLUMN {column} {definition}"))
 
+def count_users_with_role(role: str) -> int:
+    with session_scope() as session:
+        row = session.get(RoleCount, role)
+        return row.count if row else 0
 
-def init_db() -> None:
-    Base.metadata.create_all(bind=engine)
-    _ensure_sqlite_schema()
+
+def claim_first_admin(telegram_id: int) -> Optional[Dict[str, Optional[str]]]:
+    """Promote ``telegram_id`` to admin if, and only if, there is no admin yet.
+
+    The admin count is bumped with a conditional ``UPDATE ... WHERE count = 0``
+    so exactly one of several concurrent registrations wins. Returns the
+    updated record for the winner and ``None`` otherwise.
+    """
+    telegram_id_str = str(telegram_id)
+    with session_scope() as session:
+        user = session.query(User).filter_by(telegram_id=telegram_id_str).one_or_none()
+        if user is None or user.role == "admin":
+            return None
+        claimed = session.execute(
+            update(RoleCount).where(RoleCount.role == "admin", RoleCount.count == 0).values(count=1)
+        ).rowcount
+        if not claimed:
+            return None
+        _adjust_role_count(session, user.role, -1)
+        user.role = "admin"
+        session.flush()
+        session.refresh(user)
+        record = user.to_dict()
+    user_cache.invalidate(telegram_id_str)
+    return record
+
+
+def _apply_profile(
+    user: User,
+    username: Optional[str],
+    first_name: Optional[str],
+    last_name: Optional[str],
+) -> None:
+    user.username = username or user.username
+    user.first_name = first_name or user.first_name
+    user.last_name = last_name or user.last_name
+    user.is_active = True
+    user.left_at = None
 
 
 def add_or_update_user(
@@ -145,13 +419,11 @@ def add_or_update_user(
     with session_scope() as session:
         user: Optional[User] = session.query(User).filter_by(telegram_id=telegram_id_str).one_or_none()
         if user:
-            user.username = username or user.username
-            user.first_name = first_name or user.first_name
-            user.last_name = last_name or user.last_name
-            if role:
+            _apply_profile(user, username, first_name, last_name)
+            if role and role != user.role:
+                _adjust_role_count(session, user.role, -1)
+                _adjust_role_count(session, role, 1)
                 user.role = role
-            user.is_active = True
-            user.left_at = None
         else:
             user = User(
                 telegram_id=telegram_id_str,
@@ -162,15 +434,36 @@ def add_or_update_user(
                 is_active=True,
             )
             session.add(user)
+            _adjust_role_count(session, user.role, 1)
         session.flush()
         session.refresh(user)
-        return user.to_dict()
+        record = user.to_dict()
+    user_cache.invalidate(telegram_id_str)
+    return record
 
 
-def get_user_by_id(telegram_id: int) -> Optional[Dict[str, Optional[str]]]:
+# Sentinel distinguishing "not cached" from a cached "no such user".
+_CACHE_MISS = object()
+
+
+def _lookup_user(telegram_id: int) -> Optional[Dict[str, Optional[str]]]:
+    """Return the cached user record (shared, do not mutate) or load it."""
+    key = str(telegram_id)
+    cached = user_cache.get(key, _CACHE_MISS)
+    if cached is not _CACHE_MISS:
+        return cached
+    # Taken before the read, so a write committed meanwhile keeps its invalidation.
+    token = user_cache.token()
     with session_scope() as session:
-        user = session.query(User).filter_by(telegram_id=str(telegram_id)).one_or_none()
-        return user.to_dict() if user else None
+        user = session.query(User).filter_by(telegram_id=key).one_or_none()
+        record = user.to_dict() if user else None
+    user_cache.set(key, record, token=token)
+    return record
+
+
+def get_user_by_id(telegram_id: int) -> Optional[Dict[str, Optional[str]]]:
+    record = _lookup_user(telegram_id)
+    return dict(record) if record else None
 
 
 def set_user_role(telegram_id: int, role: str) -> Optional[Dict[str, Optional[str]]]:
@@ -178,10 +471,15 @@ def set_user_role(telegram_id: int, role: str) -> Optional[Dict[str, Optional[st
         user = session.query(User).filter_by(telegram_id=str(telegram_id)).one_or_none()
         if not user:
             return None
+        if role != user.role:
+            _adjust_role_count(session, user.role, -1)
+            _adjust_role_count(session, role, 1)
         user.role = role
         session.flush()
         session.refresh(user)
-        return user.to_dict()
+        record = user.to_dict()
+    user_cache.invalidate(str(telegram_id))
+    return record
 
 
 def list_users() -> List[Dict[str, Optional[str]]]:
@@ -190,13 +488,72 @@ def list_users() -> List[Dict[str, Optional[str]]]:
         return [user.to_dict() for user in users]
 
 
+UserCursor = Tuple[datetime, int]
+
+
+def list_users_page(
+    limit: int = 20,
+    after: Optional[UserCursor] = None,
+    before: Optional[UserCursor] = None,
+    role: Optional[str] = None,
+    active: Optional[bool] = None,
+    username_prefix: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Return one page of users ordered by ``(created_at, id)`` using keyset pagination.
+
+    ``after``/``before`` are cursors from a previous page. The result holds
+    ``users`` plus ``next``/``prev`` cursors (``None`` at either end), so the
+    cost of a page does not depend on how far into the table it is.
+    """
+    with session_scope() as session:
+        query = session.query(User)
+        if role:
+            query = query.filter(User.role == role)
+        if active is not None:
+            query = query.filter(User.is_active.is_(active))
+        if username_prefix:
+            escaped = username_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            query = query.filter(User.username.like(f"{escaped}%", escape="\\"))
+
+        backwards = before is not None
+        if backwards:
+            query = query.filter(tuple_(User.created_at, User.id) < tuple_(*before))
+            query = query.order_by(User.created_at.desc(), User.id.desc())
+        else:
+            if after is not None:
+                query = query.filter(tuple_(User.created_at, User.id) > tuple_(*after))
+            query = query.order_by(User.created_at.asc(), User.id.asc())
+
+        rows = query.limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+
+        first = (rows[0].created_at, rows[0].id) if rows else None
+        last = (rows[-1].created_at, rows[-1].id) if rows else None
+        if backwards:
+            prev_cursor = first if has_more else None
+            next_cursor = last
+        else:
+            prev_cursor = first if after is not None else None
+            next_cursor = last if has_more else None
+        return {
+            "users": [user.to_dict() for user in rows],
+            "next": next_cursor,
+            "prev": prev_cursor,
+        }
+
+
 def remove_user(telegram_id: int) -> bool:
     with session_scope() as session:
         user = session.query(User).filter_by(telegram_id=str(telegram_id)).one_or_none()
         if not user:
             return False
+        _adjust_role_count(session, user.role, -1)
         session.delete(user)
-        return True
+    user_cache.invalidate(str(telegram_id))
+    return True
 
 
 def mark_user_inactive(telegram_id: int) -> Optional[Dict[str, Optional[str]]]:
@@ -208,16 +565,71 @@ def mark_user_inactive(telegram_id: int) -> Optional[Dict[str, Optional[str]]]:
         user.left_at = datetime.utcnow()
         session.flush()
         session.refresh(user)
-        return user.to_dict()
+        record = user.to_dict()
+    user_cache.invalidate(str(telegram_id))
+    return record
 
 
 def user_has_role(telegram_id: int, *roles: str) -> bool:
-    user = get_user_by_id(telegram_id)
+    user = _lookup_user(telegram_id)
     if not user:
         return False
     return user.get("role") in roles
 
 
+# (chat_id, day) -> [joins, leaves, joins_left]
+DailyCounts = Dict[Tuple[str, date], List[int]]
+
+
+def _last_event(session, telegram_id_str: str, chat_id_str: str) -> Optional[Tuple[str, datetime]]:
+    row = (
+        session.query(MembershipEvent.event, MembershipEvent.created_at)
+        .filter(MembershipEvent.telegram_id == telegram_id_str, MembershipEvent.chat_id == chat_id_str)
+        .order_by(MembershipEvent.created_at.desc(), MembershipEvent.id.desc())
+        .first()
+    )
+    return (row[0], row[1]) if row else None
+
+
+def _count_event(
+    counts: DailyCounts,
+    chat_id_str: str,
+    event: str,
+    at: datetime,
+    previous: Optional[Tuple[str, datetime]],
+) -> None:
+    if event == "join":
+        counts.setdefault((chat_id_str, at.date()), [0, 0, 0])[0] += 1
+        return
+    counts.setdefault((chat_id_str, at.date()), [0, 0, 0])[1] += 1
+    if previous is not None and previous[0] == "join":
+        # The leave closes the member's latest join, wherever that day falls.
+        counts.setdefault((chat_id_str, previous[1].date()), [0, 0, 0])[2] += 1
+
+
+def _apply_daily_counts(session, counts: DailyCounts) -> None:
+    if not counts:
+        return
+    table = MembershipDailyStat.__table__
+    statement = _dialect_insert()(table)
+    excluded = statement.excluded
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.chat_id, table.c.day],
+        set_={
+            "joins": table.c.joins + excluded.joins,
+            "leaves": table.c.leaves + excluded.leaves,
+            "joins_left": table.c.joins_left + excluded.joins_left,
+        },
+    )
+    session.execute(
+        statement,
+        [
+            {"chat_id": chat_id, "day": day, "joins": joins, "leaves": leaves, "joins_left": joins_left}
+            for (chat_id, day), (joins, leaves, joins_left) in sorted(counts.items())
+        ],
+    )
+
+
 def record_membership_event(
     telegram_id: int,
     chat_id: int,
@@ -227,30 +639,499 @@ def record_membership_event(
 ) -> None:
     if event not in {"join", "leave"}:
         raise ValueError("event must be 'join' or 'leave'")
+    telegram_id_str, chat_id_str = str(telegram_id), str(chat_id)
+    now = datetime.utcnow()
+    counts: DailyCounts = {}
     with session_scope() as session:
+        previous = _last_event(session, telegram_id_str, chat_id_str) if event == "leave" else None
         session.add(
             MembershipEvent(
-                telegram_id=str(telegram_id),
-                chat_id=str(chat_id),
+                telegram_id=telegram_id_str,
+                chat_id=chat_id_str,
                 chat_title=chat_title,
                 username=username,
                 event=event,
+                created_at=now,
+            )
+        )
+        _count_event(counts, chat_id_str, event, now, previous)
+        _apply_daily_counts(session, counts)
+
+
+def membership_stats(start: date, end: date, chat_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Sum the daily rollups for ``start``..``end`` (inclusive, UTC days) per chat.
+
+    Each row has ``joins``, ``leaves``, ``net``, ``retained`` (joins in the
+    range whose member has not left) and ``retention`` (``None`` without joins).
+    """
+    with session_scope() as session:
+        query = session.query(
+            MembershipDailyStat.chat_id,
+            func.sum(MembershipDailyStat.joins),
+            func.sum(MembershipDailyStat.leaves),
+            func.sum(MembershipDailyStat.joins_left),
+        ).filter(MembershipDailyStat.day >= start, MembershipDailyStat.day <= end)
+        if chat_id is not None:
+            query = query.filter(MembershipDailyStat.chat_id == str(chat_id))
+        rows = query.group_by(MembershipDailyStat.chat_id).all()
+
+    stats = []
+    for chat, joins, leaves, joins_left in rows:
+        joins, leaves, joins_left = int(joins or 0), int(leaves or 0), int(joins_left or 0)
+        retained = joins - joins_left
+        stats.append(
+            {
+                "chat_id": chat,
+                "joins": joins,
+                "leaves": leaves,
+                "net": joins - leaves,
+                "retained": retained,
+                "retention": retained / joins if joins else None,
+            }
+        )
+    stats.sort(key=lambda item: (-item["joins"], item["chat_id"]))
+    return stats
+
+
+def membership_events_before(cutoff: datetime, after_id: int = 0, limit: int = 5000) -> List[Dict[str, Any]]:
+    """Return up to ``limit`` events older than ``cutoff`` with ``id > after_id``, in id order.
+
+    Each record carries ``is_latest``: whether it is still the member's most
+    recent event in that chat, which the rollups need to match a later leave.
+    """
+    with session_scope() as session:
+        events = (
+            session.query(MembershipEvent)
+            .filter(MembershipEvent.created_at < cutoff, MembershipEvent.id > after_id)
+            .order_by(MembershipEvent.id)
+            .limit(limit)
+            .all()
+        )
+        latest: Dict[Tuple[str, str], int] = {}
+        telegram_ids = sorted({row.telegram_id for row in events})
+        for start in range(0, len(telegram_ids), _IN_CLAUSE_CHUNK):
+            chunk = telegram_ids[start:start + _IN_CLAUSE_CHUNK]
+            rows = (
+                session.query(MembershipEvent.telegram_id, MembershipEvent.chat_id, func.max(MembershipEvent.id))
+                .filter(MembershipEvent.telegram_id.in_(chunk))
+                .group_by(MembershipEvent.telegram_id, MembershipEvent.chat_id)
+            )
+            latest.update({(telegram_id, chat_id): max_id for telegram_id, chat_id, max_id in rows})
+        records = []
+        for row in events:
+            record = row.to_dict()
+            record["is_latest"] = latest.get((row.telegram_id, row.chat_id)) == row.id
+            records.append(record)
+        return records
+
+
+def superseded_membership_events(pairs: Sequence[Tuple[str, str]], up_to_id: int) -> List[Dict[str, Any]]:
+    """Return the events with ``id <= up_to_id`` of the given ``(telegram_id, chat_id)`` pairs.
+
+    The retention job calls this with pairs that have a newer event, so
+    every returned event is no longer its member's latest.
+    """
+    wanted = set(pairs)
+    records: List[Dict[str, Any]] = []
+    with session_scope() as session:
+        telegram_ids = sorted({telegram_id for telegram_id, _chat_id in wanted})
+        for start in range(0, len(telegram_ids), _IN_CLAUSE_CHUNK):
+            chunk = telegram_ids[start:start + _IN_CLAUSE_CHUNK]
+            events = (
+                session.query(MembershipEvent)
+                .filter(MembershipEvent.telegram_id.in_(chunk), MembershipEvent.id <= up_to_id)
+                .order_by(MembershipEvent.id)
+            )
+            records.extend(
+                {**row.to_dict(), "is_latest": False}
+                for row in events
+                if (row.telegram_id, row.chat_id) in wanted
+            )
+    return records
+
+
+def delete_membership_events(event_ids: Sequence[int]) -> int:
+    deleted = 0
+    with session_scope() as session:
+        for start in range(0, len(event_ids), _IN_CLAUSE_CHUNK):
+            chunk = list(event_ids[start:start + _IN_CLAUSE_CHUNK])
+            deleted += (
+                session.query(MembershipEvent)
+                .filter(MembershipEvent.id.in_(chunk))
+                .delete(synchronize_session=False)
+            )
+    return deleted
+
+
+def get_job_cursor(name: str) -> int:
+    with session_scope() as session:
+        cursor = session.get(JobCursor, name)
+        return int(cursor.position) if cursor else 0
+
+
+def set_job_cursor(name: str, position: int) -> None:
+    with session_scope() as session:
+        cursor = session.get(JobCursor, name)
+        if cursor is None:
+            session.add(JobCursor(name=name, position=position))
+        else:
+            cursor.position = position
+
+
+def has_membership_rollups() -> bool:
+    with session_scope() as session:
+        return session.query(MembershipDailyStat.id).first() is not None
+
+
+def rebuild_membership_rollups(since: Optional[date] = None, chunk_size: int = 10_000) -> int:
+    """Recompute the daily rollups from raw events, for every day from ``since`` on.
+
+    Events are streamed in ``(chat, member, time)`` order so memory stays
+    bounded by the number of chat-days. Leaves whose join predates ``since``
+    only count as leaves. Once the retention job has archived old events,
+    pass a ``since`` after the retention cutoff so archived days are kept.
+    The rollup rows are replaced wholesale, so this must not run while
+    membership events are being recorded. Returns the number of events read.
+    """
+    counts: DailyCounts = {}
+    read = 0
+    with session_scope() as session:
+        query = session.query(
+            MembershipEvent.chat_id, MembershipEvent.telegram_id, MembershipEvent.event, MembershipEvent.created_at
+        ).order_by(
+            MembershipEvent.chat_id, MembershipEvent.telegram_id, MembershipEvent.created_at, MembershipEvent.id
+        )
+        if since is not None:
+            query = query.filter(MembershipEvent.created_at >= datetime.combine(since, datetime.min.time()))
+
+        member: Optional[Tuple[str, str]] = None
+        previous: Optional[Tuple[str, datetime]] = None
+        for chat_id_str, telegram_id_str, kind_of_event, created_at in query.yield_per(chunk_size):
+            if member != (chat_id_str, telegram_id_str):
+                member, previous = (chat_id_str, telegram_id_str), None
+            _count_event(counts, chat_id_str, kind_of_event, created_at, previous)
+            previous = (kind_of_event, created_at)
+            read += 1
+
+        deletion = session.query(MembershipDailyStat)
+        if since is not None:
+            deletion = deletion.filter(MembershipDailyStat.day >= since)
+        deletion.delete(synchronize_session=False)
+        session.flush()
+        _apply_daily_counts(session, counts)
+    return read
+
+
+def get_stored_file(file_unique_id: str) -> Optional[Dict[str, Any]]:
+    with session_scope() as session:
+        stored = session.query(StoredFile).filter_by(file_unique_id=file_unique_id).one_or_none()
+        return stored.to_dict() if stored else None
+
+
+def record_stored_file(
+    file_unique_id: str,
+    sha256: str,
+    size: int,
+    storage_path: str,
+    file_name: Optional[str] = None,
+    mime_type: Optional[str] = None,
+    uploaded_by: Optional[int] = None,
+    chat_id: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Index a stored blob under its Telegram ``file_unique_id``.
+
+    If another upload indexed the same id concurrently, that record wins and
+    is returned instead.
+    """
+    try:
+        with session_scope() as session:
+            stored = StoredFile(
+                file_unique_id=file_unique_id,
+                sha256=sha256,
+                size=size,
+                storage_path=storage_path,
+                file_name=file_name,
+                mime_type=mime_type,
+                uploaded_by=str(uploaded_by) if uploaded_by is not None else None,
+                chat_id=str(chat_id) if chat_id is not None else None,
             )
+            session.add(stored)
+            session.flush()
+            return stored.to_dict()
+    except IntegrityError:
+        existing = get_stored_file(file_unique_id)
+        if existing is None:
+            raise
+        return existing
+
+
+def get_user_storage_usage(telegram_id: int) -> int:
+    """Total bytes indexed for uploads made by ``telegram_id``."""
+    with session_scope() as session:
+        total = (
+            session.query(func.coalesce(func.sum(StoredFile.size), 0))
+            .filter(StoredFile.uploaded_by == str(telegram_id))
+            .scalar()
         )
+        return int(total or 0)
+
+
+def get_twitter_state(handle: str) -> Optional[Dict[str, Optional[str]]]:
+    with session_scope() as session:
+        state = session.get(TwitterHandleState, handle.lower())
+        return state.to_dict() if state else None
+
+
+def save_twitter_state(handle: str, since_id: Optional[str], changed: bool) -> None:
+    """Record a timeline fetch; ``since_id`` only moves forward."""
+    now = datetime.utcnow()
+    with session_scope() as session:
+        state = session.get(TwitterHandleState, handle.lower())
+        if state is None:
+            state = TwitterHandleState(handle=handle.lower())
+            session.add(state)
+        if since_id and (not state.since_id or int(since_id) > int(state.since_id)):
+            state.since_id = since_id
+        state.last_fetched_at = now
+        if changed:
+            state.last_changed_at = now
+
+
+def get_twitter_cursor(handle: str, chat_id: int) -> Optional[str]:
+    with session_scope() as session:
+        cursor = (
+            session.query(TwitterChatCursor)
+            .filter_by(handle=handle.lower(), chat_id=str(chat_id))
+            .one_or_none()
+        )
+        return cursor.last_tweet_id if cursor else None
+
+
+def set_twitter_cursor(handle: str, chat_id: int, tweet_id: str) -> None:
+    with session_scope() as session:
+        cursor = (
+            session.query(TwitterChatCursor)
+            .filter_by(handle=handle.lower(), chat_id=str(chat_id))
+            .one_or_none()
+        )
+        if cursor is None:
+            session.add(TwitterChatCursor(handle=handle.lower(), chat_id=str(chat_id), last_tweet_id=tweet_id))
+        elif int(tweet_id) > int(cursor.last_tweet_id):
+            cursor.last_tweet_id = tweet_id
+
+
+# SQLite refuses statements with more than 999 bound parameters on older builds.
+_IN_CLAUSE_CHUNK = 500
+
+
+def _load_users(session, telegram_ids: Sequence[str]) -> Dict[str, User]:
+    users: Dict[str, User] = {}
+    for start in range(0, len(telegram_ids), _IN_CLAUSE_CHUNK):
+        chunk = telegram_ids[start:start + _IN_CLAUSE_CHUNK]
+        for user in session.query(User).filter(User.telegram_id.in_(chunk)):
+            users[user.telegram_id] = user
+    return users
+
+
+def apply_membership_batch(operations: Sequence[Tuple[str, Dict[str, Any]]]) -> int:
+    """Apply queued user upserts, departures and membership events in one transaction.
+
+    ``operations`` is an ordered list of ``(kind, payload)`` pairs where kind is
+    ``"upsert"``, ``"inactive"`` or ``"event"``; payloads carry the same keyword
+    arguments as :func:`add_or_update_user`, :func:`mark_user_inactive` and
+    :func:`record_membership_event`. ``"inactive"`` and ``"event"`` payloads
+    may carry ``at``, the UTC time the change happened, which is used instead
+    of the time of the flush. Returns the number of operations applied.
+    """
+    if not operations:
+        return 0
+
+    telegram_ids = sorted(
+        {str(payload["telegram_id"]) for kind, payload in operations if kind in {"upsert", "inactive"}}
+    )
+    with session_scope() as session:
+        users = _load_users(session, telegram_ids)
+        new_users: Dict[str, Dict[str, Any]] = {}
+        for kind, payload in operations:
+            telegram_id_str = str(payload["telegram_id"])
+            if kind == "upsert" and telegram_id_str not in users and telegram_id_str not in new_users:
+                new_users[telegram_id_str] = {
+                    "telegram_id": telegram_id_str,
+                    "username": payload.get("username"),
+                    "first_name": payload.get("first_name"),
+                    "last_name": payload.get("last_name"),
+                    "role": "member",
+                    "is_active": True,
+                }
+        created = 0
+        if new_users:
+            # Another process may insert the same member meanwhile (multi-process mode);
+            # only the rows this statement actually inserted count as created.
+            statement = (
+                _dialect_insert()(User.__table__)
+                .on_conflict_do_nothing(index_elements=["telegram_id"])
+                .returning(User.__table__.c.telegram_id)
+            )
+            created = len(session.execute(statement, list(new_users.values())).all())
+            users.update(_load_users(session, list(new_users)))
+
+        events: List[MembershipEvent] = []
+        counts: DailyCounts = {}
+        last_seen: Dict[Tuple[str, str], Tuple[str, datetime]] = {}
+        for kind, payload in operations:
+            telegram_id_str = str(payload["telegram_id"])
+            if kind == "upsert":
+                _apply_profile(
+                    users[telegram_id_str], payload.get("username"), payload.get("first_name"), payload.get("last_name")
+                )
+            elif kind == "inactive":
+                user = users.get(telegram_id_str)
+                if user is not None:
+                    user.is_active = False
+                    user.left_at = payload.get("at") or datetime.utcnow()
+            elif kind == "event":
+                chat_id_str = str(payload["chat_id"])
+                kind_of_event, happened_at = payload["event"], payload.get("at") or datetime.utcnow()
+                key = (telegram_id_str, chat_id_str)
+                previous = None
+                if kind_of_event == "leave":
+                    previous = last_seen[key] if key in last_seen else _last_event(session, *key)
+                last_seen[key] = (kind_of_event, happened_at)
+                _count_event(counts, chat_id_str, kind_of_event, happened_at, previous)
+                events.append(
+                    MembershipEvent(
+                        telegram_id=telegram_id_str,
+                        chat_id=chat_id_str,
+                        chat_title=payload.get("chat_title"),
+                        username=payload.get("username"),
+                        event=kind_of_event,
+                        created_at=happened_at,
+                    )
+                )
+            else:
+                raise ValueError(f"Unknown batch operation: {kind}")
+        session.add_all(events)
+        _apply_daily_counts(session, counts)
+        _adjust_role_count(session, "member", created)
+    for telegram_id_str in telegram_ids:
+        user_cache.invalidate(telegram_id_str)
+    return len(operations)
+
+
+def _upsert_statement():
+    # Built without values so it compiles once and runs as executemany per chunk.
+    statement = _dialect_insert()(User.__table__)
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=[User.telegram_id],
+        set_={
+            "username": func.coalesce(excluded.username, User.username),
+            "first_name": func.coalesce(excluded.first_name, User.first_name),
+            "last_name": func.coalesce(excluded.last_name, User.last_name),
+            "role": excluded.role,
+            "is_active": True,
+            "left_at": None,
+            "updated_at": excluded.updated_at,
+        },
+    )
+
+
+def bulk_upsert_users(records: Sequence[Dict[str, Any]]) -> Dict[str, int]:
+    """Insert or refresh many users with a single ``INSERT ... ON CONFLICT`` statement.
+
+    Each record carries ``telegram_id`` and optionally ``username``,
+    ``first_name``, ``last_name`` and ``role``; existing users keep their role
+    unless one is given. Later duplicates of a ``telegram_id`` win. Returns
+    ``{"inserted": n, "updated": m}``.
+    """
+    latest: Dict[str, Dict[str, Any]] = {}
+    for record in records:
+        latest[str(record["telegram_id"])] = record
+    telegram_ids = list(latest)
+
+    inserted = updated = 0
+    statement = _upsert_statement()
+    with session_scope() as session:
+        for start in range(0, len(telegram_ids), _IN_CLAUSE_CHUNK):
+            chunk = telegram_ids[start:start + _IN_CLAUSE_CHUNK]
+            existing = dict(
+                session.query(User.telegram_id, User.role).filter(User.telegram_id.in_(chunk)).all()
+            )
+            now = datetime.utcnow()
+            role_deltas: Counter = Counter()
+            rows = []
+            for telegram_id_str in chunk:
+                record = latest[telegram_id_str]
+                old_role = existing.get(telegram_id_str)
+                role = record.get("role") or old_role or "member"
+                if old_role is None:
+                    inserted += 1
+                    role_deltas[role] += 1
+                else:
+                    updated += 1
+                    if role != old_role:
+                        role_deltas[old_role] -= 1
+                        role_deltas[role] += 1
+                rows.append(
+                    {
+                        "telegram_id": telegram_id_str,
+                        "username": record.get("username"),
+                        "first_name": record.get("first_name"),
+                        "last_name": record.get("last_name"),
+                        "role": role,
+                        "is_active": True,
+                        "created_at": now,
+                        "updated_at": now,
+                    }
+                )
+            session.execute(statement, rows)
+            for role, delta in role_deltas.items():
+                _adjust_role_count(session, role, delta)
+    for telegram_id_str in telegram_ids:
+        user_cache.invalidate(telegram_id_str)
+    return {"inserted": inserted, "updated": updated}
 
 
 __all__ = [
     "User",
     "MembershipEvent",
-    "engine",
+    "MembershipDailyStat",
+    "StoredFile",
+    "TwitterHandleState",
+    "TwitterChatCursor",
+    "JobCursor",
+    "RoleCount",
     "SessionLocal",
+    "get_engine",
     "init_db",
     "add_or_update_user",
     "get_user_by_id",
     "set_user_role",
     "list_users",
+    "list_users_page",
+    "UserCursor",
     "remove_user",
     "user_has_role",
+    "count_users_with_role",
+    "claim_first_admin",
     "mark_user_inactive",
     "record_membership_event",
+    "membership_stats",
+    "has_membership_rollups",
+    "rebuild_membership_rollups",
+    "membership_events_before",
+    "superseded_membership_events",
+    "delete_membership_events",
+    "get_job_cursor",
+    "set_job_cursor",
+    "apply_membership_batch",
+    "bulk_upsert_users",
+    "user_cache",
+    "get_stored_file",
+    "record_stored_file",
+    "get_user_storage_usage",
+    "get_twitter_state",
+    "save_twitter_state",
+    "get_twitter_cursor",
+    "set_twitter_cursor",
 ]
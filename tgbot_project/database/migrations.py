@@ -0,0 +1,120 @@
+﻿"""Versioned schema migrations for SQLite and PostgreSQL."""
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy import MetaData, func, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+
+from ..logger.logger import get_logger
+
+logger = get_logger("database.migrations")
+
+MigrationStep = Callable[[Connection, MetaData], None]
+
+# Columns that were added to ``users`` after the first releases.
+_LEGACY_USER_COLUMNS: Dict[str, Dict[str, str]] = {
+    "sqlite": {
+        "first_name": "TEXT",
+        "last_name": "TEXT",
+        "is_active": "INTEGER DEFAULT 1",
+        "left_at": "DATETIME",
+    },
+    "postgresql": {
+        "first_name": "VARCHAR(255)",
+        "last_name": "VARCHAR(255)",
+        "is_active": "BOOLEAN DEFAULT TRUE",
+        "left_at": "TIMESTAMP",
+    },
+}
+
+_CREATE_VERSION_TABLE = (
+    "CREATE TABLE IF NOT EXISTS schema_version ("
+    "version INTEGER PRIMARY KEY, description VARCHAR(255) NOT NULL, applied_at TIMESTAMP NOT NULL)"
+)
+
+
+def _create_indexes(connection: Connection, metadata: MetaData, table_name: str) -> None:
+    for index in metadata.tables[table_name].indexes:
+        index.create(bind=connection, checkfirst=True)
+
+
+def _baseline(connection: Connection, metadata: MetaData) -> None:
+    # Databases created before versioning may lack tables, columns or indexes.
+    metadata.create_all(bind=connection)
+    columns = {column["name"] for column in inspect(connection).get_columns("users")}
+    for column, definition in _LEGACY_USER_COLUMNS.get(connection.dialect.name, {}).items():
+        if column not in columns:
+            connection.execute(text(f"ALTER TABLE users ADD COLUMN {column} {definition}"))
+    for table_name in ("users", "stored_files", "twitter_chat_cursors"):
+        _create_indexes(connection, metadata, table_name)
+
+
+def _seed_role_counts(connection: Connection, metadata: MetaData) -> None:
+    users = metadata.tables["users"]
+    role_counts = metadata.tables["role_counts"]
+    if connection.execute(select(role_counts.c.role).limit(1)).first() is not None:
+        return
+    counts = dict(connection.execute(select(users.c.role, func.count()).group_by(users.c.role)).all())
+    for role in ("admin", "member"):
+        counts.setdefault(role, 0)
+    connection.execute(role_counts.insert(), [{"role": role, "count": count} for role, count in counts.items()])
+
+
+def _index_membership_events(connection: Connection, metadata: MetaData) -> None:
+    _create_indexes(connection, metadata, "membership_events")
+
+
+def _create_membership_rollups(connection: Connection, metadata: MetaData) -> None:
+    # Filled by the backfill job scheduled from commands.stats.
+    metadata.tables["membership_daily_stats"].create(bind=connection, checkfirst=True)
+
+
+def _create_job_cursors(connection: Connection, metadata: MetaData) -> None:
+    metadata.tables["job_cursors"].create(bind=connection, checkfirst=True)
+
+
+# Append new steps at the end; never renumber or edit an applied one.
+MIGRATIONS: List[Tuple[int, str, MigrationStep]] = [
+    (1, "baseline schema", _baseline),
+    (2, "seed role counts", _seed_role_counts),
+    (3, "index membership events by chat and user", _index_membership_events),
+    (4, "create membership daily rollups", _create_membership_rollups),
+    (5, "create job cursors", _create_job_cursors),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection: Connection) -> int:
+    connection.execute(text(_CREATE_VERSION_TABLE))
+    return connection.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+
+
+def migrate(engine: Engine, metadata: MetaData) -> int:
+    """Bring the schema up to :data:`LATEST_VERSION`; returns the resulting version.
+
+    An up-to-date database costs one query. Each pending step runs in its own
+    transaction together with its ``schema_version`` row.
+    """
+    with engine.begin() as connection:
+        version = current_version(connection)
+    if version >= LATEST_VERSION:
+        return version
+
+    for number, description, step in MIGRATIONS:
+        if number <= version:
+            continue
+        with engine.begin() as connection:
+            logger.info("Applying schema migration %d: %s", number, description)
+            step(connection, metadata)
+            connection.execute(
+                text("INSERT INTO schema_version (version, description, applied_at) VALUES (:v, :d, :t)"),
+                {"v": number, "d": description, "t": datetime.utcnow()},
+            )
+        version = number
+    return version
+
+
+__all__ = ["LATEST_VERSION", "MIGRATIONS", "current_version", "migrate"]
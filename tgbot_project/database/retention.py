@@ -0,0 +1,148 @@
+﻿"""Retention policy for raw membership events: archive to gzip JSONL, then delete."""
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from ..config import config_database
+from ..logger.logger import get_logger
+from .db import (
+    delete_membership_events,
+    get_job_cursor,
+    has_membership_rollups,
+    membership_events_before,
+    set_job_cursor,
+    superseded_membership_events,
+)
+
+logger = get_logger("database.retention")
+
+_PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+# job_cursors row holding the highest event id already scanned.
+CURSOR_NAME = "membership_event_retention"
+
+
+class EventArchiver:
+    """Move membership events older than ``keep_days`` out of the hot table.
+
+    Events are appended to one gzip JSONL file per month (each run adds a new
+    gzip member, which ``zcat`` and :func:`gzip.open` read transparently) and
+    deleted in batches of ``batch_size``, one transaction per batch. A
+    member's latest event in a chat is kept, because the daily rollups need it
+    to attribute a later leave to its join. Lines carry the event ``id``, so a
+    batch re-archived after a crash can be de-duplicated.
+
+    Each run resumes after the highest id scanned before (kept in
+    ``job_cursors``), so its cost follows the new events, not the history. A
+    kept event is archived once a newer event of the same member and chat
+    is scanned, i.e. when that one ages past ``keep_days`` too.
+    """
+
+    def __init__(
+        self,
+        archive_dir: Path,
+        keep_days: int = 90,
+        batch_size: int = 5000,
+        max_batches: int = 200,
+        pause_seconds: float = 0.1,
+    ) -> None:
+        self.archive_dir = Path(archive_dir)
+        self.keep_days = max(1, int(keep_days))
+        self.batch_size = max(1, int(batch_size))
+        self.max_batches = max(1, int(max_batches))
+        self.pause_seconds = float(pause_seconds)
+
+    def run(self, now: Optional[datetime] = None) -> Dict[str, int]:
+        """Archive and delete one bounded pass of old events; returns counters."""
+        totals = {"archived": 0, "kept": 0, "batches": 0}
+        if not has_membership_rollups():
+            # Deleting before the backfill has run would lose those days from /stats.
+            logger.info("Skipping event retention until the membership rollups are built")
+            return totals
+
+        cutoff = (now or datetime.utcnow()) - timedelta(days=self.keep_days)
+        after_id = get_job_cursor(CURSOR_NAME)
+        while totals["batches"] < self.max_batches:
+            events = membership_events_before(cutoff, after_id=after_id, limit=self.batch_size)
+            if not events:
+                break
+            # Events kept by earlier runs whose member has moved on since.
+            pairs = sorted({(event["telegram_id"], event["chat_id"]) for event in events})
+            superseded = superseded_membership_events(pairs, up_to_id=after_id) if after_id else []
+            expired = superseded + [event for event in events if not event["is_latest"]]
+            totals["kept"] += sum(1 for event in events if event["is_latest"])
+            if expired:
+                self._archive(expired)
+                totals["archived"] += delete_membership_events([event["id"] for event in expired])
+            after_id = events[-1]["id"]
+            set_job_cursor(CURSOR_NAME, after_id)
+            totals["batches"] += 1
+            if len(events) < self.batch_size:
+                break
+            time.sleep(self.pause_seconds)
+
+        if totals["archived"]:
+            logger.info(
+                "Archived %d membership events older than %s (%d kept as member state)",
+                totals["archived"],
+                cutoff.date().isoformat(),
+                totals["kept"],
+            )
+        return totals
+
+    def tick(self, context: Any = None) -> None:
+        """Job-queue callback."""
+        try:
+            self.run()
+        except Exception:
+            logger.exception("Membership event retention failed")
+
+    def _archive(self, events: List[Dict[str, Any]]) -> None:
+        by_month: Dict[str, List[Dict[str, Any]]] = {}
+        for event in events:
+            by_month.setdefault(event["created_at"][:7], []).append(event)
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        for month, items in sorted(by_month.items()):
+            path = self.archive_dir / f"membership_events-{month}.jsonl.gz"
+            with open(path, "ab") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as archive:
+                for item in items:
+                    line = {key: value for key, value in item.items() if key != "is_latest"}
+                    archive.write(json.dumps(line, ensure_ascii=False).encode("utf-8") + b"\n")
+                archive.flush()
+            # The rows are deleted right after this, so the archive must be durable first.
+            with open(path, "rb") as written:
+                os.fsync(written.fileno())
+
+
+def _build_event_archiver() -> Optional[EventArchiver]:
+    conf = getattr(config_database, "retention", None)
+    if not getattr(conf, "enabled", False):
+        return None
+    return EventArchiver(
+        (_PROJECT_ROOT / getattr(conf, "archive_dir", "../data/archive")).resolve(),
+        keep_days=getattr(conf, "keep_days", 90),
+        batch_size=getattr(conf, "batch_size", 5000),
+        max_batches=getattr(conf, "max_batches", 200),
+        pause_seconds=getattr(conf, "pause_seconds", 0.1),
+    )
+
+
+def schedule_event_retention(job_queue: Any) -> Optional[EventArchiver]:
+    """Register the periodic retention job when enabled in config."""
+    archiver = _build_event_archiver()
+    if archiver is None:
+        return None
+    conf = getattr(config_database, "retention", None)
+    interval = float(getattr(conf, "interval_hours", 24)) * 3600
+    job_queue.run_repeating(archiver.tick, interval=interval, first=60, name="event_retention")
+    logger.info("Membership events older than %d days will be archived to %s", archiver.keep_days, archiver.archive_dir)
+    return archiver
+
+
+__all__ = ["EventArchiver", "schedule_event_retention"]
@@ -0,0 +1,171 @@
+﻿"""Write-behind queue that batches membership writes into shared transactions."""
+from __future__ import annotations
+
+import atexit
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..config import config_database
+from ..logger.logger import get_logger
+from ..monitoring.metrics import registry
+from .db import apply_membership_batch
+
+logger = get_logger("database.write_behind")
+
+Operation = Tuple[str, Dict[str, Any]]
+
+
+class WriteBehindQueue:
+    """Collect user upserts and membership events and flush them in batches.
+
+    A background thread flushes whenever ``batch_size`` operations are pending
+    or ``flush_interval`` seconds have passed. While the queue is not running
+    every call is applied synchronously, so callers never need to care which
+    mode is active. Departures and events are stamped when they are queued,
+    so a late flush or a retry does not move them to another day.
+    """
+
+    def __init__(self, batch_size: int = 200, flush_interval: float = 0.5, max_pending: int = 5000) -> None:
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0.01, float(flush_interval))
+        self.max_pending = max(self.batch_size, int(max_pending))
+        self._pending: List[Operation] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._atexit_registered = False
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        if not self._atexit_registered:
+            atexit.register(self.stop)
+            self._atexit_registered = True
+        logger.info(
+            "Write-behind queue started (batch_size=%s, flush_interval=%ss)", self.batch_size, self.flush_interval
+        )
+
+    def stop(self, timeout: Optional[float] = 10.0) -> None:
+        """Stop the worker thread and drain everything still pending."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        thread.join(timeout)
+        self._thread = None
+        self.flush()
+        logger.info("Write-behind queue stopped")
+
+    def upsert_user(
+        self,
+        telegram_id: int,
+        username: Optional[str],
+        first_name: Optional[str] = None,
+        last_name: Optional[str] = None,
+    ) -> None:
+        self._submit(
+            "upsert",
+            {"telegram_id": telegram_id, "username": username, "first_name": first_name, "last_name": last_name},
+        )
+
+    def mark_inactive(self, telegram_id: int) -> None:
+        self._submit("inactive", {"telegram_id": telegram_id, "at": datetime.utcnow()})
+
+    def record_event(
+        self,
+        telegram_id: int,
+        chat_id: int,
+        event: str,
+        chat_title: Optional[str] = None,
+        username: Optional[str] = None,
+    ) -> None:
+        if event not in {"join", "leave"}:
+            raise ValueError("event must be 'join' or 'leave'")
+        self._submit(
+            "event",
+            {
+                "telegram_id": telegram_id,
+                "chat_id": chat_id,
+                "event": event,
+                "chat_title": chat_title,
+                "username": username,
+                "at": datetime.utcnow(),
+            },
+        )
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self) -> int:
+        """Apply all pending operations; returns how many were written."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                return apply_membership_batch(batch)
+            except Exception:
+                logger.exception("Batched write of %d operations failed; retrying one by one", len(batch))
+                return self._apply_individually(batch)
+
+    def _submit(self, kind: str, payload: Dict[str, Any]) -> None:
+        if not self.running:
+            apply_membership_batch([(kind, payload)])
+            return
+
+        with self._lock:
+            self._pending.append((kind, payload))
+            size = len(self._pending)
+
+        if size >= self.max_pending:
+            # Backpressure: the writer is falling behind, so pay for the flush here.
+            self.flush()
+        elif size >= self.batch_size:
+            self._wakeup.set()
+
+    def _apply_individually(self, batch: List[Operation]) -> int:
+        written = 0
+        for operation in batch:
+            try:
+                written += apply_membership_batch([operation])
+            except Exception:
+                logger.exception("Dropping queued %s write for %s", operation[0], operation[1].get("telegram_id"))
+        return written
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:  # pragma: no cover - defensive
+                logger.exception("Write-behind flush failed")
+
+
+def _build_write_queue() -> Tuple[WriteBehindQueue, bool]:
+    conf = getattr(config_database, "write_behind", None)
+    queue = WriteBehindQueue(
+        batch_size=getattr(conf, "batch_size", 200),
+        flush_interval=getattr(conf, "flush_interval", 0.5),
+        max_pending=getattr(conf, "max_pending", 5000),
+    )
+    return queue, bool(getattr(conf, "enabled", False))
+
+
+write_queue, WRITE_BEHIND_ENABLED = _build_write_queue()
+registry.gauge("tgbot_write_behind_pending", "Membership writes waiting to be flushed.", collect=write_queue.pending)
+
+__all__ = ["WriteBehindQueue", "write_queue", "WRITE_BEHIND_ENABLED"]
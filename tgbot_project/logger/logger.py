@@ -1,38 +1,151 @@
 ﻿"""Project-wide logging helpers."""
 from __future__ import annotations
 
+import atexit
+import json
 import logging
 import logging.handlers
-import os
+import queue
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Optional
+from typing import Any, List, Optional
 
-from ..config import config_logger
+from ..config import ConfigNamespace, config_logger
 
 _LOG_ROOT = Path(config_logger.log_file).parent
 
+_handlers_lock = threading.Lock()
+_shared_handlers: Optional[List[logging.Handler]] = None
+_sinks: List[logging.Handler] = []
+_configured_loggers: List[logging.Logger] = []
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+@dataclass(frozen=True)
+class UpdateContext:
+    """Identifies the update whose handler is running in the current context."""
+
+    update_id: Optional[int]
+    chat_id: Optional[int]
+    user_id: Optional[int]
+    handler: str
+    started: float = field(default_factory=time.perf_counter)
+
+
+# Set by runtime.dispatch around every handler; read by the logging filter below.
+update_context: ContextVar[Optional[UpdateContext]] = ContextVar("update_context", default=None)
+
+CONTEXT_FIELDS = ("update_id", "chat_id", "user_id", "handler", "elapsed_ms")
+
 
 def _ensure_log_dir() -> None:
     if not _LOG_ROOT.exists():
         _LOG_ROOT.mkdir(parents=True, exist_ok=True)
 
 
-def get_logger(name: Optional[str] = None) -> logging.Logger:
-    """Return a configured logger instance."""
-    logger = logging.getLogger(name)
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records instead of blocking when the queue is full.
 
-    if getattr(logger, "_chiffon_logger_configured", False):
-        return logger
+    Once there is room again, a warning with the number of lost records is
+    queued ahead of the next record.
+    """
 
-    level = getattr(logging, config_logger.log_level.upper(), logging.INFO)
-    logger.setLevel(level)
+    def __init__(self, records: "queue.Queue[logging.LogRecord]") -> None:
+        super().__init__(records)
+        self.dropped = 0
+        self._unreported = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            if self._unreported:
+                notice = logging.makeLogRecord(
+                    {
+                        "name": __name__,
+                        "levelno": logging.WARNING,
+                        "levelname": "WARNING",
+                        "msg": f"Log queue full; dropped {self._unreported} records",
+                    }
+                )
+                self.queue.put_nowait(notice)
+                self._unreported = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._unreported += 1
+
+
+class _UpdateContextFilter(logging.Filter):
+    """Copy the current :class:`UpdateContext` onto records.
+
+    It runs on the calling thread, before a record is queued, because that is
+    where the context variable is visible.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = update_context.get()
+        if context is None:
+            return True
+        for name in ("update_id", "chat_id", "user_id", "handler"):
+            if not hasattr(record, name):
+                setattr(record, name, getattr(context, name))
+        if not hasattr(record, "elapsed_ms"):
+            record.elapsed_ms = round((time.perf_counter() - context.started) * 1000, 3)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including any update context fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name in CONTEXT_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                payload[name] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def _log_level(conf: ConfigNamespace) -> int:
+    name = str(getattr(conf, "log_level", "INFO")).upper()
+    level = logging.getLevelName(name)
+    if not isinstance(level, int):
+        raise ValueError(f"Unknown log_level: {name}")
+    return level
+
+
+def _apply_log_level(conf: ConfigNamespace) -> None:
+    """Subscriber for config_logger.yaml reloads; the other logging settings need a restart."""
+    level = _log_level(conf)
+    with _handlers_lock:
+        handlers = list(_sinks)
+        loggers = list(_configured_loggers)
+    for handler in handlers:
+        handler.setLevel(level)
+    for configured in loggers:
+        configured.setLevel(level)
 
-    formatter = logging.Formatter(config_logger.formatter)
+
+def _build_sinks(level: int) -> List[logging.Handler]:
+    text_formatter = logging.Formatter(config_logger.formatter)
+    structured_conf = getattr(config_logger, "structured", None)
+    structured = bool(getattr(structured_conf, "enabled", False))
 
     stream_handler = logging.StreamHandler()
     stream_handler.setLevel(level)
-    stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
+    stream_handler.setFormatter(
+        JsonFormatter() if structured and getattr(structured_conf, "console", False) else text_formatter
+    )
 
     _ensure_log_dir()
     log_file = Path(config_logger.log_file)
@@ -47,9 +160,101 @@ def get_logger(name: Optional[str] = None) -> logging.Logger:
         encoding="utf-8",
     )
     file_handler.setLevel(level)
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    file_handler.setFormatter(JsonFormatter() if structured else text_formatter)
+    return [stream_handler, file_handler]
+
+
+def _get_shared_handlers(level: int) -> List[logging.Handler]:
+    """Build the console/file sinks once and, when queueing is enabled, put them behind a listener thread."""
+    global _shared_handlers, _listener
+    with _handlers_lock:
+        if _shared_handlers is not None:
+            return _shared_handlers
+
+        sinks = _build_sinks(level)
+        _sinks.extend(sinks)
+        queue_conf = getattr(config_logger, "queue", None)
+        if not getattr(queue_conf, "enabled", True):
+            for sink in sinks:
+                sink.addFilter(_UpdateContextFilter())
+            _shared_handlers = sinks
+            return _shared_handlers
+
+        records: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=int(getattr(queue_conf, "max_size", 50000)))
+        _listener = logging.handlers.QueueListener(records, *sinks, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+        queue_handler = _DroppingQueueHandler(records)
+        queue_handler.addFilter(_UpdateContextFilter())
+        _shared_handlers = [queue_handler]
+        return _shared_handlers
+
+
+def stop_logging() -> None:
+    """Flush queued records to the sinks and stop the listener thread."""
+    global _listener
+    with _handlers_lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+
+
+def forward_logs(records: Any) -> None:
+    """Send every record of this process to ``records`` instead of the local sinks.
+
+    Worker processes call this with a multiprocessing queue drained by
+    :func:`serve_forwarded_logs` in the supervisor, so only one process writes
+    and rotates the log file.
+    """
+    global _shared_handlers
+    forwarder = _DroppingQueueHandler(records)
+    forwarder.addFilter(_UpdateContextFilter())
+    with _handlers_lock:
+        previous = _shared_handlers or []
+        sinks = list(_sinks)
+        _shared_handlers = [forwarder]
+        _sinks.clear()
+        loggers = list(_configured_loggers)
+    for configured in loggers:
+        for handler in previous:
+            configured.removeHandler(handler)
+        configured.addHandler(forwarder)
+    stop_logging()
+    for sink in sinks:
+        sink.close()
+
+
+def serve_forwarded_logs(records: Any) -> logging.handlers.QueueListener:
+    """Write records that other processes put on ``records`` to this process's sinks."""
+    with _handlers_lock:
+        sinks = list(_sinks)
+    listener = logging.handlers.QueueListener(records, *sinks, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def get_logger(name: Optional[str] = None) -> logging.Logger:
+    """Return a configured logger instance.
+
+    Every logger shares the same handlers; with ``queue.enabled`` a log call
+    only formats and enqueues the record, and one listener thread does the
+    console and file I/O.
+    """
+    logger = logging.getLogger(name)
+
+    if getattr(logger, "_chiffon_logger_configured", False):
+        return logger
+
+    level = getattr(logging, config_logger.log_level.upper(), logging.INFO)
+    logger.setLevel(level)
+    for handler in _get_shared_handlers(level):
+        logger.addHandler(handler)
 
     logger._chiffon_logger_configured = True  # type: ignore[attr-defined]
+    with _handlers_lock:
+        _configured_loggers.append(logger)
     return logger
 
+
+config_logger.add_validator(_log_level)
+config_logger.subscribe(_apply_log_level)
@@ -0,0 +1 @@
+﻿"""Outbound messaging helpers package."""
@@ -0,0 +1,400 @@
+﻿"""Rate-limited outbound message queue shared by every handler."""
+from __future__ import annotations
+
+import atexit
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from telegram import Bot, Message
+from telegram.error import NetworkError, RetryAfter, TelegramError, TimedOut
+
+from ..config import ConfigNamespace, config_bot
+from ..logger.logger import get_logger
+from ..monitoring.metrics import registry
+
+logger = get_logger("messaging.send_queue")
+
+TELEGRAM_MAX_LENGTH = 4096
+MERGE_SEPARATOR = "\n\n"
+
+SentCallback = Callable[[Message], None]
+
+
+def split_text(text: str, limit: int = TELEGRAM_MAX_LENGTH) -> List[str]:
+    """Split ``text`` into chunks of at most ``limit`` characters, preferring line breaks."""
+    if len(text) <= limit:
+        return [text]
+    parts: List[str] = []
+    remaining = text
+    while len(remaining) > limit:
+        cut = remaining.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        parts.append(remaining[:cut])
+        remaining = remaining[cut:].lstrip("\n")
+    if remaining:
+        parts.append(remaining)
+    return parts
+
+
+class TokenBucket:
+    """Classic token bucket; ``rate`` tokens per second up to ``capacity``."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until one token is available (0 when it is available now)."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 1.0
+
+    def consume(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def reconfigure(self, rate: float, capacity: float, now: float) -> None:
+        self._refill(now)
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = min(self.tokens, self.capacity)
+
+    def block_for(self, seconds: float, now: float) -> None:
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+@dataclass
+class OutboundMessage:
+    bot: Bot
+    chat_id: int
+    text: str
+    reply_to_message_id: Optional[int] = None
+    reply_markup: Any = None
+    parse_mode: Optional[str] = None
+    on_sent: Optional[SentCallback] = None
+    attempts: int = 0
+
+    def can_merge(self, other: "OutboundMessage") -> bool:
+        return (
+            self.reply_markup is None
+            and other.reply_markup is None
+            and self.on_sent is None
+            and other.on_sent is None
+            and self.reply_to_message_id == other.reply_to_message_id
+            and self.parse_mode == other.parse_mode
+            and len(self.text) + len(MERGE_SEPARATOR) + len(other.text) <= TELEGRAM_MAX_LENGTH
+        )
+
+
+class SendQueue:
+    """Deliver messages from one thread while honouring Telegram's flood limits.
+
+    A global bucket caps the bot-wide rate and one bucket per chat caps each
+    chat (group chats get a stricter per-minute allowance). Chats are served
+    round-robin. Small consecutive messages to the same chat that pile up
+    behind a limit are merged into one, texts above 4096 characters are
+    split, and ``RetryAfter`` pauses the affected chat for the advertised
+    time before the message is retried.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        global_burst: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        group_rate_per_minute: float = 20.0,
+        group_burst: float = 5.0,
+        max_retries: int = 3,
+        idle_chat_ttl: float = 300.0,
+    ) -> None:
+        self.chat_rate = float(chat_rate)
+        self.chat_burst = float(chat_burst)
+        self.group_rate = float(group_rate_per_minute) / 60.0
+        self.group_burst = float(group_burst)
+        self.max_retries = int(max_retries)
+        self.idle_chat_ttl = float(idle_chat_ttl)
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._queues: Dict[int, Deque[OutboundMessage]] = {}
+        self._order: Deque[int] = deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._atexit_registered = False
+        self.sent = 0
+        self.merged = 0
+        self.retried = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="send-queue", daemon=True)
+        self._thread.start()
+        if not self._atexit_registered:
+            atexit.register(self.stop)
+            self._atexit_registered = True
+        logger.info("Send queue started")
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """Deliver what is still queued (within ``timeout``) and stop the worker."""
+        thread = self._thread
+        if thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        thread.join(timeout)
+        self._thread = None
+        logger.info("Send queue stopped (sent=%d, merged=%d, retried=%d)", self.sent, self.merged, self.retried)
+
+    def configure(
+        self,
+        global_rate: float,
+        global_burst: float,
+        chat_rate: float,
+        chat_burst: float,
+        group_rate_per_minute: float,
+        group_burst: float,
+        max_retries: int,
+    ) -> None:
+        """Change the send limits; existing buckets keep their tokens up to the new capacity."""
+        with self._cond:
+            self.chat_rate = float(chat_rate)
+            self.chat_burst = float(chat_burst)
+            self.group_rate = float(group_rate_per_minute) / 60.0
+            self.group_burst = float(group_burst)
+            self.max_retries = int(max_retries)
+            now = time.monotonic()
+            self._global.reconfigure(global_rate, global_burst, now)
+            for chat_id, bucket in self._chat_buckets.items():
+                if chat_id < 0:
+                    bucket.reconfigure(self.group_rate, self.group_burst, now)
+                else:
+                    bucket.reconfigure(self.chat_rate, self.chat_burst, now)
+            self._cond.notify_all()
+
+    def depth(self) -> int:
+        with self._cond:
+            return sum(len(items) for items in self._queues.values())
+
+    def send(
+        self,
+        bot: Bot,
+        chat_id: int,
+        text: str,
+        reply_to_message_id: Optional[int] = None,
+        reply_markup: Any = None,
+        parse_mode: Optional[str] = None,
+        on_sent: Optional[SentCallback] = None,
+    ) -> None:
+        """Queue ``text`` for ``chat_id``; delivered inline when the queue is not running."""
+        parts = split_text(text)
+        items = [
+            OutboundMessage(
+                bot=bot,
+                chat_id=chat_id,
+                text=part,
+                reply_to_message_id=reply_to_message_id,
+                parse_mode=parse_mode,
+                # Keyboards and callbacks belong to the last part only.
+                reply_markup=reply_markup if index == len(parts) - 1 else None,
+                on_sent=on_sent if index == len(parts) - 1 else None,
+            )
+            for index, part in enumerate(parts)
+        ]
+
+        if not self.running:
+            for item in items:
+                self._deliver_now(item)
+            return
+
+        with self._cond:
+            queue = self._queues.get(chat_id)
+            if queue is None:
+                queue = self._queues[chat_id] = deque()
+                self._order.append(chat_id)
+            queue.extend(items)
+            self._cond.notify()
+
+    def reply(self, message: Message, text: str, **kwargs: Any) -> None:
+        """Queue a reply to ``message``."""
+        self.send(message.bot, message.chat_id, text, reply_to_message_id=message.message_id, **kwargs)
+
+    def _bucket_for(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _next_batch(self, now: float) -> Tuple[Optional[OutboundMessage], float]:
+        """Pick the next ready chat round-robin; returns ``(item, wait)``."""
+        global_wait = self._global.wait_time(now)
+        if global_wait > 0:
+            return None, global_wait
+        shortest = 1.0
+        for _ in range(len(self._order)):
+            chat_id = self._order[0]
+            self._order.rotate(-1)
+            wait = self._bucket_for(chat_id).wait_time(now)
+            if wait > 0:
+                shortest = min(shortest, wait)
+                continue
+            return self._take(chat_id, now), 0.0
+        return None, shortest
+
+    def _take(self, chat_id: int, now: float) -> OutboundMessage:
+        queue = self._queues[chat_id]
+        item = queue.popleft()
+        while queue and item.can_merge(queue[0]):
+            following = queue.popleft()
+            item.text = f"{item.text}{MERGE_SEPARATOR}{following.text}"
+            self.merged += 1
+        if not queue:
+            del self._queues[chat_id]
+            self._order.remove(chat_id)
+        self._global.consume(now)
+        self._bucket_for(chat_id).consume(now)
+        return item
+
+    def _requeue_front(self, item: OutboundMessage) -> None:
+        queue = self._queues.get(item.chat_id)
+        if queue is None:
+            queue = self._queues[item.chat_id] = deque()
+            self._order.append(item.chat_id)
+        queue.appendleft(item)
+
+    def _forget_idle_buckets(self, now: float) -> None:
+        stale = [
+            chat_id
+            for chat_id, bucket in self._chat_buckets.items()
+            if chat_id not in self._queues and now - bucket.updated > self.idle_chat_ttl
+        ]
+        for chat_id in stale:
+            del self._chat_buckets[chat_id]
+
+    def _run(self) -> None:
+        last_sweep = time.monotonic()
+        while True:
+            with self._cond:
+                while not self._queues and not self._stopping:
+                    self._cond.wait()
+                if not self._queues and self._stopping:
+                    return
+                now = time.monotonic()
+                if now - last_sweep > self.idle_chat_ttl:
+                    self._forget_idle_buckets(now)
+                    last_sweep = now
+                item, wait = self._next_batch(now)
+                if item is None:
+                    self._cond.wait(wait)
+                    continue
+            self._deliver(item)
+
+    def _deliver(self, item: OutboundMessage) -> None:
+        try:
+            self._deliver_now(item)
+        except RetryAfter as exc:
+            self.retried += 1
+            with self._cond:
+                self._bucket_for(item.chat_id).block_for(float(exc.retry_after), time.monotonic())
+                self._requeue_front(item)
+            logger.warning("Flood limit hit for chat %s; retrying in %ss", item.chat_id, exc.retry_after)
+        except (TimedOut, NetworkError) as exc:
+            item.attempts += 1
+            if item.attempts > self.max_retries:
+                logger.error("Giving up on message to chat %s after %d attempts: %s", item.chat_id, item.attempts, exc)
+                return
+            self.retried += 1
+            with self._cond:
+                self._bucket_for(item.chat_id).block_for(min(30.0, 2.0 ** item.attempts), time.monotonic())
+                self._requeue_front(item)
+        except TelegramError as exc:
+            logger.error("Dropping message to chat %s: %s", item.chat_id, exc)
+        except Exception:
+            # Anything else would end the sender thread and with it every later message.
+            logger.exception("Dropping message to chat %s after an unexpected error", item.chat_id)
+
+    def _deliver_now(self, item: OutboundMessage) -> None:
+        sent = item.bot.send_message(
+            chat_id=item.chat_id,
+            text=item.text,
+            reply_to_message_id=item.reply_to_message_id,
+            reply_markup=item.reply_markup,
+            parse_mode=item.parse_mode,
+            allow_sending_without_reply=True,
+        )
+        self.sent += 1
+        if item.on_sent is not None:
+            try:
+                item.on_sent(sent)
+            except Exception:
+                logger.exception("on_sent callback failed for chat %s", item.chat_id)
+
+
+# Number of processes sending with the same bot token; they split the bot-wide limit.
+_global_share = 1
+
+
+def _send_limits(bot_conf: ConfigNamespace) -> Dict[str, Any]:
+    conf = getattr(bot_conf, "send_queue", None)
+    return {
+        "global_rate": float(getattr(conf, "global_rate", 30)) / _global_share,
+        "global_burst": max(1.0, float(getattr(conf, "global_burst", 30)) / _global_share),
+        "chat_rate": float(getattr(conf, "chat_rate", 1)),
+        "chat_burst": float(getattr(conf, "chat_burst", 3)),
+        "group_rate_per_minute": float(getattr(conf, "group_rate_per_minute", 20)),
+        "group_burst": float(getattr(conf, "group_burst", 5)),
+        "max_retries": int(getattr(conf, "max_retries", 3)),
+    }
+
+
+def _build_send_queue() -> SendQueue:
+    return SendQueue(**_send_limits(config_bot.snapshot()))
+
+
+send_queue = _build_send_queue()
+config_bot.add_validator(_send_limits)
+config_bot.subscribe(lambda conf: send_queue.configure(**_send_limits(conf)))
+
+
+def set_global_share(processes: int) -> None:
+    """Give this process ``1/processes`` of the bot-wide send limit.
+
+    Per-chat limits stay whole: in multi-process mode each chat is served by
+    exactly one process.
+    """
+    global _global_share
+    _global_share = max(1, int(processes))
+    send_queue.configure(**_send_limits(config_bot.snapshot()))
+
+
+registry.gauge("tgbot_send_queue_depth", "Messages waiting in the send queue.", collect=send_queue.depth)
+registry.counter("tgbot_messages_sent_total", "Messages delivered to Telegram.", collect=lambda: send_queue.sent)
+registry.counter("tgbot_messages_merged_total", "Queued messages merged into a neighbour.", collect=lambda: send_queue.merged)
+registry.counter("tgbot_message_retries_total", "Deliveries retried after flood or network errors.", collect=lambda: send_queue.retried)
+
+__all__ = ["SendQueue", "TokenBucket", "send_queue", "set_global_share", "split_text"]
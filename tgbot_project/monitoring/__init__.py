@@ -0,0 +1 @@
+﻿"""Metrics and monitoring helpers package."""
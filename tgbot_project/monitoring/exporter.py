@@ -0,0 +1,92 @@
+﻿"""Local HTTP endpoint serving the metrics registry in Prometheus text format."""
+from __future__ import annotations
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+
+from ..config import config_bot
+from ..logger.logger import get_logger
+from .metrics import Registry, registry
+
+logger = get_logger("monitoring.exporter")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer:
+    """Serve ``GET <path>`` from a background thread."""
+
+    def __init__(self, metrics: Registry, listen: str = "127.0.0.1", port: int = 9464, path: str = "/metrics") -> None:
+        self.metrics = metrics
+        self.listen = listen
+        self.port = int(port)
+        self.path = path if path.startswith("/") else f"/{path}"
+        self._httpd: Optional[_HTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> str:
+        port = self._httpd.server_address[1] if self._httpd else self.port
+        return f"http://{self.listen}:{port}{self.path}"
+
+    def start(self) -> None:
+        if self._httpd is not None:
+            return
+        self._httpd = _HTTPServer((self.listen, self.port), _make_request_handler(self))
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="metrics-http", daemon=True)
+        self._thread.start()
+        logger.info("Metrics exporter listening on %s", self.address)
+
+    def stop(self) -> None:
+        if self._httpd is None:
+            return
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join(5)
+        self._httpd = None
+        self._thread = None
+
+
+def _make_request_handler(server: MetricsServer) -> type:
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?", 1)[0] != server.path:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = server.metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            logger.debug("metrics %s - %s", self.client_address[0], format % args)
+
+    return _Handler
+
+
+def start_metrics_server() -> Optional[MetricsServer]:
+    """Start the exporter when ``metrics.enabled`` is set in config_bot.yaml."""
+    conf = getattr(config_bot, "metrics", None)
+    if not getattr(conf, "enabled", False):
+        return None
+    server = MetricsServer(
+        registry,
+        listen=getattr(conf, "listen", "127.0.0.1"),
+        port=getattr(conf, "port", 9464),
+        path=getattr(conf, "path", "/metrics"),
+    )
+    server.start()
+    return server
+
+
+__all__ = ["MetricsServer", "start_metrics_server"]
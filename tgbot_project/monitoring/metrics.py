@@ -0,0 +1,264 @@
+﻿"""In-process metrics (counters, gauges, histograms) rendered in Prometheus text format."""
+from __future__ import annotations
+
+import bisect
+import math
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+LabelKey = Tuple[str, ...]
+Sample = Tuple[str, Dict[str, str], float]
+# Metric name -> (kind, documentation, samples), as sent between processes.
+Snapshot = Dict[str, Tuple[str, str, List[Sample]]]
+
+# Seconds; covers fast DB statements up to slow handlers.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Bytes per second; 64 KiB/s up to 256 MiB/s.
+THROUGHPUT_BUCKETS = tuple(float(64 * 1024 * 4 ** power) for power in range(7))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelKey:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _labels(self, key: LabelKey) -> Dict[str, str]:
+        return dict(zip(self.label_names, key))
+
+    def samples(self) -> Iterable[Sample]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return _render_family(self.name, self.kind, self.documentation, self.samples())
+
+
+def _render_family(name: str, kind: str, documentation: str, samples: Iterable[Sample]) -> List[str]:
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    for sample_name, labels, value in samples:
+        if labels:
+            rendered = ",".join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+            lines.append(f"{sample_name}{{{rendered}}} {_format_value(value)}")
+        else:
+            lines.append(f"{sample_name} {_format_value(value)}")
+    return lines
+
+
+class Counter(_Metric):
+    """Monotonic counter; ``collect`` reads the value from an existing counter attribute instead."""
+
+    kind = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        collect: Optional[Callable[[], float]] = None,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self._collect = collect
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterable[Sample]:
+        if self._collect is not None:
+            return [(self.name, {}, float(self._collect()))]
+        with self._lock:
+            return [(self.name, self._labels(key), value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    """Point-in-time value, either set explicitly or read from ``collect`` at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        collect: Optional[Callable[[], float]] = None,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self._collect = collect
+        self._values: Dict[LabelKey, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def samples(self) -> Iterable[Sample]:
+        if self._collect is not None:
+            return [(self.name, {}, float(self._collect()))]
+        with self._lock:
+            return [(self.name, self._labels(key), value) for key, value in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram, so p99 can be computed with ``histogram_quantile``."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+        # Per label set: [per-bucket counts..., +Inf count], sum
+        self._series: Dict[LabelKey, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    def samples(self) -> Iterable[Sample]:
+        with self._lock:
+            snapshot = [(key, list(counts), total[0]) for key, (counts, total) in sorted(self._series.items())]
+        samples: List[Sample] = []
+        for key, counts, total in snapshot:
+            labels = self._labels(key)
+            running = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                running += count
+                samples.append((f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, running))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, running))
+        return samples
+
+
+class Registry:
+    """Named collection of metrics.
+
+    Asking for an existing name returns the same metric, except that metrics
+    with a ``collect`` callback replace an earlier registration of that name.
+    Snapshots merged from other processes are rendered with the local
+    metrics, each sample labelled with the process it came from.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._remote: Dict[str, Snapshot] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None and existing.kind == metric.kind and getattr(metric, "_collect", None) is None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = (), collect: Optional[Callable[[], float]] = None) -> Counter:
+        return self._register(Counter(name, documentation, labels, collect))  # type: ignore[return-value]
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = (), collect: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge(name, documentation, labels, collect))  # type: ignore[return-value]
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))  # type: ignore[return-value]
+
+    def snapshot(self) -> Snapshot:
+        """Current samples of every metric, in a form that can be pickled to another process."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        snapshot: Snapshot = {}
+        for metric in metrics:
+            try:
+                snapshot[metric.name] = (metric.kind, metric.documentation, list(metric.samples()))
+            except Exception:
+                continue
+        return snapshot
+
+    def merge_remote(self, source: str, snapshot: Snapshot) -> None:
+        """Replace the samples last received from ``source`` (rendered with a ``process`` label)."""
+        with self._lock:
+            self._remote[source] = snapshot
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            remote = list(self._remote.items())
+        lines: List[str] = []
+        rendered = set()
+        for metric in metrics:
+            rendered.add(metric.name)
+            try:
+                samples = list(metric.samples())
+            except Exception as exc:
+                # A failing collect callback must not break the whole scrape.
+                lines.append(f"# {metric.name} unavailable: {exc}")
+                samples = []
+            samples.extend(_remote_samples(remote, metric.name))
+            lines.extend(_render_family(metric.name, metric.kind, metric.documentation, samples))
+        # Families only the other processes registered.
+        for _source, snapshot in remote:
+            for name, (kind, documentation, _samples) in snapshot.items():
+                if name not in rendered:
+                    rendered.add(name)
+                    lines.extend(_render_family(name, kind, documentation, _remote_samples(remote, name)))
+        return "\n".join(lines) + "\n"
+
+
+def _remote_samples(remote: List[Tuple[str, Snapshot]], name: str) -> List[Sample]:
+    samples: List[Sample] = []
+    for source, snapshot in remote:
+        family = snapshot.get(name)
+        if family is not None:
+            samples.extend((sample, {**labels, "process": source}, value) for sample, labels, value in family[2])
+    return samples
+
+
+registry = Registry()
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "LATENCY_BUCKETS",
+    "Registry",
+    "Snapshot",
+    "THROUGHPUT_BUCKETS",
+    "registry",
+]
@@ -0,0 +1 @@
+﻿"""Runtime modes package."""
@@ -0,0 +1,159 @@
+﻿"""Asyncio runtime that runs coroutine handlers next to the python-telegram-bot dispatcher.
+
+The project is pinned to python-telegram-bot 13, whose ``Dispatcher`` only
+calls plain functions. In async mode every handler is a coroutine scheduled on
+a dedicated event loop thread, so dispatcher threads return immediately. The
+v13 ``Bot`` and SQLAlchemy are blocking, so handlers await them through two
+bounded executors: a small one for the database and a larger one for network
+I/O.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from ..config import config_bot
+from ..logger.logger import get_logger
+
+logger = get_logger("runtime.async_runtime")
+
+T = TypeVar("T")
+AsyncHandler = Callable[[Update, CallbackContext], Awaitable[None]]
+
+
+class AsyncRuntime:
+    """Own an event loop thread plus the executors used for blocking calls."""
+
+    def __init__(self, db_workers: int = 4, io_workers: int = 16, max_concurrent_updates: int = 256) -> None:
+        self.db_workers = max(1, int(db_workers))
+        self.io_workers = max(1, int(io_workers))
+        self.max_concurrent_updates = max(1, int(max_concurrent_updates))
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._db_executor: Optional[ThreadPoolExecutor] = None
+        self._io_executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    @property
+    def running(self) -> bool:
+        return self._loop is not None and self._loop.is_running()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._db_executor = ThreadPoolExecutor(self.db_workers, thread_name_prefix="async-db")
+        self._io_executor = ThreadPoolExecutor(self.io_workers, thread_name_prefix="async-io")
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, args=(ready,), name="asyncio-runtime", daemon=True)
+        self._thread.start()
+        ready.wait()
+        logger.info(
+            "Async runtime started (db_workers=%s, io_workers=%s, max_concurrent_updates=%s)",
+            self.db_workers,
+            self.io_workers,
+            self.max_concurrent_updates,
+        )
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """Wait for in-flight handlers, then stop the loop and executors."""
+        loop = self._loop
+        if loop is None:
+            return
+        if loop.is_running():
+            drain = asyncio.run_coroutine_threadsafe(self._drain(), loop)
+            try:
+                drain.result(timeout)
+            except Exception:
+                logger.warning("Timed out waiting for async handlers to finish")
+            loop.call_soon_threadsafe(loop.stop)
+        if self._thread is not None:
+            self._thread.join(timeout)
+        loop.close()
+        for executor in (self._db_executor, self._io_executor):
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self._loop = None
+        self._thread = None
+        logger.info("Async runtime stopped")
+
+    async def run_db(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Run a blocking database call on the database executor."""
+        return await self._run_in(self._db_executor, func, *args, **kwargs)
+
+    async def run_io(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Run blocking network or disk I/O on the I/O executor."""
+        return await self._run_in(self._io_executor, func, *args, **kwargs)
+
+    def adapt(self, handler: AsyncHandler) -> Callable[[Update, CallbackContext], None]:
+        """Wrap a coroutine handler into a callback the v13 dispatcher can call."""
+
+        @functools.wraps(handler)
+        def callback(update: Update, context: CallbackContext) -> None:
+            if not self.running:
+                raise RuntimeError("Async runtime is not running")
+            future = asyncio.run_coroutine_threadsafe(self._guarded(handler, update, context), self._loop)
+            future.add_done_callback(functools.partial(_report_failure, update, context))
+
+        return callback
+
+    async def _guarded(self, handler: AsyncHandler, update: Update, context: CallbackContext) -> None:
+        assert self._slots is not None
+        async with self._slots:
+            await handler(update, context)
+
+    async def _run_in(self, executor: Optional[ThreadPoolExecutor], func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        if executor is None:
+            raise RuntimeError("Async runtime is not running")
+        loop = asyncio.get_running_loop()
+        # Executors do not inherit context variables, so carry them over explicitly.
+        call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+        return await loop.run_in_executor(executor, call)
+
+    async def _drain(self) -> None:
+        current = asyncio.current_task()
+        pending = [task for task in asyncio.all_tasks() if task is not current]
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def _run_loop(self, ready: threading.Event) -> None:
+        assert self._loop is not None
+        asyncio.set_event_loop(self._loop)
+        self._slots = asyncio.Semaphore(self.max_concurrent_updates)
+        self._loop.call_soon(ready.set)
+        self._loop.run_forever()
+
+
+def _report_failure(update: Update, context: CallbackContext, future: "asyncio.Future[None]") -> None:
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is None:
+        return
+    dispatcher = getattr(context, "dispatcher", None)
+    if dispatcher is not None and dispatcher.error_handlers:
+        dispatcher.dispatch_error(update, error)
+    else:
+        logger.error("Async handler failed for update %s", update, exc_info=error)
+
+
+def _build_runtime() -> AsyncRuntime:
+    conf = getattr(config_bot, "runtime", None)
+    return AsyncRuntime(
+        db_workers=getattr(conf, "db_workers", 4),
+        io_workers=getattr(conf, "io_workers", 16),
+        max_concurrent_updates=getattr(conf, "max_concurrent_updates", 256),
+    )
+
+
+RUNTIME_MODE = str(getattr(getattr(config_bot, "runtime", None), "mode", "sync")).lower()
+runtime = _build_runtime()
+
+__all__ = ["AsyncRuntime", "RUNTIME_MODE", "runtime"]
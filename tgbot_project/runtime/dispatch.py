@@ -0,0 +1,92 @@
+﻿"""Handler wrapper that binds the update context used for log correlation and timing."""
+from __future__ import annotations
+
+import asyncio
+import functools
+import time
+from typing import Any, Callable, Optional
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from ..logger.logger import UpdateContext, get_logger, update_context
+from ..monitoring.metrics import registry
+
+logger = get_logger("runtime.dispatch")
+
+HANDLER_SECONDS = registry.histogram(
+    "tgbot_handler_duration_seconds", "Time spent in update handlers.", labels=("handler", "outcome")
+)
+
+
+def handler_name(handler: Callable[..., Any]) -> str:
+    """``<module>.<function>`` with the ``_async`` suffix dropped, so both variants aggregate together."""
+    module = getattr(handler, "__module__", "") or ""
+    name = getattr(handler, "__name__", repr(handler))
+    if name.endswith("_async"):
+        name = name[: -len("_async")]
+    return f"{module.rsplit('.', 1)[-1]}.{name}" if module else name
+
+
+def _context_for(update: Any, name: str) -> UpdateContext:
+    if not isinstance(update, Update):
+        return UpdateContext(update_id=None, chat_id=None, user_id=None, handler=name)
+    chat = update.effective_chat
+    user = update.effective_user
+    return UpdateContext(
+        update_id=update.update_id,
+        chat_id=chat.id if chat else None,
+        user_id=user.id if user else None,
+        handler=name,
+    )
+
+
+def _finish(context: UpdateContext, outcome: str) -> None:
+    elapsed = time.perf_counter() - context.started
+    HANDLER_SECONDS.observe(elapsed, handler=context.handler, outcome=outcome)
+    elapsed_ms = round(elapsed * 1000, 3)
+    logger.info("Handled %s in %.1f ms (%s)", context.handler, elapsed_ms, outcome, extra={"elapsed_ms": elapsed_ms})
+
+
+def traced(handler: Callable[..., Any], name: Optional[str] = None) -> Callable[..., Any]:
+    """Wrap a sync or coroutine handler so its log records carry the update context.
+
+    Every call ends with one ``Handled <handler>`` record holding the total
+    ``elapsed_ms``, which is what per-command latency is aggregated from.
+    """
+    label = name or handler_name(handler)
+
+    if asyncio.iscoroutinefunction(handler):
+
+        @functools.wraps(handler)
+        async def async_wrapper(update: Update, context: CallbackContext) -> Any:
+            bound = _context_for(update, label)
+            token = update_context.set(bound)
+            outcome = "error"
+            try:
+                result = await handler(update, context)
+                outcome = "ok"
+                return result
+            finally:
+                _finish(bound, outcome)
+                update_context.reset(token)
+
+        return async_wrapper
+
+    @functools.wraps(handler)
+    def wrapper(update: Update, context: CallbackContext) -> Any:
+        bound = _context_for(update, label)
+        token = update_context.set(bound)
+        outcome = "error"
+        try:
+            result = handler(update, context)
+            outcome = "ok"
+            return result
+        finally:
+            _finish(bound, outcome)
+            update_context.reset(token)
+
+    return wrapper
+
+
+__all__ = ["handler_name", "traced"]
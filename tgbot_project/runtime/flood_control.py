@@ -0,0 +1,259 @@
+﻿"""Flood control: reject commands, uploads and button presses over their rate limits before any handler runs."""
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import CallbackContext, Dispatcher, DispatcherHandlerStop, TypeHandler
+
+from ..config import ConfigNamespace, config_bot
+from ..database.cache import TTLCache
+from ..logger.logger import get_logger
+from ..messaging.send_queue import send_queue
+from ..monitoring.metrics import registry
+
+logger = get_logger("runtime.flood_control")
+
+FLOOD_REJECTED = registry.counter(
+    "tgbot_flood_rejected_total", "Updates dropped by flood control, by the limit they hit.", labels=("scope",)
+)
+
+POLICIES = ("drop", "reply")
+
+
+@dataclass(frozen=True)
+class Limit:
+    """At most ``count`` requests per ``window`` seconds."""
+
+    count: int
+    window: float
+
+
+class SlidingWindowLimiter:
+    """Approximate sliding-window counters for many keys in bounded memory.
+
+    Each key keeps only the start of its current fixed window and the counts
+    of that window and the previous one; the previous count is weighted by
+    how much of it still overlaps the sliding window. Keys are kept in LRU
+    order and the least recently used are forgotten beyond ``max_keys``.
+    """
+
+    def __init__(self, max_keys: int = 50000, clock: Callable[[], float] = time.monotonic) -> None:
+        self.max_keys = max(1, int(max_keys))
+        self.clock = clock
+        # key -> [current window start, current count, previous count]
+        self._windows: "OrderedDict[Hashable, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    def _window(self, key: Hashable, window: float, now: float) -> List[float]:
+        start = now - now % window
+        state = self._windows.get(key)
+        if state is None:
+            state = self._windows[key] = [start, 0.0, 0.0]
+            return state
+        self._windows.move_to_end(key)
+        if state[0] != start:
+            # Only the window right before this one still overlaps it.
+            state[2] = state[1] if start - state[0] <= window else 0.0
+            state[1] = 0.0
+            state[0] = start
+        return state
+
+    @staticmethod
+    def _retry_after(state: List[float], limit: Limit, now: float) -> float:
+        """Seconds until one more request would fit, or 0 if it fits now."""
+        start, current, previous = state
+        elapsed = now - start
+        if previous * (1 - elapsed / limit.window) + current < limit.count:
+            return 0.0
+        if current < limit.count:
+            # The previous window's weight decays until the estimate drops below the limit.
+            fits_at = limit.window * (1 - (limit.count - current) / previous)
+            return max(fits_at - elapsed, 0.001)
+        fits_at = limit.window + limit.window * (1 - limit.count / current)
+        return max(fits_at - elapsed, 0.001)
+
+    def hit(self, checks: Sequence[Tuple[Hashable, Limit]]) -> Tuple[Optional[Hashable], float]:
+        """Count one request against every ``(key, limit)`` if all of them allow it.
+
+        Returns ``(None, 0.0)`` when the request was counted, otherwise the
+        first key that rejected it and the seconds until it would be allowed.
+        Rejected requests are not counted, so waiting out the limit is enough.
+        """
+        now = self.clock()
+        with self._lock:
+            states = [self._window(key, limit.window, now) for key, limit in checks]
+            for (key, limit), state in zip(checks, states):
+                retry_after = self._retry_after(state, limit, now)
+                if retry_after:
+                    return key, retry_after
+            for state in states:
+                state[1] += 1
+            while len(self._windows) > self.max_keys:
+                self._windows.popitem(last=False)
+        return None, 0.0
+
+
+def request_name(update: Update) -> Optional[str]:
+    """The command, ``upload`` or ``callback`` an update asks for; ``None`` for updates that are never limited."""
+    if update.callback_query is not None:
+        return "callback"
+    message = update.message or update.edited_message
+    if message is None:
+        return None
+    if message.document or message.photo:
+        return "upload"
+    text = message.text or ""
+    if not text.startswith("/"):
+        return None
+    return text[1:].split(None, 1)[0].split("@", 1)[0].lower() or None
+
+
+class FloodControl:
+    """Dispatcher middleware enforcing per-user, per-chat and per-command limits.
+
+    Only commands, uploads and callback queries are counted; plain messages
+    and member updates always pass. An update over a limit stops dispatching,
+    and with the ``reply`` policy the user is told how long to wait, at most
+    once per ``notice_cooldown`` seconds.
+    """
+
+    def __init__(
+        self,
+        user: Optional[Limit] = None,
+        chat: Optional[Limit] = None,
+        commands: Optional[Dict[str, Limit]] = None,
+        policy: str = "reply",
+        notice_cooldown: float = 30.0,
+        max_keys: int = 50000,
+    ) -> None:
+        self.limiter = SlidingWindowLimiter(max_keys)
+        self._notices = TTLCache(max_entries=max_keys, ttl=notice_cooldown)
+        # Called with every rejected update, e.g. by the load test to account for it.
+        self.on_reject: Optional[Callable[[Update], None]] = None
+        self.configure(user, chat, commands, policy, notice_cooldown, max_keys)
+
+    def configure(
+        self,
+        user: Optional[Limit],
+        chat: Optional[Limit],
+        commands: Optional[Dict[str, Limit]],
+        policy: str,
+        notice_cooldown: float,
+        max_keys: int,
+    ) -> None:
+        """Apply new limits; counters of requests already seen are kept."""
+        self.user = user
+        self.chat = chat
+        self.commands = dict(commands or {})
+        self.policy = policy
+        self.limiter.max_keys = max(1, int(max_keys))
+        self._notices.max_entries = max(1, int(max_keys))
+        self._notices.ttl = float(notice_cooldown)
+
+    def attach(self, dispatcher: Dispatcher, group: int = -1) -> None:
+        """Check every update in ``group``, which runs before the handlers in group 0."""
+        dispatcher.add_handler(TypeHandler(Update, self.check), group=group)
+
+    def _checks(self, update: Update, name: str) -> List[Tuple[Hashable, Limit]]:
+        user = update.effective_user
+        chat = update.effective_chat
+        checks: List[Tuple[Hashable, Limit]] = []
+        command = self.commands.get(name)
+        if command is not None and user is not None:
+            checks.append((("command", name, user.id), command))
+        if self.user is not None and user is not None:
+            checks.append((("user", user.id), self.user))
+        # In private chats the user limit already covers the chat.
+        if self.chat is not None and chat is not None and chat.type != "private":
+            checks.append((("chat", chat.id), self.chat))
+        return checks
+
+    def check(self, update: Update, context: CallbackContext) -> None:
+        name = request_name(update)
+        if name is None:
+            return
+        key, retry_after = self.limiter.hit(self._checks(update, name))
+        if key is None:
+            return
+        scope = key[0]
+        FLOOD_REJECTED.inc(scope=scope)
+        user = update.effective_user
+        logger.debug(
+            "Dropping %s from user %s: %s limit, retry in %.0fs", name, user.id if user else None, scope, retry_after
+        )
+        if self.policy == "reply" and user is not None:
+            self._notify(update, user.id, retry_after)
+        if self.on_reject is not None:
+            self.on_reject(update)
+        raise DispatcherHandlerStop()
+
+    def _notify(self, update: Update, user_id: int, retry_after: float) -> None:
+        if self._notices.get(user_id) is not None:
+            return
+        self._notices.set(user_id, True)
+        text = f"操作太频繁，请 {max(1, round(retry_after))} 秒后再试。"
+        query = update.callback_query
+        if query is not None:
+            try:
+                query.answer(text)
+            except TelegramError as exc:
+                logger.warning("Could not answer a rate-limited callback query: %s", exc)
+            return
+        message = update.effective_message
+        if message is not None:
+            send_queue.reply(message, text)
+
+
+def _limit(conf: Optional[ConfigNamespace], where: str) -> Optional[Limit]:
+    if conf is None:
+        return None
+    count = int(getattr(conf, "limit", 0))
+    window = float(getattr(conf, "window_seconds", 0))
+    if count <= 0 or window <= 0:
+        raise ValueError(f"flood_control.{where} needs a positive limit and window_seconds")
+    return Limit(count, window)
+
+
+def _flood_settings(bot_conf: ConfigNamespace) -> Dict[str, object]:
+    conf = getattr(bot_conf, "flood_control", None)
+    policy = str(getattr(conf, "policy", "reply"))
+    if policy not in POLICIES:
+        raise ValueError(f"flood_control.policy must be one of {', '.join(POLICIES)}, not {policy!r}")
+    commands_conf = getattr(conf, "commands", None)
+    commands = {
+        name.lower(): _limit(getattr(commands_conf, name), f"commands.{name}")
+        for name in (vars(commands_conf) if commands_conf is not None else {})
+    }
+    return {
+        "user": _limit(getattr(conf, "user", None), "user"),
+        "chat": _limit(getattr(conf, "chat", None), "chat"),
+        "commands": commands,
+        "policy": policy,
+        "notice_cooldown": float(getattr(conf, "notice_cooldown_seconds", 30)),
+        "max_keys": int(getattr(conf, "max_keys", 50000)),
+    }
+
+
+def build_flood_control() -> Optional[FloodControl]:
+    """Return the middleware unless ``flood_control.enabled`` is false in config_bot.yaml.
+
+    Limit edits apply live; enabling or disabling it needs a restart.
+    """
+    if not getattr(getattr(config_bot, "flood_control", None), "enabled", True):
+        return None
+    flood_control = FloodControl(**_flood_settings(config_bot.snapshot()))  # type: ignore[arg-type]
+    config_bot.add_validator(_flood_settings)
+    config_bot.subscribe(lambda conf: flood_control.configure(**_flood_settings(conf)))  # type: ignore[arg-type]
+    return flood_control
+
+
+__all__ = ["FloodControl", "Limit", "SlidingWindowLimiter", "build_flood_control", "request_name"]
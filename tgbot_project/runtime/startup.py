@@ -0,0 +1,130 @@
+﻿"""Startup timing: per-module import cost and per-phase init cost.
+
+Only the standard library is imported here, so ``bot`` can import this module
+before anything else and have every later import timed.
+"""
+from __future__ import annotations
+
+import sys
+import threading
+import time
+from collections import defaultdict
+from importlib.machinery import ModuleSpec
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+_PACKAGE = __name__.split(".", 1)[0]
+
+
+class _ImportTimer:
+    """Meta path finder that times ``exec_module`` of every newly imported module.
+
+    It never finds anything itself; it asks the finders after it for the spec
+    and shadows ``exec_module`` on that spec's loader instance, so the loader
+    keeps its type for anything that inspects it.
+    """
+
+    def __init__(self, profiler: "StartupProfiler") -> None:
+        self.profiler = profiler
+
+    def find_spec(self, name: str, path: Optional[Sequence[str]], target: Any = None) -> Optional[ModuleSpec]:
+        finders = sys.meta_path
+        start = finders.index(self) + 1 if self in finders else 0
+        for finder in finders[start:]:
+            find_spec = getattr(finder, "find_spec", None)
+            if find_spec is None:
+                continue
+            spec = find_spec(name, path, target)
+            if spec is None:
+                continue
+            loader = spec.loader
+            # Builtin and frozen importers are classes; patching them would affect every module.
+            if loader is not None and not isinstance(loader, type) and hasattr(loader, "exec_module"):
+                self._wrap(name, loader)
+            return spec
+        return None
+
+    def _wrap(self, name: str, loader: Any) -> None:
+        exec_module = loader.exec_module
+        profiler = self.profiler
+
+        def timed_exec_module(module: Any) -> None:
+            profiler._enter()
+            try:
+                exec_module(module)
+            finally:
+                profiler._leave(name)
+                try:
+                    del loader.exec_module
+                except AttributeError:
+                    pass
+
+        loader.exec_module = timed_exec_module
+
+
+class StartupProfiler:
+    """Collect import and init timings from the moment this module is imported until :meth:`finish`.
+
+    Import time is attributed to the module that spent it, excluding nested
+    imports; third-party modules are grouped by their top-level package.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.imports: Dict[str, float] = defaultdict(float)
+        self.phases: List[Tuple[str, float]] = []
+        self._last_mark = self.started
+        self._local = threading.local()
+        self._timer: Optional[_ImportTimer] = None
+
+    def track_imports(self) -> None:
+        if self._timer is None:
+            self._timer = _ImportTimer(self)
+            sys.meta_path.insert(0, self._timer)
+
+    def stop_tracking_imports(self) -> None:
+        timer, self._timer = self._timer, None
+        if timer is not None and timer in sys.meta_path:
+            sys.meta_path.remove(timer)
+
+    def _stack(self) -> List[List[float]]:
+        # One stack of [started, time spent in nested imports] per importing thread.
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _enter(self) -> None:
+        self._stack().append([time.perf_counter(), 0.0])
+
+    def _leave(self, name: str) -> None:
+        stack = self._stack()
+        started, nested = stack.pop()
+        elapsed = time.perf_counter() - started
+        owner = name if name.split(".", 1)[0] == _PACKAGE else name.split(".", 1)[0]
+        self.imports[owner] += elapsed - nested
+        if stack:
+            stack[-1][1] += elapsed
+
+    def mark(self, phase: str) -> None:
+        """Record the time since the previous mark (or profiler creation) as ``phase``."""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last_mark))
+        self._last_mark = now
+
+    def finish(self, top: int = 8) -> List[str]:
+        """Stop tracking imports and return the report lines."""
+        self.stop_tracking_imports()
+        total = time.perf_counter() - self.started
+        import_total = sum(self.imports.values())
+        phases = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in self.phases)
+        lines = [f"Startup took {total * 1000:.0f} ms ({phases}); {import_total * 1000:.0f} ms of it in imports"]
+        slowest = sorted(self.imports.items(), key=lambda item: item[1], reverse=True)[:top]
+        if slowest:
+            lines.append("Slowest imports: " + ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in slowest))
+        return lines
+
+
+startup = StartupProfiler()
+startup.track_imports()
+
+__all__ = ["StartupProfiler", "startup"]
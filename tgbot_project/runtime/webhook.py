@@ -0,0 +1,257 @@
+﻿"""Webhook ingestion server used instead of long polling."""
+from __future__ import annotations
+
+import hmac
+import json
+import queue
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+
+from ..config import config_bot, config_secret
+from ..logger.logger import get_logger
+from ..monitoring.metrics import registry
+
+logger = get_logger("runtime.webhook")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+UpdateCallback = Callable[[Dict[str, Any]], None]
+
+_CHAT_CARRIERS = (
+    "message",
+    "edited_message",
+    "channel_post",
+    "edited_channel_post",
+    "my_chat_member",
+    "chat_member",
+    "chat_join_request",
+)
+
+
+def update_chat_id(payload: Dict[str, Any]) -> Optional[int]:
+    """Return the chat id of a raw update payload, if it carries one."""
+    for key in _CHAT_CARRIERS:
+        carrier = payload.get(key)
+        if isinstance(carrier, dict) and isinstance(carrier.get("chat"), dict):
+            return carrier["chat"].get("id")
+    callback = payload.get("callback_query")
+    if isinstance(callback, dict) and isinstance(callback.get("message"), dict):
+        return callback["message"].get("chat", {}).get("id")
+    return None
+
+
+def _update_sender_id(payload: Dict[str, Any]) -> Optional[int]:
+    for value in payload.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"].get("id")
+    return None
+
+
+def shard_for(payload: Dict[str, Any], shards: int) -> int:
+    """Map a raw update to one of ``shards``, so updates from one chat always share a shard.
+
+    The shard is the CRC-32 of the decimal chat id, falling back to the
+    sender's id and then the update id for updates without a chat, modulo
+    ``shards``. Both the webhook queues and the worker processes use it.
+    """
+    key = update_chat_id(payload)
+    if key is None:
+        key = _update_sender_id(payload)
+    if key is None:
+        key = payload.get("update_id", 0)
+    return zlib.crc32(str(key).encode("utf-8")) % shards
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The stdlib default backlog of 5 resets connections under bursty deliveries.
+    request_queue_size = 128
+
+
+class WebhookServer:
+    """Accept Telegram update JSON over HTTP and hand it to worker threads.
+
+    Updates are routed to one bounded queue per worker by chat, which keeps
+    per-chat ordering while chats are processed in parallel. When a queue is
+    full the request is answered with 503 so Telegram retries it later.
+    """
+
+    def __init__(
+        self,
+        on_update: UpdateCallback,
+        listen: str = "127.0.0.1",
+        port: int = 8443,
+        path: str = "/telegram/webhook",
+        secret_token: Optional[str] = None,
+        queue_size: int = 1000,
+        workers: int = 4,
+        max_body_bytes: int = 1024 * 1024,
+    ) -> None:
+        self.on_update = on_update
+        self.listen = listen
+        self.port = int(port)
+        self.path = path if path.startswith("/") else f"/{path}"
+        self.secret_token = secret_token or None
+        self.workers = max(1, int(workers))
+        self.max_body_bytes = int(max_body_bytes)
+        per_worker = max(1, int(queue_size) // self.workers)
+        self._queues: List["queue.Queue[Optional[Dict[str, Any]]]"] = [
+            queue.Queue(maxsize=per_worker) for _ in range(self.workers)
+        ]
+        self._threads: List[threading.Thread] = []
+        self._httpd: Optional[_HTTPServer] = None
+        self._stats_lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+
+    @property
+    def address(self) -> str:
+        port = self._httpd.server_address[1] if self._httpd else self.port
+        return f"http://{self.listen}:{port}{self.path}"
+
+    def queue_depth(self) -> int:
+        return sum(item.qsize() for item in self._queues)
+
+    def start(self) -> None:
+        if self._httpd is not None:
+            return
+        self._httpd = _HTTPServer((self.listen, self.port), _make_request_handler(self))
+        for index, work_queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._work, args=(work_queue,), name=f"webhook-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        server_thread = threading.Thread(target=self._httpd.serve_forever, name="webhook-http", daemon=True)
+        server_thread.start()
+        self._threads.append(server_thread)
+        logger.info("Webhook server listening on %s (%d workers)", self.address, self.workers)
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """Stop accepting requests and finish the updates already queued."""
+        if self._httpd is None:
+            return
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        for work_queue in self._queues:
+            work_queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._httpd = None
+        logger.info("Webhook server stopped (accepted=%d, rejected=%d)", self.accepted, self.rejected)
+
+    def submit(self, payload: Dict[str, Any]) -> bool:
+        """Queue an update; returns False when its shard is full."""
+        try:
+            self._queues[shard_for(payload, self.workers)].put_nowait(payload)
+        except queue.Full:
+            with self._stats_lock:
+                self.rejected += 1
+            return False
+        with self._stats_lock:
+            self.accepted += 1
+        return True
+
+    def _work(self, work_queue: "queue.Queue[Optional[Dict[str, Any]]]") -> None:
+        while True:
+            payload = work_queue.get()
+            if payload is None:
+                return
+            try:
+                self.on_update(payload)
+            except Exception:
+                logger.exception("Failed to process webhook update %s", payload.get("update_id"))
+
+
+def _make_request_handler(server: WebhookServer) -> type:
+    class _Handler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            if self.path.split("?", 1)[0] != server.path:
+                self._respond(404)
+                return
+            if server.secret_token is not None:
+                supplied = self.headers.get(SECRET_HEADER, "")
+                if not hmac.compare_digest(supplied.encode("utf-8"), server.secret_token.encode("utf-8")):
+                    logger.warning("Rejected webhook request with invalid secret token from %s", self.client_address[0])
+                    self._respond(403)
+                    return
+            try:
+                length = int(self.headers.get("Content-Length", "0"))
+            except ValueError:
+                length = -1
+            if length <= 0 or length > server.max_body_bytes:
+                self._respond(413 if length > 0 else 400)
+                return
+            try:
+                payload = json.loads(self.rfile.read(length))
+            except (ValueError, UnicodeDecodeError):
+                self._respond(400)
+                return
+            if not isinstance(payload, dict) or "update_id" not in payload:
+                self._respond(400)
+                return
+            if not server.submit(payload):
+                self._respond(503, retry_after=1)
+                return
+            self._respond(200)
+
+        def _respond(self, status: int, retry_after: Optional[int] = None) -> None:
+            self.send_response(status)
+            if retry_after is not None:
+                self.send_header("Retry-After", str(retry_after))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format: str, *args: Any) -> None:
+            logger.debug("webhook %s - %s", self.client_address[0], format % args)
+
+    return _Handler
+
+
+def webhook_secret() -> Optional[str]:
+    """Return ``WEBHOOK_SECRET_TOKEN`` from config_secret.yaml.
+
+    Without it anyone who learns the URL can inject updates, so a missing
+    secret raises ``ValueError`` unless ``webhook.allow_without_secret`` is
+    set (e.g. when a proxy in front authenticates Telegram instead).
+    """
+    secret = getattr(config_secret, "WEBHOOK_SECRET_TOKEN", None) or None
+    if secret is None:
+        if not getattr(getattr(config_bot, "webhook", None), "allow_without_secret", False):
+            raise ValueError(
+                "Webhook ingestion needs WEBHOOK_SECRET_TOKEN in config_secret.yaml "
+                "(or webhook.allow_without_secret: true in config_bot.yaml)"
+            )
+        logger.warning("Webhook secret token not set; %s is not checked on incoming updates", SECRET_HEADER)
+    return secret
+
+
+def build_webhook_server(on_update: UpdateCallback) -> WebhookServer:
+    conf = getattr(config_bot, "webhook", None)
+    server = WebhookServer(
+        on_update,
+        listen=getattr(conf, "listen", "127.0.0.1"),
+        port=getattr(conf, "port", 8443),
+        path=getattr(conf, "path", "/telegram/webhook"),
+        secret_token=webhook_secret(),
+        queue_size=getattr(conf, "queue_size", 1000),
+        workers=getattr(conf, "workers", 4),
+        max_body_bytes=getattr(conf, "max_body_bytes", 1024 * 1024),
+    )
+    registry.gauge("tgbot_webhook_queue_depth", "Updates waiting in the webhook queues.", collect=server.queue_depth)
+    registry.counter("tgbot_webhook_rejected_total", "Webhook updates answered with 503.", collect=lambda: server.rejected)
+    return server
+
+
+INGESTION_MODE = str(getattr(getattr(config_bot, "runtime", None), "ingestion", "polling")).lower()
+
+__all__ = [
+    "INGESTION_MODE",
+    "SECRET_HEADER",
+    "WebhookServer",
+    "build_webhook_server",
+    "shard_for",
+    "update_chat_id",
+    "webhook_secret",
+]
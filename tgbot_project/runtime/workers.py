@@ -0,0 +1,366 @@
+﻿"""Multi-process mode: one supervisor receives updates and shards them across worker processes by chat."""
+from __future__ import annotations
+
+import json
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, List, Optional, Tuple
+
+from telegram import Bot, Update
+from telegram.ext import CallbackContext, Dispatcher, TypeHandler
+
+from ..config import config_bot, config_secret
+from ..config.watcher import reload_config
+from ..database.cache import user_cache
+from ..database.write_behind import WRITE_BEHIND_ENABLED, write_queue
+from ..logger.logger import forward_logs, get_logger, serve_forwarded_logs
+from ..messaging.send_queue import send_queue, set_global_share
+from ..monitoring.metrics import registry
+from ..storage.download_pool import download_pool
+from .startup import startup
+from .webhook import shard_for
+
+logger = get_logger("runtime.workers")
+
+WORKER_RESTARTS = registry.counter(
+    "tgbot_worker_restarts_total", "Worker processes restarted by the supervisor.", labels=("reason",)
+)
+WORKER_QUEUE_DEPTH = registry.gauge(
+    "tgbot_worker_queue_depth", "Updates routed to a worker process but not yet taken.", labels=("worker",)
+)
+
+# Seconds a worker waits for an update before it refreshes its heartbeat anyway.
+_IDLE_POLL = 1.0
+
+
+def _metrics_push_interval() -> float:
+    """Seconds between metric snapshots a worker sends to the supervisor; 0 when the exporter is off."""
+    conf = getattr(config_bot, "metrics", None)
+    if not getattr(conf, "enabled", False):
+        return 0.0
+    return float(getattr(conf, "worker_push_seconds", 5))
+
+
+def default_bot() -> Bot:
+    return Bot(getattr(config_secret, "TELEGRAM_API_TOKEN", None))
+
+
+class _Worker:
+    """Supervisor-side handle of one worker process.
+
+    Routed updates wait in ``buffer`` and a sender thread writes them, with a
+    sequence number, to the worker's pipe. Sent updates stay in ``unacked``
+    until the worker reports (through ``started`` and ``finished``) that it
+    moved past them.
+    """
+
+    def __init__(self, context: Any, index: int, buffer_size: int) -> None:
+        self.index = index
+        self.buffer: "queue.Queue[Optional[Tuple[int, str]]]" = queue.Queue(max(1, buffer_size))
+        # Shared without locks so a killed worker cannot leave one held.
+        self.heartbeat = context.RawValue("d", 0.0)
+        self.started = context.RawValue("q", 0)
+        self.finished = context.RawValue("q", 0)
+        self.unacked: Deque[Tuple[int, str]] = deque()
+        self.process: Optional[Any] = None
+        self.connection: Optional[Any] = None
+        self.lock = threading.Lock()
+        self.sender: Optional[threading.Thread] = None
+        self._sequence = 0
+        self._sequence_lock = threading.Lock()
+
+    def enqueue(self, payload: str) -> None:
+        with self._sequence_lock:
+            self._sequence += 1
+            # Blocks while the buffer is full; the caller holds the sequence lock so order is kept.
+            self.buffer.put((self._sequence, payload))
+
+    def _trim(self) -> None:
+        finished = self.finished.value
+        while self.unacked and self.unacked[0][0] <= finished:
+            self.unacked.popleft()
+
+    def depth(self) -> int:
+        with self.lock:
+            self._trim()
+            return self.buffer.qsize() + len(self.unacked)
+
+    def send_loop(self) -> None:
+        while True:
+            item = self.buffer.get()
+            with self.lock:
+                if item is not None:
+                    self._trim()
+                    self.unacked.append(item)
+                connection = self.connection
+            try:
+                connection.send(item)
+            except (OSError, ValueError):
+                # The worker died; the restart resends everything still unacknowledged.
+                pass
+            if item is None:
+                return
+
+
+class WorkerPool:
+    """Run the handlers in ``processes`` worker processes.
+
+    Updates are serialized and sent to the worker chosen by :func:`.webhook.shard_for`,
+    and each worker handles them in order, so the updates of one chat are
+    handled in the order Telegram sent them. Workers are started with
+    ``spawn`` and open their own database connections.
+
+    A monitor thread restarts a worker that exited or whose heartbeat is
+    older than ``stall_seconds`` and resends the updates it had not started.
+    The update it was handling when it died is dropped rather than retried,
+    since it may be what killed it.
+
+    Workers send their log records and, when the exporter is enabled,
+    periodic metric snapshots back here, so this process writes every log
+    and ``/metrics`` covers the handlers too.
+    """
+
+    def __init__(
+        self,
+        processes: int,
+        queue_size: int = 1000,
+        stall_seconds: float = 120.0,
+        check_interval: float = 5.0,
+        bot_factory: Callable[[], Bot] = default_bot,
+    ) -> None:
+        self._context = multiprocessing.get_context("spawn")
+        self.stall_seconds = float(stall_seconds)
+        self.check_interval = float(check_interval)
+        self.bot_factory = bot_factory
+        self.workers: List[_Worker] = [
+            _Worker(self._context, index, int(queue_size)) for index in range(max(1, int(processes)))
+        ]
+        self._logs = self._context.Queue(-1)
+        self._log_listener: Optional[Any] = None
+        self._metrics = self._context.Queue(-1)
+        self._metrics_reader: Optional[threading.Thread] = None
+        self._monitor: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def start(self) -> None:
+        if self._monitor is not None:
+            return
+        self._log_listener = serve_forwarded_logs(self._logs)
+        self._metrics_reader = threading.Thread(target=self._read_metrics, name="worker-metrics", daemon=True)
+        self._metrics_reader.start()
+        for worker in self.workers:
+            self._spawn(worker)
+            worker.sender = threading.Thread(target=worker.send_loop, name=f"worker-{worker.index}-sender", daemon=True)
+            worker.sender.start()
+        self._monitor = threading.Thread(target=self._watch, name="worker-monitor", daemon=True)
+        self._monitor.start()
+        logger.info("Started %d worker processes", len(self.workers))
+
+    def attach(self, dispatcher: Dispatcher) -> None:
+        """Make ``dispatcher`` route every update to the workers instead of handling it."""
+        dispatcher.add_handler(TypeHandler(Update, self.route))
+
+    def route(self, update: Update, context: CallbackContext) -> None:
+        payload = update.to_dict()
+        self.workers[shard_for(payload, len(self.workers))].enqueue(json.dumps(payload))
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """Let the workers finish what was routed to them (within ``timeout``) and stop them."""
+        if self._monitor is None:
+            return
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.buffer.put(None)
+        for worker in self.workers:
+            if worker.sender is not None:
+                worker.sender.join(max(0.0, deadline - time.monotonic()))
+            process = worker.process
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("Worker %d did not stop in time; terminating it", worker.index)
+                process.terminate()
+                process.join(5)
+        self._stopping.set()
+        self._monitor.join()
+        self._monitor = None
+        self._metrics.put(None)
+        if self._metrics_reader is not None:
+            self._metrics_reader.join(5)
+            self._metrics_reader = None
+        if self._log_listener is not None:
+            self._log_listener.stop()
+            self._log_listener = None
+        logger.info("Worker processes stopped")
+
+    def _spawn(self, worker: _Worker) -> None:
+        """Start a process for ``worker`` on a fresh pipe and resend what the previous one had not started."""
+        reader, writer = self._context.Pipe(duplex=False)
+        worker.heartbeat.value = time.time()
+        process = self._context.Process(
+            target=worker_main,
+            args=(
+                worker.index,
+                len(self.workers),
+                reader,
+                (worker.heartbeat, worker.started, worker.finished),
+                self._logs,
+                self._metrics,
+                self.bot_factory,
+            ),
+            name=f"tgbot-worker-{worker.index}",
+        )
+        process.start()
+        # Without our copy of the read end, writes fail as soon as the worker dies.
+        reader.close()
+        with worker.lock:
+            previous, worker.connection, worker.process = worker.connection, writer, process
+            if previous is not None:
+                previous.close()
+            started, finished = worker.started.value, worker.finished.value
+            if started > finished:
+                logger.warning("Worker %d died while handling routed update #%d; dropping it", worker.index, started)
+            pending = [item for item in worker.unacked if item[0] > started]
+            worker.unacked = deque(pending)
+            for item in pending:
+                writer.send(item)
+
+    def _read_metrics(self) -> None:
+        while True:
+            item = self._metrics.get()
+            if item is None:
+                return
+            index, snapshot = item
+            registry.merge_remote(f"worker-{index}", snapshot)
+
+    def _watch(self) -> None:
+        while not self._stopping.wait(self.check_interval):
+            for worker in self.workers:
+                try:
+                    self._check(worker)
+                except Exception:  # pragma: no cover - defensive
+                    logger.exception("Health check of worker %d failed", worker.index)
+
+    def _check(self, worker: _Worker) -> None:
+        WORKER_QUEUE_DEPTH.set(worker.depth(), worker=str(worker.index))
+        process = worker.process
+        if process is None or self._stopping.is_set():
+            return
+        if not process.is_alive():
+            if process.exitcode == 0:
+                return  # stopped on request
+            logger.error("Worker %d exited with code %s; restarting it", worker.index, process.exitcode)
+            WORKER_RESTARTS.inc(reason="exited")
+        elif time.time() - worker.heartbeat.value > self.stall_seconds:
+            logger.error("Worker %d made no progress for %.0fs; restarting it", worker.index, self.stall_seconds)
+            WORKER_RESTARTS.inc(reason="stalled")
+            process.terminate()
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        else:
+            return
+        self._spawn(worker)
+
+
+def isolate_worker_caches() -> None:
+    """Turn off the caches another process could make stale.
+
+    A user changed by one worker (e.g. an admin demoted via /manage_user) is
+    only invalidated in that worker's cache, so the others would keep the old
+    role until the TTL expired. Workers read users from the database instead.
+    """
+    user_cache.disable()
+
+
+def worker_main(
+    index: int,
+    shards: int,
+    updates: Any,
+    progress: Tuple[Any, Any, Any],
+    logs: Any,
+    metrics: Any,
+    bot_factory: Callable[[], Bot] = default_bot,
+) -> None:
+    """Entry point of a worker process: handle this worker's share of chats until told to stop."""
+    # Imported here because bot imports this module.
+    from ..bot import register_handlers
+
+    heartbeat, started, finished = progress
+
+    # Ctrl+C reaches the whole process group; the supervisor decides when workers stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    startup.stop_tracking_imports()
+    forward_logs(logs)
+    isolate_worker_caches()
+
+    bot = bot_factory()
+    dispatcher = Dispatcher(bot, None, use_context=True)
+    # Always the sync handlers: an async one returns as soon as it is scheduled,
+    # which would let the next update of the chat overtake it and advance
+    # ``finished`` before the work is done.
+    register_handlers(dispatcher)
+    # The supervisor sends too (Twitter mirroring), hence one extra share.
+    set_global_share(shards + 1)
+    send_queue.start()
+    if WRITE_BEHIND_ENABLED:
+        write_queue.start()
+    reload_conf = getattr(config_bot, "config_reload", None)
+    reload_interval = float(getattr(reload_conf, "interval_seconds", 5)) if getattr(reload_conf, "enabled", True) else 0.0
+    next_reload = time.monotonic() + reload_interval
+    push_interval = _metrics_push_interval()
+    next_push = time.monotonic() + push_interval
+    logger.info("Worker %d of %d ready", index, shards)
+
+    try:
+        while True:
+            heartbeat.value = time.time()
+            if reload_interval and time.monotonic() >= next_reload:
+                reload_config()
+                next_reload = time.monotonic() + reload_interval
+            if push_interval and time.monotonic() >= next_push:
+                metrics.put((index, registry.snapshot()))
+                next_push = time.monotonic() + push_interval
+            if not updates.poll(_IDLE_POLL):
+                continue
+            try:
+                item = updates.recv()
+            except EOFError:
+                logger.error("Worker %d lost its supervisor", index)
+                break
+            if item is None:
+                break
+            sequence, payload = item
+            started.value = sequence
+            dispatcher.process_update(Update.de_json(json.loads(payload), bot))
+            finished.value = sequence
+    finally:
+        logger.info("Worker %d stopping", index)
+        dispatcher.stop()
+        download_pool.stop()
+        send_queue.stop()
+        write_queue.stop()
+        if push_interval:
+            metrics.put((index, registry.snapshot()))
+
+
+def build_worker_pool() -> Optional[WorkerPool]:
+    """Return a pool when ``runtime.processes`` is above 1 in config_bot.yaml."""
+    conf = getattr(config_bot, "runtime", None)
+    processes = int(getattr(conf, "processes", 1))
+    if processes <= 1:
+        return None
+    return WorkerPool(
+        processes,
+        queue_size=getattr(conf, "worker_queue_size", 1000),
+        stall_seconds=getattr(conf, "worker_stall_seconds", 120),
+    )
+
+
+__all__ = ["WorkerPool", "build_worker_pool", "isolate_worker_caches", "worker_main"]
@@ -0,0 +1 @@
+﻿"""File storage helpers package."""
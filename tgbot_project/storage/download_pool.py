@@ -0,0 +1,230 @@
+﻿"""Bounded worker pool that downloads uploads off the dispatcher threads."""
+from __future__ import annotations
+
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Set
+
+from ..config import ConfigNamespace, config_bot
+from ..database.db import get_user_storage_usage
+from ..logger.logger import get_logger
+from ..monitoring.metrics import THROUGHPUT_BUCKETS, registry
+from .file_store import FileStore, get_file_store, iter_telegram_file
+
+logger = get_logger("storage.download_pool")
+
+MB = 1024 * 1024
+
+DOWNLOADS = registry.counter("tgbot_downloads_total", "Finished upload downloads.", labels=("outcome",))
+DOWNLOAD_BYTES = registry.counter("tgbot_download_bytes_total", "Bytes stored by finished downloads.")
+DOWNLOAD_THROUGHPUT = registry.histogram(
+    "tgbot_download_bytes_per_second", "Average throughput of each finished download.", buckets=THROUGHPUT_BUCKETS
+)
+
+ProgressCallback = Callable[[int, Optional[int]], None]
+CompletionCallback = Callable[[Optional[Dict[str, Any]], Optional[BaseException]], None]
+
+
+class UploadRejected(Exception):
+    """Raised when an upload violates a size, quota or concurrency limit.
+
+    The message is meant to be shown to the user as-is.
+    """
+
+
+@dataclass
+class DownloadJob:
+    attachment: Any
+    file_name: Optional[str]
+    user_id: Optional[int]
+    chat_id: Optional[int]
+    on_complete: CompletionCallback
+    on_progress: Optional[ProgressCallback] = None
+
+
+class DownloadPool:
+    """Run uploads on a fixed number of threads with per-user limits.
+
+    Without an explicit ``store`` the shared one from :func:`get_file_store` is
+    used, created when the first upload runs.
+    """
+
+    def __init__(
+        self,
+        store: Optional[FileStore] = None,
+        workers: int = 4,
+        per_user_concurrency: int = 2,
+        max_file_bytes: int = 20 * MB,
+        user_quota_bytes: int = 500 * MB,
+        progress_interval: float = 5.0,
+    ) -> None:
+        self._store = store
+        self.workers = max(1, int(workers))
+        self.per_user_concurrency = max(1, int(per_user_concurrency))
+        self.max_file_bytes = int(max_file_bytes)
+        self.user_quota_bytes = int(user_quota_bytes)
+        self.progress_interval = float(progress_interval)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._active: Dict[Optional[int], int] = defaultdict(int)
+        self._in_flight: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def configure(
+        self,
+        workers: int,
+        per_user_concurrency: int,
+        max_file_bytes: int,
+        user_quota_bytes: int,
+        progress_interval: float,
+    ) -> None:
+        """Apply new limits to later uploads.
+
+        A new worker count takes effect by retiring the current executor: it
+        finishes what it is running while the next upload starts a new one.
+        """
+        retired: Optional[ThreadPoolExecutor] = None
+        with self._lock:
+            workers = max(1, int(workers))
+            if workers != self.workers:
+                self.workers = workers
+                retired, self._executor = self._executor, None
+            self.per_user_concurrency = max(1, int(per_user_concurrency))
+            self.max_file_bytes = int(max_file_bytes)
+            self.user_quota_bytes = int(user_quota_bytes)
+            self.progress_interval = float(progress_interval)
+        if retired is not None:
+            retired.shutdown(wait=False)
+
+    @property
+    def store(self) -> FileStore:
+        return self._store if self._store is not None else get_file_store()
+
+    def active_downloads(self) -> int:
+        with self._lock:
+            return sum(self._active.values())
+
+    def submit(self, job: DownloadJob) -> None:
+        """Validate and queue ``job``; raises :class:`UploadRejected` when it cannot run."""
+        declared_size = getattr(job.attachment, "file_size", None)
+        if declared_size and declared_size > self.max_file_bytes:
+            raise UploadRejected(f"文件过大（{format_size(declared_size)}），上限为 {format_size(self.max_file_bytes)}。")
+
+        if job.user_id is not None and self.user_quota_bytes > 0:
+            used = get_user_storage_usage(job.user_id)
+            if used + (declared_size or 0) > self.user_quota_bytes:
+                raise UploadRejected(
+                    f"存储配额不足：已使用 {format_size(used)}，上限为 {format_size(self.user_quota_bytes)}。"
+                )
+
+        file_unique_id = job.attachment.file_unique_id
+        with self._lock:
+            if file_unique_id in self._in_flight:
+                raise UploadRejected("该文件正在接收中，请稍候。")
+            if self._active[job.user_id] >= self.per_user_concurrency:
+                raise UploadRejected("你已有文件正在上传，请等待完成后再试。")
+            self._active[job.user_id] += 1
+            self._in_flight.add(file_unique_id)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="download")
+            executor = self._executor
+
+        executor.submit(self._run, job)
+
+    def stop(self, wait: bool = True) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def _run(self, job: DownloadJob) -> None:
+        record: Optional[Dict[str, Any]] = None
+        error: Optional[BaseException] = None
+        started = time.perf_counter()
+        try:
+            telegram_file = job.attachment.get_file()
+            if telegram_file.file_size and telegram_file.file_size > self.max_file_bytes:
+                raise UploadRejected(
+                    f"文件过大（{format_size(telegram_file.file_size)}），上限为 {format_size(self.max_file_bytes)}。"
+                )
+            chunks = self._metered(
+                iter_telegram_file(telegram_file, self.store.chunk_size),
+                telegram_file.file_size,
+                job.on_progress,
+            )
+            record = self.store.store_stream(
+                chunks,
+                file_unique_id=job.attachment.file_unique_id,
+                file_name=job.file_name,
+                mime_type=getattr(job.attachment, "mime_type", None),
+                uploaded_by=job.user_id,
+                chat_id=job.chat_id,
+            )
+            elapsed = time.perf_counter() - started
+            DOWNLOADS.inc(outcome="ok")
+            DOWNLOAD_BYTES.inc(record["size"])
+            if elapsed > 0:
+                DOWNLOAD_THROUGHPUT.observe(record["size"] / elapsed)
+        except Exception as exc:
+            error = exc
+            DOWNLOADS.inc(outcome="rejected" if isinstance(exc, UploadRejected) else "error")
+            if not isinstance(exc, UploadRejected):
+                logger.exception("Download of %s failed", job.file_name)
+        finally:
+            with self._lock:
+                self._in_flight.discard(job.attachment.file_unique_id)
+                self._active[job.user_id] -= 1
+                if self._active[job.user_id] <= 0:
+                    del self._active[job.user_id]
+        try:
+            job.on_complete(record, error)
+        except Exception:
+            logger.exception("Upload completion callback failed for %s", job.file_name)
+
+    def _metered(
+        self,
+        chunks: Iterable[bytes],
+        total: Optional[int],
+        on_progress: Optional[ProgressCallback],
+    ) -> Iterator[bytes]:
+        received = 0
+        last_report = time.monotonic()
+        for chunk in chunks:
+            received += len(chunk)
+            if received > self.max_file_bytes:
+                raise UploadRejected(f"文件超过上限 {format_size(self.max_file_bytes)}，已停止接收。")
+            if on_progress is not None and time.monotonic() - last_report >= self.progress_interval:
+                last_report = time.monotonic()
+                on_progress(received, total)
+            yield chunk
+
+
+def format_size(size: int) -> str:
+    if size >= MB:
+        return f"{size / MB:.1f} MB"
+    return f"{size / 1024:.1f} KB"
+
+
+def _upload_settings(bot_conf: ConfigNamespace) -> Dict[str, Any]:
+    conf = getattr(bot_conf, "uploads", None)
+    return {
+        "workers": int(getattr(conf, "workers", 4)),
+        "per_user_concurrency": int(getattr(conf, "per_user_concurrency", 2)),
+        "max_file_bytes": int(float(getattr(conf, "max_file_mb", 20)) * MB),
+        "user_quota_bytes": int(float(getattr(conf, "user_quota_mb", 500)) * MB),
+        "progress_interval": float(getattr(conf, "progress_interval", 5)),
+    }
+
+
+def _build_download_pool() -> DownloadPool:
+    return DownloadPool(**_upload_settings(config_bot.snapshot()))
+
+
+download_pool = _build_download_pool()
+config_bot.add_validator(_upload_settings)
+config_bot.subscribe(lambda conf: download_pool.configure(**_upload_settings(conf)))
+registry.gauge("tgbot_downloads_active", "Downloads currently running.", collect=download_pool.active_downloads)
+
+__all__ = ["DownloadJob", "DownloadPool", "UploadRejected", "download_pool", "format_size"]
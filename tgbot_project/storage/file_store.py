@@ -0,0 +1,135 @@
+﻿"""Content-addressed storage for uploaded files."""
+from __future__ import annotations
+
+import hashlib
+import os
+import tempfile
+import threading
+import urllib.request
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+from telegram import File
+
+from ..config import config_bot
+from ..database.db import get_stored_file, record_stored_file
+from ..logger.logger import get_logger
+
+logger = get_logger("storage.file_store")
+
+_PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+
+def iter_telegram_file(telegram_file: File, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Yield the contents of a Telegram file in chunks without buffering it whole."""
+    file_path = telegram_file.file_path or ""
+    local_path = Path(file_path)
+    # A self-hosted Bot API server in --local mode hands out filesystem paths.
+    if local_path.is_absolute() and local_path.is_file():
+        with local_path.open("rb") as source:
+            yield from iter(lambda: source.read(chunk_size), b"")
+        return
+    with urllib.request.urlopen(file_path, timeout=60) as response:
+        yield from iter(lambda: response.read(chunk_size), b"")
+
+
+class FileStore:
+    """Store blobs under ``objects/<aa>/<bb>/<sha256>`` and index them by ``file_unique_id``.
+
+    Content is hashed while it is streamed into a temporary file in the same
+    filesystem and then atomically renamed into place, so identical content is
+    kept once no matter how often or under which name it is uploaded.
+    """
+
+    def __init__(self, root: Path, chunk_size: int = 64 * 1024) -> None:
+        self.root = Path(root)
+        self.chunk_size = int(chunk_size)
+        self.objects_dir = self.root / "objects"
+        self.tmp_dir = self.root / "tmp"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, digest: str) -> Path:
+        return self.objects_dir / digest[:2] / digest[2:4] / digest
+
+    def absolute_path(self, record: Dict[str, Any]) -> Path:
+        return self.root / record["storage_path"]
+
+    def lookup(self, file_unique_id: str) -> Optional[Dict[str, Any]]:
+        """Return the index record for ``file_unique_id`` if its blob is still on disk."""
+        record = get_stored_file(file_unique_id)
+        if record is None:
+            return None
+        if not self.absolute_path(record).exists():
+            logger.warning("Blob for %s is missing on disk; it will be downloaded again", file_unique_id)
+            return None
+        return record
+
+    def store_stream(
+        self,
+        chunks: Iterable[bytes],
+        file_unique_id: str,
+        file_name: Optional[str] = None,
+        mime_type: Optional[str] = None,
+        uploaded_by: Optional[int] = None,
+        chat_id: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        digest, size = self._write_blob(chunks)
+        return record_stored_file(
+            file_unique_id=file_unique_id,
+            sha256=digest,
+            size=size,
+            storage_path=self.path_for(digest).relative_to(self.root).as_posix(),
+            file_name=file_name,
+            mime_type=mime_type,
+            uploaded_by=uploaded_by,
+            chat_id=chat_id,
+        )
+
+    def _write_blob(self, chunks: Iterable[bytes]) -> Tuple[str, int]:
+        hasher = hashlib.sha256()
+        size = 0
+        handle, tmp_name = tempfile.mkstemp(dir=self.tmp_dir, prefix="upload-")
+        try:
+            with os.fdopen(handle, "wb") as tmp_file:
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    tmp_file.write(chunk)
+                    size += len(chunk)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            digest = hasher.hexdigest()
+            target = self.path_for(digest)
+            if target.exists():
+                os.unlink(tmp_name)
+            else:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(tmp_name, target)
+            return digest, size
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            raise
+
+
+def _build_file_store() -> FileStore:
+    conf = getattr(config_bot, "storage", None)
+    root = Path(os.getenv("TGBOT_STORAGE_ROOT") or _PROJECT_ROOT / getattr(conf, "root", "files/store"))
+    return FileStore(root.resolve(), chunk_size=getattr(conf, "chunk_size", 64 * 1024))
+
+
+_file_store: Optional[FileStore] = None
+_file_store_lock = threading.Lock()
+
+
+def get_file_store() -> FileStore:
+    """Return the shared store, creating its directories on first use."""
+    global _file_store
+    if _file_store is None:
+        with _file_store_lock:
+            if _file_store is None:
+                _file_store = _build_file_store()
+    return _file_store
+
+
+__all__ = ["FileStore", "get_file_store", "iter_telegram_file"]